@@ -2,8 +2,16 @@
 Implements convolutional networks in PyTorch.
 WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
+import copy
+import json
+import math
+import os
+import warnings
+
 import torch
 from fully_connected_networks import Linear_ReLU, Linear, Solver, adam, ReLU, softmax_loss
+from fully_connected_networks import LossScaler, Workspace, low_precision_supported, _cast_params, _master_grad, _predict
+from rob599 import ParamStore, initialize_params, load_checkpoint, save_checkpoint
 
 
 def hello_convolutional_networks():
@@ -17,7 +25,7 @@ def hello_convolutional_networks():
 class Conv(object):
 
     @staticmethod
-    def forward(x, w, b, conv_param):
+    def forward(x, w, b, conv_param, out=None):
         """
         A naive implementation of the forward pass for a convolutional layer.
         The input consists of N data points, each with C channels, height H and
@@ -32,6 +40,8 @@ class Conv(object):
           - 'stride': The number of pixels between adjacent receptive fields
             in the horizontal and vertical directions.
           - 'pad': The number of pixels that is used to zero-pad the input.
+        - out: Optional buffer of shape (N, F, H', W') to write the output
+          into
 
         During padding, 'pad' zeros should be placed symmetrically (i.e equally
         on both sides) along the height and width axes of the input. Be careful
@@ -43,7 +53,6 @@ class Conv(object):
           W' = 1 + (W + 2 * pad - WW) / stride
         - cache: (x, w, b, conv_param)
         """
-        out = None
         N, C, H, W = x.shape
         F, C1, HH, WW = w.shape
         st = conv_param['stride']
@@ -51,7 +60,8 @@ class Conv(object):
         xpadding = torch.nn.functional.pad(x, (pd, pd, pd, pd),"constant", 0) 
         Hout = 1 + (H + 2 * pd - HH) // st
         Wout = 1 + (W + 2 * pd - WW) // st
-        out = torch.zeros((N, F, Hout, Wout),dtype=torch.float64, device=x.device)
+        if out is None:
+            out = torch.zeros((N, F, Hout, Wout), dtype=x.dtype, device=x.device)
         for num in range(N):
           for k in range(F):
             for i in range(0, Hout):
@@ -110,9 +120,14 @@ class Conv(object):
 class MaxPool(object):
 
     @staticmethod
-    def forward(x, pool_param):
+    def forward(x, pool_param, out=None):
         """
-        A naive implementation of the forward pass for a max-pooling layer.
+        Forward pass for a max-pooling layer.
+
+        The pooling windows are read as a strided view of x, so no data is
+        copied before the max. Instead of keeping x for the backward pass,
+        the cache stores the offset of the max element inside each window as
+        a compact integer tensor.
 
         Inputs:
         - x: Input data, of shape (N, C, H, W)
@@ -121,66 +136,96 @@ class MaxPool(object):
           - 'pool_width': The width of each pooling region
           - 'stride': The distance between adjacent pooling regions
         No padding is necessary here.
+        - out: Optional tuple of buffers (out, argmax) of shape (N, C, H', W')
+          to write the output and the int64 window offsets of the max into
 
         Returns a tuple of:
         - out: Output of shape (N, C, H', W') where H' and W' are given by
           H' = 1 + (H - pool_height) / stride
           W' = 1 + (W - pool_width) / stride
-        - cache: (x, pool_param)
+        - cache: (x_shape, argmax, pool_param)
         """
-        out = None
-        N,C,H,W = x.shape
+        N, C, H, W = x.shape
         pheight = pool_param['pool_height']
         pwidth = pool_param['pool_width']
         st = pool_param['stride']
         Heightp = 1 + (H - pheight) // st
         Weightp = 1 + (W - pwidth) // st
-        out = torch.zeros((N,C,Heightp,Weightp),dtype=torch.float64, device=x.device)
-        for num in range(N):
-          for chan in range(C):
-            for hei in range(Heightp):
-                for wei in range(Weightp):
-                    heightstart = hei * st
-                    heightend = heightstart + pheight
-                    weightstart = wei * st
-                    weightend = weightstart + pwidth
-                    x_pool = x[num, chan, heightstart:heightend, weightstart:weightend]
-                    out[num, chan, hei, wei] = torch.max(x_pool)
-        cache = (x, pool_param)
+        sN, sC, sH, sW = x.stride()
+        windows = x.as_strided((N, C, Heightp, Weightp, pheight, pwidth),
+                               (sN, sC, sH * st, sW * st, sH, sW))
+        windows = windows.reshape(N, C, Heightp, Weightp, pheight * pwidth)
+        if out is None:
+            out, argmax = windows.max(dim=-1)
+        else:
+            out, argmax = torch.max(windows, dim=-1, out=out)
+        cache = (x.shape, argmax.to(_index_dtype(pheight * pwidth)),
+                 pool_param)
         return out, cache
 
     @staticmethod
-    def backward(dout, cache):
+    def backward(dout, cache, out=None):
         """
-        A naive implementation of the backward pass for a max-pooling layer.
+        Backward pass for a max-pooling layer. The upstream gradient of each
+        window is routed to its max element only, and all windows are
+        scattered in a single op, which also handles overlapping windows.
         Inputs:
         - dout: Upstream derivatives
-        - cache: A tuple of (x, pool_param) as in the forward pass.
+        - cache: A tuple of (x_shape, argmax, pool_param) as in the forward
+          pass.
+        - out: Optional contiguous buffer of shape x_shape to write dx into
         Returns:
         - dx: Gradient with respect to x
         """
-        dx = None
-        x, pool_param = cache
-        N, C, H, W = x.shape
-        pheight = pool_param['pool_height']
+        x_shape, argmax, pool_param = cache
+        N, C, H, W = x_shape
         pwidth = pool_param['pool_width']
         st = pool_param['stride']
-        Heightp = 1 + (H - pheight) // st
-        Weightp = 1 + (W - pwidth) // st
-        dx = torch.zeros_like(x, dtype=torch.float64, device=x.device)
-        for num in range(N):
-          for chan in range(C):
-            for hei in range(Heightp):
-                for wei in range(Weightp):
-                    heightstart = hei * st
-                    heightend = heightstart + pheight
-                    weightstart = wei * st
-                    weightend = weightstart + pwidth
-                    x_pool = x[num, chan, heightstart:heightend, weightstart:weightend]
-                    mask = (x_pool == torch.max(x_pool))
-                    dx[num, chan, heightstart:heightend, weightstart:weightend] += mask * dout[num, chan, hei, wei]
+        Heightp, Weightp = argmax.shape[2:]
+        argmax = argmax.long()
+        rows = torch.div(argmax, pwidth, rounding_mode='floor') \
+            + st * torch.arange(Heightp, device=dout.device).view(-1, 1)
+        cols = argmax.remainder(pwidth) \
+            + st * torch.arange(Weightp, device=dout.device)
+        index = (rows * W + cols).view(N, C, -1)
+        if out is None:
+            dx = torch.zeros(N, C, H * W, dtype=dout.dtype, device=dout.device)
+        else:
+            dx = out.view(N, C, H * W).zero_()
+        dx.scatter_add_(2, index, dout.reshape(N, C, -1))
+        return dx.view(N, C, H, W)
 
-        return dx
+
+def _conv_output_shape(x, w, conv_param):
+    """
+    Shape (N, F, H', W') of the output of a convolution of x with w.
+    """
+    N, _, H, W = x.shape
+    F, _, HH, WW = w.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+    return (N, F, 1 + (H + 2 * pad - HH) // stride,
+            1 + (W + 2 * pad - WW) // stride)
+
+
+def _pool_output_shape(x, pool_param):
+    """
+    Shape (N, C, H', W') of the output of max pooling x.
+    """
+    N, C, H, W = x.shape
+    stride = pool_param['stride']
+    return (N, C, 1 + (H - pool_param['pool_height']) // stride,
+            1 + (W - pool_param['pool_width']) // stride)
+
+
+def _index_dtype(size):
+    """
+    Smallest integer dtype that can hold indices in the range [0, size).
+    """
+    if size <= 2 ** 7:
+        return torch.int8
+    if size <= 2 ** 15:
+        return torch.int16
+    return torch.int64
 
 
 class ThreeLayerConvNet(object):
@@ -201,7 +246,10 @@ class ThreeLayerConvNet(object):
                  weight_scale=1e-3,
                  reg=0.0,
                  dtype=torch.float,
-                 device='cpu'):
+                 device='cpu',
+                 conv_engine='fast',
+                 pool_engine='fast',
+                 init_seed=None):
         """
         Initialize a new network.
         Inputs:
@@ -217,28 +265,39 @@ class ThreeLayerConvNet(object):
           using this datatype. float is faster but less accurate, so you
           should use double for numeric gradient checking.
         - device: device to use for computation. 'cpu' or 'cuda'
+        - conv_engine, pool_engine: Implementations of the convolution and
+          pooling layers; 'fast' by default. Autotuning is opt-in: pass
+          'auto' to let the autotuner time the candidates on first use and
+          pick the fastest ones. See _conv_engine and _pool_engine.
+        - init_seed: If not None, seed each parameter's initialization
+          separately from it; see rob599.initialize_params.
         """
         self.params = {}
         self.reg = reg
         self.dtype = dtype
-        self.params['W1'] = torch.randn(num_filters, input_dims[0], filter_size, filter_size, dtype=dtype, device=device) * weight_scale
-        self.params['b1'] = torch.zeros(num_filters, dtype=dtype, device=device)
+        self.conv_engine = conv_engine
+        self.pool_engine = pool_engine
         pool_output_size = num_filters * (input_dims[1] // 2) * (input_dims[2] // 2)
-        self.params['W2'] = torch.randn(pool_output_size, hidden_dim, dtype=dtype, device=device) * weight_scale
-        self.params['b2'] = torch.zeros(hidden_dim, dtype=dtype, device=device)
-        self.params['W3'] = torch.randn(hidden_dim, num_classes, dtype=dtype, device=device) * weight_scale
-        self.params['b3'] = torch.zeros(num_classes, dtype=dtype, device=device)
+        self.params = initialize_params([
+            ('W1', (num_filters, input_dims[0], filter_size, filter_size), weight_scale),
+            ('b1', (num_filters,), 'zeros'),
+            ('W2', (pool_output_size, hidden_dim), weight_scale),
+            ('b2', (hidden_dim,), 'zeros'),
+            ('W3', (hidden_dim, num_classes), weight_scale),
+            ('b3', (num_classes,), 'zeros'),
+        ], dtype=dtype, device=device, seed=init_seed)
+
     def save(self, path):
         checkpoint = {
           'reg': self.reg,
           'dtype': self.dtype,
           'params': self.params,
         }
-        torch.save(checkpoint, path)
+        save_checkpoint(path, checkpoint)
         print("Saved in {}".format(path))
 
     def load(self, path):
-        checkpoint = torch.load(path, map_location='cpu')
+        checkpoint = load_checkpoint(path)
         self.params = checkpoint['params']
         self.dtype = checkpoint['dtype']
         self.reg = checkpoint['reg']
@@ -261,8 +320,10 @@ class ThreeLayerConvNet(object):
         W1, b1 = self.params['W1'], self.params['b1']
         W2, b2 = self.params['W2'], self.params['b2']
         W3, b3 = self.params['W3'], self.params['b3']
-        conv_param = {'stride': 1, 'pad': (W1.shape[2] - 1) // 2}
-        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+        conv_param = {'stride': 1, 'pad': (W1.shape[2] - 1) // 2,
+                      'engine': self.conv_engine}
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                      'engine': self.pool_engine}
         X = X.to(self.dtype)
         cout, ccache = Conv_ReLU_Pool.forward(X, W1, b1, conv_param, pool_param)
         aout, acache = Linear_ReLU.forward(cout, W2, b2)
@@ -282,6 +343,32 @@ class ThreeLayerConvNet(object):
         grads['W1'] += self.reg * W1
         return loss, grads
 
+    def predict(self, X, batch_size=100, k=1):
+        """
+        Predict the k most likely classes for X with a test-time forward pass.
+        Same API as FullyConnectedNet.predict: no caches are built and the
+        fully-connected activations reuse preallocated buffers.
+        """
+        W1, b1 = self.params['W1'], self.params['b1']
+        W2, b2 = self.params['W2'], self.params['b2']
+        W3, b3 = self.params['W3'], self.params['b3']
+        pad = (W1.shape[2] - 1) // 2
+        device = W1.device
+        hidden = torch.empty(batch_size, W2.shape[1], dtype=self.dtype,
+                             device=device)
+        scores = torch.empty(batch_size, W3.shape[1], dtype=self.dtype,
+                             device=device)
+
+        def forward(x):
+            x = x.to(device=device, dtype=self.dtype)
+            x = torch.nn.functional.conv2d(x, W1, b1, padding=pad).relu_()
+            x = torch.nn.functional.max_pool2d(x, 2, 2).flatten(1)
+            n = x.shape[0]
+            h = torch.addmm(b2, x, W2, out=hidden[:n]).relu_()
+            return torch.addmm(b3, h, W3, out=scores[:n])
+
+        return _predict(forward, X, batch_size, k, self.dtype, device)
+
 
 class DeepConvNet(object):
     """
@@ -314,7 +401,15 @@ class DeepConvNet(object):
                  reg=0.0,
                  weight_initializer=None,
                  dtype=torch.float,
-                 device='cpu'):
+                 device='cpu',
+                 compute_dtype=None,
+                 fuse_layers=False,
+                 checkpoint=False,
+                 checkpoint_segment=None,
+                 conv_engines='fast',
+                 pool_engine='fast',
+                 workspace=False,
+                 init_seed=None):
         """
         Initialize a new network.
 
@@ -327,8 +422,8 @@ class DeepConvNet(object):
         - batchnorm: Whether to include batch normalization in each macro layer
         - num_classes: Number of scores to produce from the final linear layer.
         - weight_scale: Scalar giving standard deviation for random
-          initialization of weights, or the string "kaiming" to use Kaiming
-          initialization instead
+          initialization of weights, or the string "kaiming" (or "xavier")
+          to use Kaiming (or Xavier) initialization instead
         - reg: Scalar giving L2 regularization strength. L2 regularization
           should only be applied to convolutional and fully-connected weight
           matrices; it should not be applied to biases or to batchnorm scale
@@ -337,45 +432,88 @@ class DeepConvNet(object):
           using this datatype. float is faster but less accurate, so you should
           use double for numeric gradient checking.
         - device: device to use for computation. 'cpu' or 'cuda'
+        - compute_dtype: If not None, a low-precision dtype such as
+          torch.bfloat16 for mixed-precision training. The parameters are
+          kept in dtype as master weights, while the forward and backward
+          passes run in compute_dtype with dynamic loss scaling. Batchnorm
+          statistics and the softmax loss are computed in full precision.
+        - fuse_layers: If True, run each macro layer as a single fused layer
+          that saves far fewer activations for the backward pass and
+          recomputes the rest.
+        - checkpoint: If True, the training forward pass only keeps the input
+          of every checkpoint_segment-th macro layer, and the backward pass
+          recomputes the macro layer caches one segment at a time. This
+          trades one extra forward pass for memory that grows with the
+          segment length rather than the depth; gradients are unchanged.
+        - checkpoint_segment: Number of macro layers per checkpointed
+          segment. Defaults to ceil(sqrt(L - 1)).
+        - conv_engines: Convolution engine used by the macro layers; either a
+          single engine name or a list of length (L - 1) with one per macro
+          layer; 'fast' by default. See _conv_engine for the available
+          engines. Autotuning is opt-in: with 'auto' the autotuner times the
+          candidates on first use and picks the fastest one for each layer.
+        - pool_engine: Implementation of the pooling layers, 'fast' by
+          default; see _pool_engine. Fused macro layers always use MaxPool.
+        - workspace: If True, training iterations write layer outputs and
+          gradients into buffers from a Workspace, which are reused from one
+          iteration to the next. This covers the ReLU, pooling and batchnorm
+          layers and the convolution engines with an out= variant ('naive',
+          'im2col' and 'winograd'); 'fast' convolutions still allocate their
+          outputs. Fused macro layers and checkpointing, which exist to hold
+          fewer activations, do not use the workspace.
+        - init_seed: If not None, seed each parameter's initialization
+          separately from it; see rob599.initialize_params.
         """
         self.params = {}
         self.num_layers = len(num_filters)+1
         self.max_pools = max_pools
         self.batchnorm = batchnorm
+        self.fuse_layers = fuse_layers
+        self.checkpoint = checkpoint
+        if checkpoint_segment is None:
+            checkpoint_segment = math.ceil(math.sqrt(len(num_filters)))
+        self.checkpoint_segment = max(1, checkpoint_segment)
+        if isinstance(conv_engines, str):
+            conv_engines = [conv_engines] * len(num_filters)
+        self.conv_engines = list(conv_engines)
+        self.pool_engine = pool_engine
+        self.workspace = Workspace() if workspace else None
         self.reg = reg
         self.dtype = dtype
 
         if device == 'cuda':
             device = 'cuda:0'
+        if compute_dtype is not None and \
+                not low_precision_supported(compute_dtype, device):
+            warnings.warn('%s is not supported on %s; training in %s'
+                          % (compute_dtype, device, dtype))
+            compute_dtype = None
+        self.compute_dtype = compute_dtype
+        self.loss_scaler = None
+        if compute_dtype is not None:
+            self.loss_scaler = LossScaler()
         C, H, W = input_dims
         L = self.num_layers
         shrink = 4 ** len(set(max_pools)) 
 
-        if isinstance(weight_scale, str):  
-          for layer, F in enumerate(num_filters):
-            self.params[f'W{layer+1}'] = kaiming_initializer(F,C,3,dtype=dtype,device=device)
-            self.params[f'b{layer+1}'] = torch.zeros(F,dtype=dtype,device=device)
-            
-            if self.batchnorm:
-              self.params[f'gamma{layer+1}'] = torch.ones(F,dtype=dtype,device=device)
-              self.params[f'beta{layer+1}'] = torch.zeros(F,dtype=dtype,device=device)
-            C = F  
-            
-          self.params[f'W{L}'] = kaiming_initializer(C*H*W//shrink,num_classes,dtype=dtype,device=device)
-        
-        else:
-          for layer, F in enumerate(num_filters):
-            self.params[f'W{layer+1}'] = weight_scale * torch.randn(F,C,3,3,dtype=dtype,device=device)
-            self.params[f'b{layer+1}'] = torch.zeros(F,dtype=dtype,device=device)
-            
-            if self.batchnorm:
-              self.params[f'gamma{layer+1}'] = torch.ones(F,dtype=dtype,device=device)
-              self.params[f'beta{layer+1}'] = torch.zeros(F,dtype=dtype,device=device)
-            C = F 
-
-          self.params[f'W{L}'] = weight_scale * torch.randn(C*H*W//shrink,num_classes,dtype=dtype,device=device)
-        
-        self.params[f'b{L}'] = torch.zeros(num_classes,dtype=dtype,device=device) 
+        # weight_scale is either a standard deviation or the name of an
+        # initialization scheme, both of which initialize_params understands.
+        # Any other string means Kaiming initialization, as it always has.
+        if isinstance(weight_scale, str) and \
+                weight_scale not in ('kaiming', 'xavier'):
+          weight_scale = 'kaiming'
+        specs = []
+        for layer, F in enumerate(num_filters):
+          specs.append((f'W{layer+1}', (F, C, 3, 3), weight_scale))
+          specs.append((f'b{layer+1}', (F,), 'zeros'))
+          if self.batchnorm:
+            specs.append((f'gamma{layer+1}', (F,), 'ones'))
+            specs.append((f'beta{layer+1}', (F,), 'zeros'))
+          C = F
+        specs.append((f'W{L}', (C*H*W//shrink, num_classes), weight_scale))
+        specs.append((f'b{L}', (num_classes,), 'zeros'))
+        self.params = initialize_params(specs, dtype=dtype, device=device,
+                                        seed=init_seed)
         self.bn_params = []
         if self.batchnorm:
             self.bn_params = [{'mode': 'train'}
@@ -411,11 +549,11 @@ class DeepConvNet(object):
           'batchnorm': self.batchnorm,
           'bn_params': self.bn_params,
         }
-        torch.save(checkpoint, path)
+        save_checkpoint(path, checkpoint)
         print("Saved in {}".format(path))
 
     def load(self, path, dtype, device):
-        checkpoint = torch.load(path, map_location='cpu')
+        checkpoint = load_checkpoint(path, dtype=dtype, device=device)
         self.params = checkpoint['params']
         self.dtype = dtype
         self.reg = checkpoint['reg']
@@ -424,16 +562,124 @@ class DeepConvNet(object):
         self.batchnorm = checkpoint['batchnorm']
         self.bn_params = checkpoint['bn_params']
 
-        for p in self.params:
-            self.params[p] = \
-                self.params[p].type(dtype).to(device)
+        print("load checkpoint file: {}".format(path))
 
-        for i in range(len(self.bn_params)):
-            for p in ["running_mean", "running_var"]:
-                self.bn_params[i][p] = \
-                    self.bn_params[i][p].type(dtype).to(device)
+    def fold_batchnorm(self):
+        """
+        Return an inference copy of this network in which every batchnorm
+        layer is folded into the convolution before it, using the running
+        statistics. The copy computes the same test-time scores with
+        conv - relu - [pool] macro layers only; it should not be trained.
+        The parameters of this network are left untouched.
+        """
+        model = copy.copy(self)
+        model.batchnorm = False
+        model.bn_params = []
+        if not self.batchnorm:
+            return model
 
-        print("load checkpoint file: {}".format(path))
+        model.params = dict(self.params)
+        for layer in range(1, self.num_layers):
+            W, b = self.params[f'W{layer}'], self.params[f'b{layer}']
+            gamma = model.params.pop(f'gamma{layer}')
+            beta = model.params.pop(f'beta{layer}')
+            bn_param = self.bn_params[layer - 1]
+            eps = bn_param.get('eps', 1e-5)
+            zeros = torch.zeros_like(b)
+            running_mean = bn_param.get('running_mean', zeros).to(b.dtype)
+            running_var = bn_param.get('running_var', zeros).to(b.dtype)
+            # gamma * (W * x + b - mean) / std + beta
+            scale = gamma * (running_var + eps).rsqrt()
+            model.params[f'W{layer}'] = W * scale.view(-1, 1, 1, 1)
+            model.params[f'b{layer}'] = (b - running_mean) * scale + beta
+        model.params = ParamStore(model.params)
+        return model
+
+    def _folded_model(self):
+        """
+        Return fold_batchnorm(), reusing the copy folded by a previous call
+        while the parameters and running statistics are unchanged: the same
+        tensors, none of them updated in place since.
+        """
+        tensors = list(self.params.items())
+        eps = []
+        for bn_param in self.bn_params:
+            tensors += [(k, v) for k, v in bn_param.items()
+                        if torch.is_tensor(v)]
+            eps.append(bn_param.get('eps', 1e-5))
+        # Tensors are compared by identity and in-place version counter
+        state = (eps, [(k, v, v._version) for k, v in tensors])
+        cached = getattr(self, '_folded', None)
+        if cached is not None:
+            (old_eps, old), model = cached
+            if old_eps == eps and len(old) == len(state[1]) and all(
+                    a[0] == b[0] and a[1] is b[1] and a[2] == b[2]
+                    for a, b in zip(old, state[1])):
+                return model
+        # Drop the old copy first so the new one does not keep it alive
+        self._folded = None
+        self._folded = (state, self.fold_batchnorm())
+        return self._folded[1]
+
+    def _macro_layer(self, layer):
+        """
+        Return the layer class implementing macro layer `layer` (one-indexed)
+        and whether that macro layer pools.
+        """
+        pool = layer - 1 in self.max_pools
+        if self.fuse_layers:
+            if self.batchnorm:
+                return Fused_Conv_BatchNorm_ReLU_Pool, pool
+            return Fused_Conv_ReLU_Pool, pool
+        if self.batchnorm:
+            if pool:
+                return Conv_BatchNorm_ReLU_Pool, pool
+            return Conv_BatchNorm_ReLU, pool
+        if pool:
+            return Conv_ReLU_Pool, pool
+        return Conv_ReLU, pool
+
+    def _macro_forward(self, layer, x, params, recompute=False, ws=None):
+        """
+        Forward pass of macro layer `layer` (one-indexed) on input x, using
+        the weights in params. Returns a tuple of (out, cache).
+
+        When recompute is True the batchnorm running statistics are left
+        untouched, since the first forward pass already updated them. ws is
+        an optional Workspace to take the layer's buffers from.
+        """
+        # Padding and stride chosen to preserve the input spatial size
+        filter_size = 3
+        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2,
+                      'engine': self.conv_engines[layer - 1]}
+        # 2x2 max pooling halves the spatial size
+        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2,
+                      'engine': self.pool_engine}
+
+        macro_layer, pool = self._macro_layer(layer)
+        args = [x, params[f'W{layer}'], params[f'b{layer}']]
+        if self.batchnorm:
+            args += [params[f'gamma{layer}'], params[f'beta{layer}']]
+        args.append(conv_param)
+        if self.batchnorm:
+            bn_param = self.bn_params[layer - 1]
+            args.append(dict(bn_param) if recompute else bn_param)
+        if pool:
+            args.append(pool_param)
+        if ws is not None:
+            return macro_layer.forward(*args, ws=ws.bind(layer, x.device))
+        return macro_layer.forward(*args)
+
+    def _recompute_segment(self, start, end, x, params):
+        """
+        Rerun macro layers start, ..., end (one-indexed, inclusive) from the
+        checkpointed input x and return a dictionary of their caches.
+        """
+        caches = {}
+        for layer in range(start, end + 1):
+            x, caches[layer] = self._macro_forward(layer, x, params,
+                                                   recompute=True)
+        return caches
 
     def loss(self, X, y=None):
         """
@@ -441,7 +687,14 @@ class DeepConvNet(object):
         network.
         Input / output: Same API as ThreeLayerConvNet.
         """
-        X = X.to(self.dtype)
+        # With mixed precision, run the layers on low-precision copies of the
+        # master weights
+        params, scale, dtype = self.params, 1.0, self.dtype
+        if self.compute_dtype is not None:
+            dtype = self.compute_dtype
+            params = _cast_params(self.params, dtype)
+            scale = self.loss_scaler.scale
+        X = X.to(dtype)
         mode = 'test' if y is None else 'train'
 
         # Set train/test mode for batchnorm params since they
@@ -449,58 +702,101 @@ class DeepConvNet(object):
         if self.batchnorm:
             for bn_param in self.bn_params:
                 bn_param['mode'] = mode
-        scores = None
-
-        # pass conv_param to the forward pass for the
-        # convolutional layer
-        # Padding and stride chosen to preserve the input
-        # spatial size
-        filter_size = 3
-        conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
-
-        # pass pool_param to the forward pass for the max-pooling layer
-        pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
 
         scores = None
         cache_dict, L = {}, self.num_layers
-        max_pools = set(self.max_pools)
+        # With checkpointing, only keep the inputs of the first macro layer
+        # of each segment; the caches are rebuilt during the backward pass
+        checkpointing = self.checkpoint and y is not None
+        k = self.checkpoint_segment
+        checkpoints = {}
+        # Scores are returned to the caller in test mode, so only training
+        # iterations use the workspace; holding every activation in it would
+        # defeat fused layers and checkpointing
+        ws = self.workspace
+        if y is None or self.fuse_layers or checkpointing:
+            ws = None
         out = X
-        if self.batchnorm:
-          for layer in range(1,L): 
-            W, b = self.params[f'W{layer}'], self.params[f'b{layer}']
-            gamma, beta = self.params[f'gamma{layer}'], self.params[f'beta{layer}']
-            bn_param = self.bn_params[layer-1]        
-            if layer - 1 in max_pools: out, cache_dict[layer] = Conv_BatchNorm_ReLU_Pool.forward(out,W,b,gamma,beta,conv_param,bn_param,pool_param)  
-            else: out, cache_dict[layer] = Conv_BatchNorm_ReLU.forward(out,W,b,gamma,beta,conv_param,bn_param)
-        else:
-          for layer in range(1,L):
-            W, b = self.params[f'W{layer}'], self.params[f'b{layer}']
-            if layer - 1 in max_pools: out, cache_dict[layer] = Conv_ReLU_Pool.forward(out,W,b,conv_param,pool_param)
-            else: out, cache_dict[layer] = Conv_ReLU.forward(out,W,b,conv_param)    
-        out, cache_dict[L] = Linear.forward(out,self.params[f'W{L}'],self.params[f'b{L}'])
-        scores = out
+        for layer in range(1, L):
+            if checkpointing and (layer - 1) % k == 0:
+                checkpoints[layer] = out
+            out, cache = self._macro_forward(layer, out, params, ws=ws)
+            if not checkpointing:
+                cache_dict[layer] = cache
+            del cache
+        fc_out = None
+        if ws is not None:
+            fc_out = ws.get(L, 'out', (X.shape[0], params[f'W{L}'].shape[1]),
+                            dtype, X.device)
+        out, cache_dict[L] = Linear.forward(out,params[f'W{L}'],params[f'b{L}'],
+                                            out=fc_out)
+        # The softmax reductions always run in full precision
+        scores = out.to(self.dtype)
         if y is None:
             return scores
         loss, grads = 0, {}
         loss, dout = softmax_loss(scores, y)
+        if self.compute_dtype is not None:
+            dout = (dout * scale).to(dtype)
         for i in range(1,L+1): loss += self.reg * (self.params[f'W{i}']**2).sum()
         
-        dout, dw, db = Linear.backward(dout,cache_dict[L])
+        fc_out = None
+        if ws is not None:
+            fc_out = (ws.get(L, 'dx', cache_dict[L][0].shape, dtype, X.device),
+                      ws.get(L, 'dw', params[f'W{L}'].shape, dtype, X.device),
+                      ws.get(L, 'db', params[f'b{L}'].shape, dtype, X.device))
+        dout, dw, db = Linear.backward(dout,cache_dict[L],out=fc_out)
+        dw, db = _master_grad(dw, self.dtype, scale), _master_grad(db, self.dtype, scale)
         grads[f'W{L}'], grads[f'b{L}'] = dw + 2 * self.reg * self.params[f'W{L}'], db 
-        if self.batchnorm:
-          for layer in range(1,L)[::-1]:
-            if layer - 1 in max_pools: dout, dw, db, dgamma, dbeta = Conv_BatchNorm_ReLU_Pool.backward(dout,cache_dict[layer])
-            else: dout, dw, db, dgamma, dbeta = Conv_BatchNorm_ReLU.backward(dout,cache_dict[layer])
-            grads[f'W{layer}'], grads[f'b{layer}'] = dw + 2 * self.reg * self.params[f'W{layer}'], db
-            grads[f'gamma{layer}'], grads[f'beta{layer}'] = dgamma, dbeta
-        else:
-          for layer in range(1,L)[::-1]:
-            if layer - 1 in max_pools: dout, dw, db = Conv_ReLU_Pool.backward(dout,cache_dict[layer])
-            else: dout, dw, db = Conv_ReLU.backward(dout,cache_dict[layer])
+        for layer in range(1,L)[::-1]:
+            if layer not in cache_dict:
+                start = (layer - 1) // k * k + 1
+                cache_dict.update(self._recompute_segment(
+                    start, layer, checkpoints.pop(start), params))
+            macro_layer, _ = self._macro_layer(layer)
+            dout, dw, db, *dbn = macro_layer.backward(dout,
+                                                      cache_dict.pop(layer))
+            dw, db = _master_grad(dw, self.dtype, scale), _master_grad(db, self.dtype, scale)
             grads[f'W{layer}'], grads[f'b{layer}'] = dw + 2 * self.reg * self.params[f'W{layer}'], db
+            if self.batchnorm:
+                dgamma, dbeta = dbn
+                grads[f'gamma{layer}'] = _master_grad(dgamma, self.dtype, scale)
+                grads[f'beta{layer}'] = _master_grad(dbeta, self.dtype, scale)
 
         return loss, grads
 
+    def predict(self, X, batch_size=100, k=1):
+        """
+        Predict the k most likely classes for X with a test-time forward pass.
+        Same API as FullyConnectedNet.predict. Batchnorm layers are folded
+        into their convolutions first, so bn_params are left alone, and each
+        ReLU runs in place on the convolution output. The folded copy is kept
+        and reused until the parameters or running statistics change.
+        """
+        model = self._folded_model() if self.batchnorm else self
+        params, dtype = model.params, self.dtype
+        if self.compute_dtype is not None:
+            dtype = self.compute_dtype
+            params = _cast_params(params, dtype)
+        device = params['W1'].device
+        L = self.num_layers
+        scores = torch.empty(batch_size, params[f'W{L}'].shape[1],
+                             dtype=dtype, device=device)
+
+        def forward(x):
+            x = x.to(device=device, dtype=dtype)
+            for layer in range(1, L):
+                w, b = params[f'W{layer}'], params[f'b{layer}']
+                x = torch.nn.functional.conv2d(
+                    x, w, b, padding=(w.shape[2] - 1) // 2).relu_()
+                if layer - 1 in self.max_pools:
+                    x = torch.nn.functional.max_pool2d(x, 2, 2)
+            x = x.flatten(1)
+            return torch.addmm(params[f'b{L}'], x, params[f'W{L}'],
+                               out=scores[:x.shape[0]])
+
+        return _predict(forward, X, batch_size, k, self.dtype, device)
+
 
 def find_overfit_parameters():
     weight_scale = 2e-3   # Experiment with this!
@@ -557,14 +853,12 @@ def kaiming_initializer(Din, Dout, K=None, relu=True, device='cpu',
     gain = 2. if relu else 1.
     weight = None
     if K is None:
-        std = torch.sqrt(gain / torch.tensor(Din))
-        weight = torch.randn(Din,Dout,dtype=dtype,device=device) * std
+        std = math.sqrt(gain / Din)
+        weight = torch.randn(Din,Dout,dtype=dtype,device=device)
     else:
-        ga = gain / torch.tensor(K*K*Din)
-        std = torch.sqrt(ga)
-        
-        weight = torch.randn(Din,Dout,K,K,dtype=dtype,device=device) * std
-    return weight
+        std = math.sqrt(gain / (Din * K * K))
+        weight = torch.randn(Dout,Din,K,K,dtype=dtype,device=device)
+    return weight.mul_(std)
 
 
 class BatchNorm(object):
@@ -615,6 +909,11 @@ class BatchNorm(object):
         eps = bn_param.get('eps', 1e-5)
         momentum = bn_param.get('momentum', 0.9)
 
+        # Low-precision inputs are normalized with full-precision statistics
+        in_dtype = x.dtype
+        if in_dtype in (torch.float16, torch.bfloat16):
+            x = x.float()
+
         N, D = x.shape
         running_mean = bn_param.get('running_mean',
                                     torch.zeros(D,
@@ -671,8 +970,8 @@ class BatchNorm(object):
             # in the out variable.                                         #
             ################################################################
             # Replace "pass" statement with your code
-            a = (x - running_mean) / (running_var + eps)
-            out = gamma * (a.sqrt()) + beta
+            x_hat = (x - running_mean) * (running_var + eps).rsqrt()
+            out = gamma * x_hat + beta
             ################################################################
             #                      END OF YOUR CODE                        #
             ################################################################
@@ -683,7 +982,7 @@ class BatchNorm(object):
         bn_param['running_mean'] = running_mean.detach()
         bn_param['running_var'] = running_var.detach()
 
-        return out, cache
+        return out.to(in_dtype), cache
 
     @staticmethod
     def backward(dout, cache):
@@ -715,6 +1014,8 @@ class BatchNorm(object):
         #####################################################################
         # Replace "pass" statement with your code
         x, x_hat, mean, var, gamma, rsqrt, eps = cache
+        out_dtype = dout.dtype
+        dout = dout.to(x.dtype)
         N, D = x.shape
         dx = torch.zeros_like(x)
         dsigma2 = torch.zeros([D], dtype=dout.dtype, device=dout.device)
@@ -725,6 +1026,7 @@ class BatchNorm(object):
         dsigma2 += 0.5 * ((var + eps) ** (-1.5)) * torch.sum(dx_hat * (mean - x), dim=0)
         dmu += -rsqrt * torch.sum(dx_hat, dim=0) + dsigma2 * (-2/N) * torch.sum(x - mean, dim=0)
         dx += dx_hat * rsqrt + dsigma2 * (2./N) * (x - mean) + 1./N * dmu
+        dx = dx.to(out_dtype)
         #################################################################
         #                      END OF YOUR CODE                         #
         #################################################################
@@ -758,11 +1060,13 @@ class BatchNorm(object):
         ###################################################################
         # Replace "pass" statement with your code
         x, x_hat, mean, var, gamma, rsqrt, eps = cache
+        out_dtype = dout.dtype
+        dout = dout.to(x.dtype)
         N, D = x.shape
         dx_hat = gamma * dout 
         hat = N * dx_hat - dx_hat.sum(dim=0)
         hat2 = (dx_hat * x_hat).sum(dim=0)
-        dx = 1./N * rsqrt * (hat - x_hat * hat2) 
+        dx = (1./N * rsqrt * (hat - x_hat * hat2)).to(out_dtype)
         dgamma, dbeta = (x_hat * dout).sum(dim = 0), dout.sum(dim = 0)
         #################################################################
         #                        END OF YOUR CODE                       #
@@ -774,12 +1078,13 @@ class BatchNorm(object):
 class SpatialBatchNorm(object):
 
     @staticmethod
-    def forward(x, gamma, beta, bn_param):
+    def forward(x, gamma, beta, bn_param, out=None):
         """
         Computes the forward pass for spatial batch normalization.
 
         Inputs:
-        - x: Input data of shape (N, C, H, W)
+        - x: Input data of shape (N, C, H, W), stored either contiguously or
+          in channels-last memory format; the output keeps the same format
         - gamma: Scale parameter, of shape (C,)
         - beta: Shift parameter, of shape (C,)
         - bn_param: Dictionary with the following keys:
@@ -794,66 +1099,85 @@ class SpatialBatchNorm(object):
             features
           - running_var Array of shape (C,) giving running variance
             of features
+        - out: Optional tuple of buffers (x_hat, out) of shape (N, C, H, W)
+          to write the normalized input and the output into. Low-precision
+          inputs are normalized in float32, so the buffers then hold float32.
 
         Returns a tuple of:
         - out: Output data, of shape (N, C, H, W)
         - cache: Values needed for the backward pass
         """
-        out, cache = None, None
+        mode = bn_param['mode']
+        eps = bn_param.get('eps', 1e-5)
+        momentum = bn_param.get('momentum', 0.9)
+
+        # Low-precision inputs are normalized with full-precision statistics
+        in_dtype = x.dtype
+        if in_dtype in (torch.float16, torch.bfloat16):
+            x = x.float()
 
-        ################################################################
-        # TODO: Implement the forward pass for spatial batch           #
-        # normalization.                                               #
-        #                                                              #
-        # HINT: You can implement spatial batch normalization by       #
-        # calling the vanilla version of batch normalization you       #
-        # implemented above. Your implementation should be very short; #
-        # ours is less than five lines.                                #
-        ################################################################
-        # Replace "pass" statement with your code
         N, C, H, W = x.shape
-        a = x.reshape(-1, C)
-        out, cache = BatchNorm.forward(a, gamma, beta, bn_param)  
-        out = out.view(N,C,H,W)
-        ################################################################
-        #                       END OF YOUR CODE                       #
-        ################################################################
+        running_mean = bn_param.get('running_mean',
+                                    torch.zeros(C,
+                                                dtype=x.dtype,
+                                                device=x.device))
+        running_var = bn_param.get('running_var',
+                                   torch.zeros(C,
+                                               dtype=x.dtype,
+                                               device=x.device))
 
-        return out, cache
+        out, cache = None, None
+        if mode == 'train':
+            # One pass over (N, H, W) gives both per-channel statistics, in
+            # whatever memory format x is stored
+            var, mean = torch.var_mean(x, dim=(0, 2, 3), unbiased=False)
+            running_mean = momentum * running_mean + (1 - momentum) * mean
+            running_var = momentum * running_var + (1 - momentum) * var
+        elif mode == 'test':
+            mean, var = running_mean, running_var
+        else:
+            raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+        rsqrt = (var + eps).rsqrt()
+        x_hat, y = out if out is not None else (None, None)
+        x_hat = torch.sub(x, mean.view(1, C, 1, 1), out=x_hat)
+        x_hat.mul_(rsqrt.view(1, C, 1, 1))
+        out = torch.addcmul(beta.to(x.dtype).view(1, C, 1, 1), x_hat,
+                            gamma.to(x.dtype).view(1, C, 1, 1), out=y)
+        if mode == 'train':
+            cache = (x_hat, rsqrt, gamma)
+
+        # Store the updated running means back into bn_param
+        bn_param['running_mean'] = running_mean.detach()
+        bn_param['running_var'] = running_var.detach()
+
+        return out.to(in_dtype), cache
 
     @staticmethod
-    def backward(dout, cache):
+    def backward(dout, cache, out=None):
         """
-        Computes the backward pass for spatial batch normalization.
+        Computes the backward pass for spatial batch normalization, using
+        the simplified formula of BatchNorm.backward_alt per channel.
         Inputs:
         - dout: Upstream derivatives, of shape (N, C, H, W)
         - cache: Values from the forward pass
+        - out: Optional buffer of shape (N, C, H, W) to write dx into, in the
+          dtype of the normalized input (float32 for low-precision inputs)
         Returns a tuple of:
         - dx: Gradient with respect to inputs, of shape (N, C, H, W)
         - dgamma: Gradient with respect to scale parameter, of shape (C,)
         - dbeta: Gradient with respect to shift parameter, of shape (C,)
         """
-        dx, dgamma, dbeta = None, None, None
-
-        #################################################################
-        # TODO: Implement the backward pass for spatial batch           #
-        # normalization.                                                #
-        #                                                               #
-        # HINT: You can implement spatial batch normalization by        #
-        # calling the vanilla version of batch normalization you        #
-        # implemented above. Your implementation should be very short;  #
-        # ours is less than five lines.                                 #
-        #################################################################
-        # Replace "pass" statement with your code
+        x_hat, rsqrt, gamma = cache
+        out_dtype = dout.dtype
+        dout = dout.to(x_hat.dtype)
         N, C, H, W = dout.shape
-        a = dout.view(-1, C)
-        dx, dgamma, dbeta = BatchNorm.backward_alt(a, cache)
-        dx = dx.view(N,C,H,W)
-        ##################################################################
-        #                       END OF YOUR CODE                         #
-        ##################################################################
-
-        return dx, dgamma, dbeta
+        M = N * H * W
+        dbeta = dout.sum(dim=(0, 2, 3))
+        dgamma = (dout * x_hat).sum(dim=(0, 2, 3))
+        dx = torch.mul(x_hat, (-dgamma / M).view(1, C, 1, 1), out=out)
+        dx.add_(dout).sub_((dbeta / M).view(1, C, 1, 1))
+        dx.mul_((gamma * rsqrt).view(1, C, 1, 1))
+        return dx.to(out_dtype), dgamma, dbeta
 
 ##################################################################
 #           Fast Implementations and Sandwich Layers             #
@@ -863,39 +1187,32 @@ class SpatialBatchNorm(object):
 class FastConv(object):
 
     @staticmethod
-    def forward(x, w, b, conv_param):
-        N, C, H, W = x.shape
-        F, _, HH, WW = w.shape
+    def forward(x, w, b, conv_param, out=None):
+        # conv2d has no out= variant, so a buffer passed as out is unused
         stride, pad = conv_param['stride'], conv_param['pad']
-        layer = torch.nn.Conv2d(C, F, (HH, WW), stride=stride, padding=pad)
-        layer.weight = torch.nn.Parameter(w)
-        layer.bias = torch.nn.Parameter(b)
-        tx = x.detach()
-        tx.requires_grad = True
-        out = layer(tx)
-        cache = (x, w, b, conv_param, tx, out, layer)
+        out = torch.nn.functional.conv2d(x, w, b, stride=stride, padding=pad)
+        # Only keep what the backward pass needs; no autograd graph
+        cache = (x, w, conv_param)
         return out, cache
 
     @staticmethod
     def backward(dout, cache):
-        try:
-            x, _, _, _, tx, out, layer = cache
-            out.backward(dout)
-            dx = tx.grad.detach()
-            dw = layer.weight.grad.detach()
-            db = layer.bias.grad.detach()
-            layer.weight.grad = layer.bias.grad = None
-        except RuntimeError:
-            dx, dw, db = torch.zeros_like(tx), \
-                         torch.zeros_like(layer.weight), \
-                         torch.zeros_like(layer.bias)
+        x, w, conv_param = cache
+        stride, pad = conv_param['stride'], conv_param['pad']
+        dx = torch.nn.grad.conv2d_input(x.shape, w, dout,
+                                        stride=stride, padding=pad)
+        dw = torch.nn.grad.conv2d_weight(x, w.shape, dout,
+                                         stride=stride, padding=pad)
+        db = dout.sum(dim=(0, 2, 3))
         return dx, dw, db
 
 
 class FastMaxPool(object):
 
     @staticmethod
-    def forward(x, pool_param):
+    def forward(x, pool_param, out=None):
+        # The autograd pooling layer allocates its own output and gradient,
+        # so buffers passed as out are unused
         N, C, H, W = x.shape
         pool_height, pool_width = \
             pool_param['pool_height'], pool_param['pool_width']
@@ -909,7 +1226,7 @@ class FastMaxPool(object):
         return out, cache
 
     @staticmethod
-    def backward(dout, cache):
+    def backward(dout, cache, out=None):
         try:
             x, _, tx, out, layer = cache
             out.backward(dout)
@@ -919,10 +1236,372 @@ class FastMaxPool(object):
         return dx
 
 
+class Im2ColConv(object):
+
+    @staticmethod
+    def forward(x, w, b, conv_param, out=None):
+        """
+        Forward pass for a convolutional layer, computed as a single matrix
+        multiply between the filters and the receptive fields of x laid out
+        as columns (im2col).
+
+        Inputs / outputs: Same as Conv.forward
+        """
+        N, C, H, W = x.shape
+        F, _, HH, WW = w.shape
+        stride, pad = conv_param['stride'], conv_param['pad']
+        Hout = 1 + (H + 2 * pad - HH) // stride
+        Wout = 1 + (W + 2 * pad - WW) // stride
+        # cols has shape (N, C * HH * WW, Hout * Wout)
+        cols = torch.nn.functional.unfold(x, (HH, WW), padding=pad,
+                                          stride=stride)
+        if out is not None:
+            out = out.view(N, F, Hout * Wout)
+        out = torch.matmul(w.reshape(F, -1), cols, out=out)
+        out += b.view(1, F, 1)
+        out = out.view(N, F, Hout, Wout)
+        cache = (x, w, b, conv_param)
+        return out, cache
+
+    @staticmethod
+    def backward(dout, cache):
+        """
+        Backward pass for a convolutional layer. dw is a single matrix
+        multiply against the im2col columns of x, and dx scatters the column
+        gradients back onto the image with col2im (fold).
+
+        Inputs / outputs: Same as Conv.backward
+        """
+        x, w, b, conv_param = cache
+        N, C, H, W = x.shape
+        F, _, HH, WW = w.shape
+        stride, pad = conv_param['stride'], conv_param['pad']
+        dout = dout.reshape(N, F, -1)
+        cols = torch.nn.functional.unfold(x, (HH, WW), padding=pad,
+                                          stride=stride)
+        db = dout.sum(dim=(0, 2))
+        dw = torch.einsum('nfl,nkl->fk', dout, cols).view_as(w)
+        dcols = torch.matmul(w.reshape(F, -1).t(), dout)
+        dx = torch.nn.functional.fold(dcols, (H, W), (HH, WW), padding=pad,
+                                      stride=stride)
+        return dx, dw, db
+
+
+class WinogradConv(object):
+
+    @staticmethod
+    def supports(w, conv_param):
+        """
+        Whether WinogradConv can run a convolution: 3x3 filters, stride 1
+        and a padding of at most 2.
+        """
+        return tuple(w.shape[2:]) == (3, 3) and conv_param['stride'] == 1 \
+            and 0 <= conv_param['pad'] <= 2
+
+    @staticmethod
+    def forward(x, w, b, conv_param, out=None):
+        """
+        Forward pass for a 3x3, stride 1 convolutional layer using the
+        Winograd F(2x2, 3x3) algorithm, which needs 16 multiplies per 2x2
+        output tile instead of the 36 of a direct convolution.
+
+        Inputs / outputs: Same as Conv.forward
+        """
+        if not WinogradConv.supports(w, conv_param):
+            raise ValueError('WinogradConv needs 3x3 filters, stride 1 and '
+                             'pad <= 2; got filters %s and %s'
+                             % (tuple(w.shape[2:]), conv_param))
+        out = _winograd_conv3x3(x, w, conv_param['pad'], out=out)
+        out += b.view(1, -1, 1, 1)
+        cache = (x, w, conv_param)
+        return out, cache
+
+    @staticmethod
+    def backward(dout, cache):
+        """
+        Backward pass for the Winograd convolutional layer. dx is itself a
+        3x3, stride 1 convolution of dout with the flipped filters, so it
+        also runs through Winograd; dw is computed directly.
+
+        Inputs / outputs: Same as Conv.backward
+        """
+        x, w, conv_param = cache
+        pad = conv_param['pad']
+        dx = _winograd_conv3x3(dout, w.flip(2, 3).transpose(0, 1), 2 - pad)
+        dw = torch.nn.grad.conv2d_weight(x, w.shape, dout, stride=1,
+                                         padding=pad)
+        db = dout.sum(dim=(0, 2, 3))
+        return dx, dw, db
+
+
+def _winograd_conv3x3(x, w, pad, out=None):
+    """
+    Stride 1 cross-correlation of x, of shape (N, C, H, W), with 3x3 filters
+    w, of shape (F, C, 3, 3), using Winograd F(2x2, 3x3). Returns an output
+    of shape (N, F, H + 2 * pad - 2, W + 2 * pad - 2), without bias, written
+    into the buffer out if one is given.
+    """
+    N, C, H, W = x.shape
+    F = w.shape[0]
+    Hout, Wout = H + 2 * pad - 2, W + 2 * pad - 2
+    th, tw = (Hout + 1) // 2, (Wout + 1) // 2
+    BT = torch.tensor([[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0],
+                       [0, 1, 0, -1]], dtype=x.dtype, device=x.device)
+    G = torch.tensor([[1, 0, 0], [.5, .5, .5], [.5, -.5, .5], [0, 0, 1]],
+                     dtype=x.dtype, device=x.device)
+    AT = torch.tensor([[1, 1, 1, 0], [0, 1, -1, -1]],
+                      dtype=x.dtype, device=x.device)
+
+    # Overlapping 4x4 input tiles with stride 2, one per 2x2 output tile;
+    # pad the bottom and right so the tiles cover an odd-sized output
+    x = torch.nn.functional.pad(x, (pad, pad + 2 * tw - Wout,
+                                    pad, pad + 2 * th - Hout))
+    tiles = x.unfold(2, 4, 2).unfold(3, 4, 2)          # (N, C, th, tw, 4, 4)
+    V = BT @ tiles @ BT.t()
+    U = G @ w @ G.t()                                   # (F, C, 4, 4)
+
+    # The elementwise products summed over channels are 16 batched GEMMs
+    V = V.permute(4, 5, 1, 0, 2, 3).reshape(16, C, N * th * tw)
+    U = U.permute(2, 3, 0, 1).reshape(16, F, C)
+    M = torch.bmm(U, V).view(4, 4, F, N, th, tw).permute(3, 2, 4, 5, 0, 1)
+    Y = AT @ M @ AT.t()                                 # (N, F, th, tw, 2, 2)
+    Y = Y.permute(0, 1, 2, 4, 3, 5).reshape(N, F, 2 * th, 2 * tw)
+    if out is None:
+        return Y[:, :, :Hout, :Wout].contiguous()
+    return out.copy_(Y[:, :, :Hout, :Wout])
+
+
+class Autotuner(object):
+    """
+    Registry of interchangeable implementations of each op, which picks the
+    fastest one for every problem it sees.
+
+    Layers use it only when their engine is 'auto'; the models default to
+    the 'fast' engines, so autotuning is opt-in.
+
+    On the first use of an (op, shape, dtype, device) key, every candidate
+    that applies is timed on a forward and backward pass and the winner is
+    recorded. Decisions are persisted to a JSON file, so later processes on
+    the same host reuse them without tuning again.
+    """
+
+    def __init__(self, path=None, num_runs=3):
+        """
+        Inputs:
+        - path: JSON file the decisions are stored in. Defaults to the
+          ROB599_AUTOTUNE_CACHE environment variable, or else
+          ~/.cache/rob599/autotune.json. Use '' to keep them in memory only.
+        - num_runs: Number of timed calls per candidate
+        """
+        if path is None:
+            path = os.environ.get(
+                'ROB599_AUTOTUNE_CACHE',
+                os.path.join(os.path.expanduser('~'), '.cache', 'rob599',
+                             'autotune.json'))
+        self.path = path
+        self.num_runs = num_runs
+        self.candidates = {}
+        self.choices = None
+
+    def register(self, op, name, layer, supports=None):
+        """
+        Add an implementation of an op.
+
+        Inputs:
+        - op: Name of the op, e.g. 'conv' or 'pool'
+        - name: Name of this implementation, as stored in the JSON file
+        - layer: Layer class with the op's forward / backward API
+        - supports: Optional function taking the op's arguments and returning
+          whether this implementation can run them
+        """
+        self.candidates.setdefault(op, {})[name] = (layer, supports)
+
+    def select(self, op, args, step):
+        """
+        Return the fastest registered implementation of op for the given
+        arguments, tuning it first if this problem has not been seen.
+
+        Inputs:
+        - op: Name of the op
+        - args: Tuple of the op's arguments: tensors and parameter dicts
+        - step: Function taking a layer class and running one forward and
+          backward pass of it on args
+
+        Returns:
+        - layer: The selected layer class
+        """
+        key = self._key(op, args)
+        if self.choices is None:
+            self.choices = self._load()
+        candidates = self.candidates[op]
+        name = self.choices.get(key)
+        if name not in candidates:
+            from rob599.benchmark import timeit
+            device = next(a.device for a in args
+                          if isinstance(a, torch.Tensor))
+            times = {}
+            # Time the backward pass even if the caller runs under no_grad,
+            # where some layers skip their real work
+            with torch.enable_grad():
+                for name, (layer, supports) in candidates.items():
+                    if supports is None or supports(*args):
+                        times[name] = timeit(lambda: step(layer),
+                                             num_runs=self.num_runs,
+                                             device=device)
+            if not times:
+                raise ValueError('No registered implementation of %s '
+                                 'supports %s' % (op, key))
+            name = min(times, key=times.get)
+            self.choices[key] = name
+            self._save()
+        return candidates[name][0]
+
+    @staticmethod
+    def _key(op, args):
+        parts = [op]
+        for a in args:
+            if isinstance(a, torch.Tensor):
+                parts.append('%s:%s:%s' % (tuple(a.shape), a.dtype,
+                                           a.device))
+            elif isinstance(a, dict):
+                parts.append(str(sorted((k, v) for k, v in a.items()
+                                        if k != 'engine')))
+        return '|'.join(parts)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            warnings.warn('Ignoring unreadable autotune cache %s' % self.path)
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Merge with decisions written by other processes meanwhile
+            choices = dict(self._load(), **self.choices)
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(choices, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            warnings.warn('Could not save autotune cache %s: %s'
+                          % (self.path, e))
+
+    def conv(self, x, w, conv_param):
+        """
+        Return the fastest convolution layer class for x, w and conv_param.
+        """
+        stride, pad = conv_param['stride'], conv_param['pad']
+        param = {'stride': stride, 'pad': pad}
+        b = torch.zeros(w.shape[0], dtype=w.dtype, device=w.device)
+
+        def step(conv):
+            out, cache = conv.forward(x, w, b, param)
+            conv.backward(torch.ones_like(out), cache)
+
+        return self.select('conv', (x, w, param), step)
+
+    def pool(self, x, pool_param):
+        """
+        Return the fastest max-pooling layer class for x and pool_param.
+        """
+        def step(pool):
+            out, cache = pool.forward(x, pool_param)
+            pool.backward(torch.ones_like(out), cache)
+
+        return self.select('pool', (x, pool_param), step)
+
+
+# The naive Conv is far too slow to be worth timing, so it is not a candidate
+autotuner = Autotuner()
+autotuner.register('conv', 'fast', FastConv)
+autotuner.register('conv', 'im2col', Im2ColConv)
+autotuner.register('conv', 'winograd', WinogradConv,
+                   lambda x, w, conv_param: WinogradConv.supports(w,
+                                                                  conv_param))
+autotuner.register('pool', 'naive', MaxPool)
+autotuner.register('pool', 'fast', FastMaxPool)
+
+_CONV_ENGINES = {
+    'naive': Conv,
+    'fast': FastConv,
+    'im2col': Im2ColConv,
+    'winograd': WinogradConv,
+}
+
+_POOL_ENGINES = {
+    'naive': MaxPool,
+    'fast': FastMaxPool,
+}
+
+
+def _conv_engine(x, w, conv_param):
+    """
+    Return the layer class that runs the convolution described by
+    conv_param['engine']: one of 'naive', 'fast' (the default), 'im2col',
+    'winograd', or 'auto' to let the autotuner pick.
+    """
+    engine = conv_param.get('engine', 'fast')
+    if engine == 'auto':
+        return autotuner.conv(x, w, conv_param)
+    if engine not in _CONV_ENGINES:
+        raise ValueError('Unknown convolution engine "%s"' % engine)
+    return _CONV_ENGINES[engine]
+
+
+def _pool_engine(x, pool_param):
+    """
+    Return the layer class that runs the max pooling described by
+    pool_param['engine']: one of 'naive', 'fast' (the default), or 'auto' to
+    let the autotuner pick.
+    """
+    engine = pool_param.get('engine', 'fast')
+    if engine == 'auto':
+        return autotuner.pool(x, pool_param)
+    if engine not in _POOL_ENGINES:
+        raise ValueError('Unknown pooling engine "%s"' % engine)
+    return _POOL_ENGINES[engine]
+
+
+def _buffer(ws, role, shape, dtype):
+    """
+    Return the workspace buffer for role, or None without a workspace.
+    """
+    return None if ws is None else ws(role, shape, dtype)
+
+
+def _pool_buffers(ws, x, pool_param):
+    """
+    Return the (out, argmax) workspace buffers of max pooling x, or None
+    without a workspace.
+    """
+    if ws is None:
+        return None
+    shape = _pool_output_shape(x, pool_param)
+    return ws('pool', shape, x.dtype), ws('argmax', shape, torch.int64)
+
+
+def _bn_buffers(ws, x):
+    """
+    Return the (x_hat, out) workspace buffers of SpatialBatchNorm on x, or
+    None without a workspace.
+    """
+    if ws is None:
+        return None
+    dtype = _full_precision_dtype(x.dtype)
+    return ws('x_hat', x.shape, dtype), ws('bn', x.shape, dtype)
+
+
 class Conv_ReLU(object):
 
     @staticmethod
-    def forward(x, w, b, conv_param):
+    def forward(x, w, b, conv_param, ws=None):
         """
         A convenience layer that performs a convolution
         followed by a ReLU.
@@ -930,13 +1609,22 @@ class Conv_ReLU(object):
         - x: Input to the convolutional layer
         - w, b, conv_param: Weights and parameters for the
           convolutional layer
+        - ws: Optional function get(role, shape, dtype) returning reusable
+          buffers, e.g. from Workspace.bind; the forward and backward passes
+          then write their activations and gradients into them wherever the
+          layers have an out= variant
         Returns a tuple of:
         - out: Output from the ReLU
         - cache: Object to give to the backward pass
         """
-        a, conv_cache = FastConv.forward(x, w, b, conv_param)
-        out, relu_cache = ReLU.forward(a)
-        cache = (conv_cache, relu_cache)
+        conv = _conv_engine(x, w, conv_param)
+        a, conv_cache = conv.forward(
+            x, w, b, conv_param,
+            out=_buffer(ws, 'conv', _conv_output_shape(x, w, conv_param),
+                        x.dtype))
+        out, relu_cache = ReLU.forward(a, out=_buffer(ws, 'relu', a.shape,
+                                                      a.dtype))
+        cache = (conv, conv_cache, relu_cache, ws)
         return out, cache
 
     @staticmethod
@@ -944,16 +1632,17 @@ class Conv_ReLU(object):
         """
         Backward pass for the conv-relu convenience layer.
         """
-        conv_cache, relu_cache = cache
-        da = ReLU.backward(dout, relu_cache)
-        dx, dw, db = FastConv.backward(da, conv_cache)
+        conv, conv_cache, relu_cache, ws = cache
+        da = ReLU.backward(dout, relu_cache,
+                           out=_buffer(ws, 'da', dout.shape, dout.dtype))
+        dx, dw, db = conv.backward(da, conv_cache)
         return dx, dw, db
 
 
 class Conv_ReLU_Pool(object):
 
     @staticmethod
-    def forward(x, w, b, conv_param, pool_param):
+    def forward(x, w, b, conv_param, pool_param, ws=None):
         """
         A convenience layer that performs a convolution,
         a ReLU, and a pool.
@@ -962,14 +1651,22 @@ class Conv_ReLU_Pool(object):
         - w, b, conv_param: Weights and parameters for
           the convolutional layer
         - pool_param: Parameters for the pooling layer
+        - ws: Optional buffer function; see Conv_ReLU.forward
         Returns a tuple of:
         - out: Output from the pooling layer
         - cache: Object to give to the backward pass
         """
-        a, conv_cache = FastConv.forward(x, w, b, conv_param)
-        s, relu_cache = ReLU.forward(a)
-        out, pool_cache = FastMaxPool.forward(s, pool_param)
-        cache = (conv_cache, relu_cache, pool_cache)
+        conv = _conv_engine(x, w, conv_param)
+        a, conv_cache = conv.forward(
+            x, w, b, conv_param,
+            out=_buffer(ws, 'conv', _conv_output_shape(x, w, conv_param),
+                        x.dtype))
+        s, relu_cache = ReLU.forward(a, out=_buffer(ws, 'relu', a.shape,
+                                                    a.dtype))
+        pool = _pool_engine(s, pool_param)
+        out, pool_cache = pool.forward(s, pool_param,
+                                       out=_pool_buffers(ws, s, pool_param))
+        cache = (conv, conv_cache, relu_cache, pool, pool_cache, ws)
         return out, cache
 
     @staticmethod
@@ -978,10 +1675,13 @@ class Conv_ReLU_Pool(object):
         Backward pass for the conv-relu-pool
         convenience layer
         """
-        conv_cache, relu_cache, pool_cache = cache
-        ds = FastMaxPool.backward(dout, pool_cache)
-        da = ReLU.backward(ds, relu_cache)
-        dx, dw, db = FastConv.backward(da, conv_cache)
+        conv, conv_cache, relu_cache, pool, pool_cache, ws = cache
+        ds = pool.backward(dout, pool_cache,
+                           out=_buffer(ws, 'ds', relu_cache.shape,
+                                       dout.dtype))
+        da = ReLU.backward(ds, relu_cache,
+                           out=_buffer(ws, 'da', ds.shape, ds.dtype))
+        dx, dw, db = conv.backward(da, conv_cache)
         return dx, dw, db
 
 
@@ -1026,39 +1726,207 @@ class Linear_BatchNorm_ReLU(object):
 class Conv_BatchNorm_ReLU(object):
 
     @staticmethod
-    def forward(x, w, b, gamma, beta, conv_param, bn_param):
-        a, conv_cache = FastConv.forward(x, w, b, conv_param)
+    def forward(x, w, b, gamma, beta, conv_param, bn_param, ws=None):
+        conv = _conv_engine(x, w, conv_param)
+        a, conv_cache = conv.forward(
+            x, w, b, conv_param,
+            out=_buffer(ws, 'conv', _conv_output_shape(x, w, conv_param),
+                        x.dtype))
         an, bn_cache = SpatialBatchNorm.forward(a, gamma,
-                                                beta, bn_param)
-        out, relu_cache = ReLU.forward(an)
-        cache = (conv_cache, bn_cache, relu_cache)
+                                                beta, bn_param,
+                                                out=_bn_buffers(ws, a))
+        out, relu_cache = ReLU.forward(an, out=_buffer(ws, 'relu', an.shape,
+                                                       an.dtype))
+        cache = (conv, conv_cache, bn_cache, relu_cache, ws)
         return out, cache
 
     @staticmethod
     def backward(dout, cache):
-        conv_cache, bn_cache, relu_cache = cache
-        dan = ReLU.backward(dout, relu_cache)
-        da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
-        dx, dw, db = FastConv.backward(da, conv_cache)
+        conv, conv_cache, bn_cache, relu_cache, ws = cache
+        dan = ReLU.backward(dout, relu_cache,
+                            out=_buffer(ws, 'dan', dout.shape, dout.dtype))
+        da, dgamma, dbeta = SpatialBatchNorm.backward(
+            dan, bn_cache,
+            out=_buffer(ws, 'da', dan.shape, _full_precision_dtype(dan.dtype)))
+        dx, dw, db = conv.backward(da, conv_cache)
         return dx, dw, db, dgamma, dbeta
 
 
 class Conv_BatchNorm_ReLU_Pool(object):
 
     @staticmethod
-    def forward(x, w, b, gamma, beta, conv_param, bn_param, pool_param):
-        a, conv_cache = FastConv.forward(x, w, b, conv_param)
-        an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param)
-        s, relu_cache = ReLU.forward(an)
-        out, pool_cache = FastMaxPool.forward(s, pool_param)
-        cache = (conv_cache, bn_cache, relu_cache, pool_cache)
+    def forward(x, w, b, gamma, beta, conv_param, bn_param, pool_param,
+                ws=None):
+        conv = _conv_engine(x, w, conv_param)
+        a, conv_cache = conv.forward(
+            x, w, b, conv_param,
+            out=_buffer(ws, 'conv', _conv_output_shape(x, w, conv_param),
+                        x.dtype))
+        an, bn_cache = SpatialBatchNorm.forward(a, gamma, beta, bn_param,
+                                                out=_bn_buffers(ws, a))
+        s, relu_cache = ReLU.forward(an, out=_buffer(ws, 'relu', an.shape,
+                                                     an.dtype))
+        pool = _pool_engine(s, pool_param)
+        out, pool_cache = pool.forward(s, pool_param,
+                                       out=_pool_buffers(ws, s, pool_param))
+        cache = (conv, conv_cache, bn_cache, relu_cache, pool, pool_cache,
+                 ws)
+        return out, cache
+
+    @staticmethod
+    def backward(dout, cache):
+        conv, conv_cache, bn_cache, relu_cache, pool, pool_cache, ws = cache
+        ds = pool.backward(dout, pool_cache,
+                           out=_buffer(ws, 'ds', relu_cache.shape,
+                                       dout.dtype))
+        dan = ReLU.backward(ds, relu_cache,
+                            out=_buffer(ws, 'dan', ds.shape, ds.dtype))
+        da, dgamma, dbeta = SpatialBatchNorm.backward(
+            dan, bn_cache,
+            out=_buffer(ws, 'da', dan.shape, _full_precision_dtype(dan.dtype)))
+        dx, dw, db = conv.backward(da, conv_cache)
+        return dx, dw, db, dgamma, dbeta
+
+
+##################################################################
+#                     Fused Macro Layers                         #
+##################################################################
+
+
+def _full_precision(x):
+    """
+    Upcast fp16 / bf16 tensors to float; other tensors are returned as is.
+    """
+    if x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
+def _full_precision_dtype(dtype):
+    """
+    The dtype _full_precision converts a tensor of dtype to.
+    """
+    if dtype in (torch.float16, torch.bfloat16):
+        return torch.float32
+    return dtype
+
+
+class Fused_Conv_ReLU_Pool(object):
+
+    @staticmethod
+    def forward(x, w, b, conv_param, pool_param=None):
+        """
+        Fused conv - relu - [pool] macro layer. Computes the same function as
+        Conv_ReLU_Pool (or Conv_ReLU when pool_param is None), but saves no
+        activation of its own for the backward pass: the ReLU is applied in
+        place on the conv output, the pool keeps only its argmax, and the
+        ReLU mask is read off the layer output, which the next layer keeps
+        anyway.
+
+        Inputs / outputs: Same as Conv_ReLU_Pool.forward
+        """
+        conv = _conv_engine(x, w, conv_param)
+        a, conv_cache = conv.forward(x, w, b, conv_param)
+        s = a.clamp_(min=0)
+        out, pool_cache = s, None
+        if pool_param is not None:
+            out, pool_cache = MaxPool.forward(s, pool_param)
+        cache = (conv, conv_cache, pool_cache, out)
+        return out, cache
+
+    @staticmethod
+    def backward(dout, cache):
+        """
+        Backward pass for the fused conv-relu-pool macro layer.
+        """
+        conv, conv_cache, pool_cache, out = cache
+        # The max of a window is positive iff the ReLU passed it through
+        ds = dout * (out > 0)
+        if pool_cache is not None:
+            ds = MaxPool.backward(ds, pool_cache)
+        dx, dw, db = conv.backward(ds, conv_cache)
+        return dx, dw, db
+
+
+class Fused_Conv_BatchNorm_ReLU_Pool(object):
+
+    @staticmethod
+    def forward(x, w, b, gamma, beta, conv_param, bn_param, pool_param=None):
+        """
+        Fused conv - spatial batchnorm - relu - [pool] macro layer. Computes
+        the same function as Conv_BatchNorm_ReLU_Pool (or Conv_BatchNorm_ReLU
+        when pool_param is None), with batchnorm statistics taken per channel
+        over the (N, H, W) axes.
+
+        Only the pre-batchnorm conv output, the per-channel statistics and the
+        pool argmax are saved for the backward pass. The normalized
+        activations are recomputed from the conv output, and the ReLU mask is
+        read off the layer output, which the next layer keeps anyway.
+
+        Inputs / outputs: Same as Conv_BatchNorm_ReLU_Pool.forward
+        """
+        conv = _conv_engine(x, w, conv_param)
+        a, conv_cache = conv.forward(x, w, b, conv_param)
+        mode = bn_param['mode']
+        eps = bn_param.get('eps', 1e-5)
+        momentum = bn_param.get('momentum', 0.9)
+
+        # Low-precision inputs are normalized with full-precision statistics
+        af = _full_precision(a)
+        C = a.shape[1]
+        running_mean = bn_param.get('running_mean',
+                                    torch.zeros(C, dtype=af.dtype,
+                                                device=a.device))
+        running_var = bn_param.get('running_var',
+                                   torch.zeros(C, dtype=af.dtype,
+                                               device=a.device))
+        if mode == 'train':
+            var, mean = torch.var_mean(af, dim=(0, 2, 3), unbiased=False)
+            running_mean = momentum * running_mean + (1 - momentum) * mean
+            running_var = momentum * running_var + (1 - momentum) * var
+        elif mode == 'test':
+            mean, var = running_mean, running_var
+        else:
+            raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+        bn_param['running_mean'] = running_mean.detach()
+        bn_param['running_var'] = running_var.detach()
+
+        rstd = (var + eps).rsqrt()
+        scale = gamma.to(af.dtype) * rstd
+        shift = beta.to(af.dtype) - mean * scale
+        s = torch.addcmul(shift.view(1, C, 1, 1), af, scale.view(1, C, 1, 1))
+        s = s.clamp_(min=0).to(a.dtype)
+        out, pool_cache = s, None
+        if pool_param is not None:
+            out, pool_cache = MaxPool.forward(s, pool_param)
+        cache = (conv, conv_cache, a, mean, rstd, gamma, mode, pool_cache,
+                 out)
         return out, cache
 
     @staticmethod
     def backward(dout, cache):
-        conv_cache, bn_cache, relu_cache, pool_cache = cache
-        ds = FastMaxPool.backward(dout, pool_cache)
-        dan = ReLU.backward(ds, relu_cache)
-        da, dgamma, dbeta = SpatialBatchNorm.backward(dan, bn_cache)
-        dx, dw, db = FastConv.backward(da, conv_cache)
+        """
+        Backward pass for the fused conv-batchnorm-relu-pool macro layer.
+        """
+        conv, conv_cache, a, mean, rstd, gamma, mode, pool_cache, out = \
+            cache
+        # The max of a window is positive iff the ReLU passed it through
+        ds = dout * (out > 0)
+        if pool_cache is not None:
+            ds = MaxPool.backward(ds, pool_cache)
+
+        af = _full_precision(a)
+        N, C, H, W = a.shape
+        ds = ds.to(af.dtype)
+        x_hat = (af - mean.view(1, C, 1, 1)) * rstd.view(1, C, 1, 1)
+        dbeta = ds.sum(dim=(0, 2, 3))
+        dgamma = (ds * x_hat).sum(dim=(0, 2, 3))
+        scale = (gamma.to(af.dtype) * rstd).view(1, C, 1, 1)
+        if mode == 'train':
+            M = N * H * W
+            x_hat.mul_((dgamma / M).view(1, C, 1, 1))
+            da = (ds - (dbeta / M).view(1, C, 1, 1) - x_hat) * scale
+        else:
+            da = ds * scale
+        dx, dw, db = conv.backward(da.to(a.dtype), conv_cache)
         return dx, dw, db, dgamma, dbeta
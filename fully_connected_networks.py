@@ -2,8 +2,10 @@
 Implements fully connected networks in PyTorch.
 WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
+import warnings
+
 import torch
-from rob599 import Solver
+from rob599 import ParamStore, Solver, initialize_params, load_checkpoint, save_checkpoint
 
 
 def hello_fully_connected_networks():
@@ -14,10 +16,154 @@ def hello_fully_connected_networks():
     print('Hello from fully_connected_networks.py!')
 
 
+def low_precision_supported(dtype, device='cpu'):
+    """
+    Check whether the matrix multiplies and convolutions used by the layers
+    can run in the given low-precision dtype on the given device.
+    """
+    try:
+        x = torch.ones(1, 1, 3, 3, dtype=dtype, device=device)
+        torch.nn.functional.conv2d(x, x, padding=1)
+        torch.mm(x.view(3, 3), x.view(3, 3))
+    except (RuntimeError, TypeError):
+        return False
+    return True
+
+
+class LossScaler(object):
+    """
+    Dynamic loss scaling for mixed-precision training.
+
+    The upstream gradient of the loss is multiplied by `scale` before the
+    low-precision backward pass so that small gradients do not underflow, and
+    the parameter gradients are divided by it again afterwards. If a step
+    produces inf or nan gradients, the update should be skipped and the scale
+    is reduced; after growth_interval good steps in a row it is increased.
+    """
+
+    def __init__(self, init_scale=2.0 ** 8, growth_factor=2.0,
+                 backoff_factor=0.5, growth_interval=1000):
+        self.scale = init_scale
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.growth_interval = growth_interval
+        self.good_steps = 0
+
+    def update(self, grads):
+        """
+        Update the scale after a step.
+        Inputs:
+        - grads: Dictionary of unscaled gradients produced with the current
+          scale
+        Returns:
+        - found_inf: True if any gradient is not finite, in which case the
+          update should be skipped
+        """
+        finite = [torch.isfinite(g).all() for g in grads.values()]
+        found_inf = not bool(torch.stack(finite).all())
+        if found_inf:
+            self.scale *= self.backoff_factor
+            self.good_steps = 0
+        else:
+            self.good_steps += 1
+            if self.good_steps == self.growth_interval:
+                self.scale *= self.growth_factor
+                self.good_steps = 0
+        return found_inf
+
+
+class Workspace(object):
+    """
+    Arena of reusable buffers for layer outputs and gradients.
+
+    Layers that accept an `out` argument write into a buffer instead of
+    allocating a new tensor; FullyConnectedNet and DeepConvNet take
+    workspace=True to use one. Buffers are keyed by (layer, role, trailing
+    dimensions, dtype, device) and sized for the largest leading (batch)
+    dimension requested so far; a smaller request gets a contiguous slice of
+    the same buffer. Training iterations therefore stop allocating once the
+    largest minibatch has been seen, and a short last batch costs nothing. A
+    buffer handed out for a key stays valid until that key is requested
+    again, typically one iteration later.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+        self.hits = 0
+
+    def get(self, layer, role, shape, dtype, device):
+        """
+        Return a buffer for the given key, allocating it on first use and
+        reallocating it when the leading dimension outgrows it.
+        Inputs:
+        - layer: Identifier of the layer, e.g. its index in the network
+        - role: Name of the buffer within the layer, e.g. 'out' or 'dw'
+        - shape, dtype, device: Shape, datatype and device of the buffer
+        Returns:
+        - buffer: An uninitialized contiguous tensor of the requested shape
+        """
+        shape = tuple(shape)
+        key = (layer, role, shape[1:], dtype, str(device))
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape[0] < shape[0]:
+            buffer = torch.empty(shape, dtype=dtype, device=device)
+            self.buffers[key] = buffer
+            self.allocations += 1
+        else:
+            self.hits += 1
+        return buffer[:shape[0]]
+
+    def bind(self, layer, device):
+        """
+        Return a function get(role, shape, dtype) handing out the buffers of
+        one layer on device, for layers that take several buffers at once.
+        """
+        def get(role, shape, dtype):
+            return self.get(layer, role, shape, dtype, device)
+        return get
+
+    def reset_stats(self):
+        """
+        Reset the allocation and hit counters, keeping the buffers.
+        """
+        self.allocations = 0
+        self.hits = 0
+
+    def nbytes(self):
+        """
+        Total number of bytes held by the buffers.
+        """
+        return sum(b.numel() * b.element_size()
+                   for b in self.buffers.values())
+
+
+def _cast_params(params, dtype):
+    """
+    Return low-precision copies of the master weights in params. params is
+    usually a ParamStore, cast with one copy per buffer, but a plain dict
+    assigned to model.params is accepted as well.
+    """
+    if not isinstance(params, ParamStore):
+        return ParamStore({k: v.to(dtype) for k, v in params.items()})
+    return params.to(dtype=dtype)
+
+
+def _master_grad(grad, dtype, scale):
+    """
+    Convert a gradient computed in low precision with a scaled loss back to
+    the dtype of the master weights.
+    """
+    grad = grad.to(dtype)
+    if scale != 1.0:
+        grad = grad / scale
+    return grad
+
+
 class Linear(object):
 
     @staticmethod
-    def forward(x, w, b):
+    def forward(x, w, b, out=None):
         """
         Computes the forward pass for an linear (fully-connected) layer.
         The input x has shape (N, d_1, ..., d_k) and contains a minibatch of N
@@ -28,6 +174,7 @@ class Linear(object):
         - x: A tensor containing input data, of shape (N, d_1, ..., d_k)
         - w: A tensor of weights, of shape (D, M)
         - b: A tensor of biases, of shape (M,)
+        - out: Optional buffer of shape (N, M) to write the output into
         Returns a tuple of:
         - out: output, of shape (N, M)
         - cache: (x, w, b)
@@ -40,7 +187,10 @@ class Linear(object):
         # Replace "pass" statement with your code
         W = x.shape[0]
         F = x.reshape((W, -1))
-        out = torch.mm(F, w) + b
+        if out is None:
+            out = torch.mm(F, w) + b
+        else:
+            out = torch.addmm(b, F, w, out=out)
         ######################################################################
         #                        END OF YOUR CODE                            #
         ######################################################################
@@ -48,7 +198,7 @@ class Linear(object):
         return out, cache
 
     @staticmethod
-    def backward(dout, cache):
+    def backward(dout, cache, out=None):
         """
         Computes the backward pass for an linear layer.
         Inputs:
@@ -57,6 +207,8 @@ class Linear(object):
           - x: Input data, of shape (N, d_1, ... d_k)
           - w: Weights, of shape (D, M)
           - b: Biases, of shape (M,)
+        - out: Optional tuple of buffers (dx, dw, db) to write the gradients
+          into
         Returns a tuple of:
         - dx: Gradient with respect to x, of shape
           (N, d1, ..., d_k)
@@ -70,6 +222,12 @@ class Linear(object):
         ##################################################
         # Replace "pass" statement with your code
         F = x.reshape(x.shape[0], -1)
+        if out is not None:
+            dx, dw, db = out
+            torch.mm(dout, w.T, out=dx.view(x.shape[0], -1))
+            torch.mm(F.T, dout, out=dw)
+            torch.sum(dout, dim=0, out=db)
+            return dx, dw, db
         x1 = torch.mm(dout, w.T)
         dx = x1.reshape(x.shape[0], *x.shape[1:])
         dw = torch.mm(F.T, dout)
@@ -83,12 +241,13 @@ class Linear(object):
 class ReLU(object):
 
     @staticmethod
-    def forward(x):
+    def forward(x, out=None):
         """
         Computes the forward pass for a layer of rectified
         linear units (ReLUs).
         Input:
         - x: Input; a tensor of any shape
+        - out: Optional buffer of the same shape to write the output into
         Returns a tuple of:
         - out: Output, a tensor of the same shape as x
         - cache: x
@@ -100,7 +259,10 @@ class ReLU(object):
         # in-place operation.                             #
         ###################################################
         # Replace "pass" statement with your code
-        out = torch.max(x, torch.tensor(0.0, dtype=x.dtype, device=x.device))
+        if out is None:
+            out = torch.max(x, torch.tensor(0.0, dtype=x.dtype, device=x.device))
+        else:
+            out = torch.clamp(x, min=0, out=out)
         ###################################################
         #                 END OF YOUR CODE                #
         ###################################################
@@ -108,13 +270,14 @@ class ReLU(object):
         return out, cache
 
     @staticmethod
-    def backward(dout, cache):
+    def backward(dout, cache, out=None):
         """
         Computes the backward pass for a layer of rectified
         linear units (ReLUs).
         Input:
         - dout: Upstream derivatives, of any shape
         - cache: Input x, of same shape as dout
+        - out: Optional buffer of the same shape to write dx into
         Returns:
         - dx: Gradient with respect to x
         """
@@ -125,6 +288,9 @@ class ReLU(object):
         # in-place operation.                               #
         #####################################################
         # Replace "pass" statement with your code
+        if out is not None:
+            # sign(x) clamped at zero is the ReLU mask, without temporaries
+            return torch.sign(x, out=out).clamp_(min=0).mul_(dout)
         out = torch.relu(x)
         out[out > 0 ] = 1
         dx = out * dout
@@ -137,7 +303,7 @@ class ReLU(object):
 class Linear_ReLU(object):
 
     @staticmethod
-    def forward(x, w, b):
+    def forward(x, w, b, out=None):
         """
         Convenience layer that performs an linear transform
         followed by a ReLU.
@@ -145,27 +311,119 @@ class Linear_ReLU(object):
         Inputs:
         - x: Input to the linear layer
         - w, b: Weights for the linear layer
+        - out: Optional buffer to write the output into; the ReLU is then
+          applied in place
         Returns a tuple of:
         - out: Output from the ReLU
         - cache: Object to give to the backward pass
         """
+        if out is not None:
+            a, fc_cache = Linear.forward(x, w, b, out=out)
+            out = a.clamp_(min=0)
+            # The ReLU output is positive exactly where its input is, so it
+            # serves as the ReLU cache
+            return out, (fc_cache, out)
         a, fc_cache = Linear.forward(x, w, b)
         out, relu_cache = ReLU.forward(a)
         cache = (fc_cache, relu_cache)
         return out, cache
 
     @staticmethod
-    def backward(dout, cache):
+    def backward(dout, cache, out=None):
         """
-        Backward pass for the linear-relu convenience layer
+        Backward pass for the linear-relu convenience layer.
+        out is an optional tuple of buffers (da, dx, dw, db) for the gradient
+        of the ReLU input and the gradients of the linear layer.
         """
         fc_cache, relu_cache = cache
+        if out is not None:
+            da = ReLU.backward(dout, relu_cache, out=out[0])
+            return Linear.backward(da, fc_cache, out=out[1:])
         da = ReLU.backward(dout, relu_cache)
         dx, dw, db = Linear.backward(da, fc_cache)
         return dx, dw, db
 
 
-def svm_loss(x, y):
+def _pack_bits(mask):
+    """
+    Pack a bool tensor into a flat uint8 tensor holding 8 elements per byte.
+    Element i goes to bit i % 8 of byte i // 8. The bytes are assembled in
+    place one bit position at a time, so apart from the output the only
+    temporary is one more byte per 8 elements.
+    """
+    flat = mask.reshape(-1)
+    packed = torch.zeros((flat.numel() + 7) // 8, dtype=torch.uint8,
+                         device=mask.device)
+    bits = torch.empty_like(packed)
+    for bit in range(8):
+        column = flat[bit::8]
+        n = column.numel()
+        bits[:n].copy_(column).mul_(1 << bit)
+        packed[:n].bitwise_or_(bits[:n])
+    return packed
+
+
+def _unpack_bits(packed, shape):
+    """
+    Inverse of _pack_bits: unpack a uint8 tensor into a bool tensor of the
+    given shape.
+    """
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = (packed.view(-1, 1) >> shifts) & 1
+    numel = 1
+    for d in shape:
+        numel *= d
+    return bits.view(-1)[:numel].view(shape).bool()
+
+
+class FusedLinear_ReLU(object):
+
+    @staticmethod
+    def forward(x, w, b, out=None):
+        """
+        Fused linear transform and ReLU. Computes the same function as
+        Linear_ReLU, but the bias add is fused into the GEMM, the ReLU is
+        applied in place on its output, and the cache holds the ReLU mask as
+        a bitmask (one bit per output) instead of the pre-activations.
+
+        Inputs:
+        - x: Input to the linear layer, of shape (N, d_1, ..., d_k)
+        - w, b: Weights for the linear layer
+        - out: Optional buffer of shape (N, M) to write the output into
+        Returns a tuple of:
+        - out: Output from the ReLU, of shape (N, M)
+        - cache: Object to give to the backward pass
+        """
+        x2d = x.reshape(x.shape[0], -1)
+        out = torch.addmm(b, x2d, w, out=out)
+        out.clamp_(min=0)
+        cache = (x.shape, x2d, w, _pack_bits(out > 0))
+        return out, cache
+
+    @staticmethod
+    def backward(dout, cache, out=None):
+        """
+        Backward pass for the fused linear-relu layer.
+        out is an optional tuple of buffers (da, dx, dw, db) for the gradient
+        of the ReLU input and the gradients of the linear layer.
+        """
+        x_shape, x2d, w, mask = cache
+        mask = _unpack_bits(mask, dout.shape)
+        if out is None:
+            da = dout * mask
+            dx = torch.mm(da, w.T).view(x_shape)
+            dw = torch.mm(x2d.T, da)
+            db = da.sum(dim=0)
+            return dx, dw, db
+        da, dx, dw, db = out
+        torch.mul(dout, mask, out=da)
+        torch.mm(da, w.T, out=dx.view(x_shape[0], -1))
+        torch.mm(x2d.T, da, out=dw)
+        torch.sum(da, dim=0, out=db)
+        return dx, dw, db
+
+
+def svm_loss(x, y, sparse=False, chunk_size=None):
     """
     Computes the loss and gradient using for multiclass SVM classification.
     Inputs:
@@ -173,64 +431,127 @@ def svm_loss(x, y):
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - sparse: If True, return dx as a sparse COO tensor holding only the
+      active margins and the correct classes, which is much smaller than a
+      dense (N, C) tensor when few margins are active
+    - chunk_size: If not None, process the examples in chunks of this many
+      rows, which bounds the temporary memory for very large N
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    loss = None
-    dx = torch.zeros_like(x)
-    
-    #####################################################
-    # TODO: Implement the SVM loss function.            #
-    #####################################################
-    # Replace "pass" statement with your code
-    N = len(y)                               
-    F = x[range(N), y][:, None]         
-    J = torch.maximum(torch.tensor(0), x - F + torch.tensor(1)) 
-    loss = J.sum() / N - 1
-    dx = (J > 0).float() / N
-    dx[range(N), y] -= dx.sum(axis=1)
-    #####################################################
-    #                  END OF YOUR CODE                 #
-    #####################################################
-    
+    N, C = x.shape
+    if chunk_size is None:
+        chunk_size = N
+    loss = torch.zeros((), dtype=x.dtype, device=x.device)
+    dx = None if sparse else torch.empty_like(x)
+    indices, values = [], []
+    for start in range(0, N, chunk_size):
+        xs, ys = x[start:start + chunk_size], y[start:start + chunk_size]
+        rows = torch.arange(xs.shape[0], device=x.device)
+        # With a dense gradient the margins are computed in the matching rows
+        # of dx, and then turned into the gradient in place
+        if sparse:
+            margins = torch.empty_like(xs)
+        else:
+            margins = dx[start:start + chunk_size]
+        torch.sub(xs, xs[rows, ys].unsqueeze(1), out=margins)
+        margins.add_(1).clamp_(min=0)
+        margins[rows, ys] = 0
+        loss += margins.sum()
+
+        # Each active margin adds 1 / N to its class and -1 / N to the
+        # correct class
+        margins.sign_()
+        counts = margins.sum(dim=1)
+        if sparse:
+            active = margins.nonzero().t()
+            active[0] += start
+            indices += [active, torch.stack([rows + start, ys])]
+            values += [margins.new_full((active.shape[1],), 1.0 / N),
+                       counts.div_(-N)]
+        else:
+            margins[rows, ys] = -counts
+            margins.div_(N)
+    loss /= N
+    if sparse:
+        dx = torch.sparse_coo_tensor(torch.cat(indices, dim=1),
+                                     torch.cat(values), (N, C))
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, chunk_size=None):
     """
     Computes the loss and gradient for softmax classification.
+
+    The loss is computed as log-sum-exp minus the correct-class score, so it
+    never takes the log of an underflowed probability, and the probabilities
+    are turned into the gradient in the same buffer.
     Inputs:
     - x: Input data, of shape (N, C) where x[i, j] is the score for
       the jth class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label
       for x[i] and 0 <= y[i] < C
+    - chunk_size: If not None, process the classes in chunks of this many
+      columns, which keeps the working set in cache for very large C
     Returns a tuple of:
     - loss: Scalar giving the loss
     - dx: Gradient of the loss with respect to x
     """
-    loss = None
-    dx = torch.zeros_like(x)
-    
-    #####################################################
-    # TODO: Implement the softmax loss function.        #
-    #####################################################
-    # Replace "pass" statement with your code
-    N = len(y)
-    max_vals, _ = x.max(axis=1, keepdims=True)
-    F = torch.exp(x - max_vals)
-    F /= F.sum(axis=1, keepdims=True) 
-    loss = -torch.log(F[range(N), y]).sum() / N
-    F[range(N), y] -= 1
-    dx = F / N
-    #####################################################
-    #                  END OF YOUR CODE                 #
-    #####################################################
-    
-    
+    N, C = x.shape
+    if chunk_size is None:
+        chunk_size = C
+    rows = torch.arange(N, device=x.device)
+    max_vals = x.max(dim=1, keepdim=True).values
+
+    # dx first holds exp(x - max), then the probabilities, then the gradient
+    dx = torch.empty_like(x)
+    sums = torch.zeros_like(max_vals)
+    for start in range(0, C, chunk_size):
+        chunk = dx[:, start:start + chunk_size]
+        torch.sub(x[:, start:start + chunk_size], max_vals, out=chunk)
+        sums += chunk.exp_().sum(dim=1, keepdim=True)
+    loss = (sums.log().view(-1) + max_vals.view(-1) - x[rows, y]).sum() / N
+
+    scale = sums.reciprocal_().div_(N)
+    for start in range(0, C, chunk_size):
+        dx[:, start:start + chunk_size].mul_(scale)
+    dx[rows, y] -= 1.0 / N
     return loss, dx
 
 
+def _softmax_topk(scores, k, probs, classes):
+    """
+    Write the k largest softmax probabilities of each row of scores into
+    probs, and their classes into classes. scores is overwritten.
+    """
+    scores.sub_(scores.max(dim=1, keepdim=True).values).exp_()
+    sums = scores.sum(dim=1, keepdim=True)
+    torch.topk(scores, k, dim=1, out=(probs, classes))
+    probs.div_(sums)
+
+
+def _predict(forward, X, batch_size, k, dtype, device):
+    """
+    Run forward on batches of X without autograd and return the top-k
+    classes and probabilities of every example.
+    Inputs:
+    - forward: Function mapping a batch of at most batch_size examples to
+      their class scores
+    - X, batch_size, k: As in FullyConnectedNet.predict
+    - dtype, device: Datatype of the probabilities and device of the outputs
+    """
+    N = X.shape[0]
+    classes = torch.empty(N, k, dtype=torch.int64, device=device)
+    probs = torch.empty(N, k, dtype=dtype, device=device)
+    with torch.no_grad():
+        for start in range(0, N, batch_size):
+            end = min(start + batch_size, N)
+            scores = forward(X[start:end]).to(dtype)
+            _softmax_topk(scores, k, probs[start:end], classes[start:end])
+    return classes, probs
+
+
 class TwoLayerNet(object):
     """
     A two-layer fully-connected neural network with ReLU nonlinearity and
@@ -247,7 +568,7 @@ class TwoLayerNet(object):
 
     def __init__(self, input_dim=3*32*32, hidden_dim=100, num_classes=10,
                  weight_scale=1e-3, reg=0.0,
-                 dtype=torch.float32, device='cpu'):
+                 dtype=torch.float32, device='cpu', init_seed=None):
         """
         Initialize a new network.
         Inputs:
@@ -261,6 +582,8 @@ class TwoLayerNet(object):
           performed using this datatype. float is faster but less accurate,
           so you should use double for numeric gradient checking.
         - device: device to use for computation. 'cpu' or 'cuda'
+        - init_seed: If not None, seed each parameter's initialization
+          separately from it; see rob599.initialize_params.
         """
         self.params = {}
         self.reg = reg
@@ -276,10 +599,12 @@ class TwoLayerNet(object):
         ###################################################################
         # Replace "pass" statement with your code
         self.device= device
-        self.params['W1'] = weight_scale * torch.randn(input_dim, hidden_dim, dtype=dtype, device=device)
-        self.params['W2'] = weight_scale * torch.randn(hidden_dim, num_classes, dtype=dtype, device=device)
-        self.params['b1'] = torch.zeros(hidden_dim, dtype=dtype, device=device)
-        self.params['b2'] = torch.zeros(num_classes, dtype=dtype, device=device)
+        self.params = initialize_params([
+            ('W1', (input_dim, hidden_dim), weight_scale),
+            ('W2', (hidden_dim, num_classes), weight_scale),
+            ('b1', (hidden_dim,), 'zeros'),
+            ('b2', (num_classes,), 'zeros'),
+        ], dtype=dtype, device=device, seed=init_seed)
         # self.params['W1'] = weight_scale * torch.random.randn(input_dim,hidden_dim) #(3072,100)
         # self.params['b1'] = torch.zeros((hidden_dim,)) #100
         # self.params['W2'] = weight_scale * torch.random.randn(hidden_dim,num_classes) #(100,10)
@@ -294,15 +619,13 @@ class TwoLayerNet(object):
           'params': self.params,
         }
 
-        torch.save(checkpoint, path)
+        save_checkpoint(path, checkpoint)
         print("Saved in {}".format(path))
 
     def load(self, path, dtype, device):
-        checkpoint = torch.load(path, map_location='cpu')
+        checkpoint = load_checkpoint(path, dtype=dtype, device=device)
         self.params = checkpoint['params']
         self.reg = checkpoint['reg']
-        for p in self.params:
-            self.params[p] = self.params[p].type(dtype).to(device)
         print("load checkpoint file: {}".format(path))
 
     def loss(self, X, y=None):
@@ -389,7 +712,8 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=0.0, reg=0.0, weight_scale=1e-2, seed=None,
-                 dtype=torch.float, device='cpu'):
+                 dtype=torch.float, device='cpu', compute_dtype=None,
+                 workspace=False, fuse_layers=True, init_seed=None):
         """
         Initialize a new FullyConnectedNet.
 
@@ -411,6 +735,19 @@ class FullyConnectedNet(object):
           performed using this datatype. float is faster but less accurate,
           so you should use double for numeric gradient checking.
         - device: device to use for computation. 'cpu' or 'cuda'
+        - compute_dtype: If not None, a low-precision dtype such as
+          torch.bfloat16 for mixed-precision training. The parameters are
+          kept in dtype as master weights, while the forward and backward
+          passes run in compute_dtype with dynamic loss scaling. The softmax
+          loss is computed in dtype.
+        - workspace: If True, training iterations write layer outputs and
+          gradients into buffers from a Workspace, which are reused from one
+          iteration to the next. The returned gradients are then only valid
+          until the next call to loss.
+        - fuse_layers: If True, the hidden layers use FusedLinear_ReLU, which
+          only keeps a bitmask of the ReLU for the backward pass.
+        - init_seed: If not None, seed each parameter's initialization
+          separately from it; see rob599.initialize_params.
         """
         self.use_dropout = dropout != 0
         self.reg = reg
@@ -418,6 +755,18 @@ class FullyConnectedNet(object):
         self.dtype = dtype
         self.params = {}
 
+        if compute_dtype is not None and \
+                not low_precision_supported(compute_dtype, device):
+            warnings.warn('%s is not supported on %s; training in %s'
+                          % (compute_dtype, device, dtype))
+            compute_dtype = None
+        self.compute_dtype = compute_dtype
+        self.loss_scaler = None
+        if compute_dtype is not None:
+            self.loss_scaler = LossScaler()
+        self.workspace = Workspace() if workspace else None
+        self.fuse_layers = fuse_layers
+
         #######################################################################
         # TODO: Initialize the parameters of the network, storing all         #
         # values in the self.params dictionary. Store weights and biases      #
@@ -428,9 +777,12 @@ class FullyConnectedNet(object):
         #######################################################################
         # Replace "pass" statement with your code
         layer_dim = [input_dim] + hidden_dims + [num_classes]
+        specs = []
         for i in range(1, self.num_layers + 1):
-          self.params[f'W{i}'] = weight_scale * torch.rand(layer_dim[i-1], layer_dim[i], dtype = dtype, device = device)
-          self.params[f'b{i}'] = torch.zeros(layer_dim[i],dtype = dtype,device = device)
+          specs.append((f'W{i}', (layer_dim[i-1], layer_dim[i]), weight_scale))
+          specs.append((f'b{i}', (layer_dim[i],), 'zeros'))
+        self.params = initialize_params(specs, dtype=dtype, device=device,
+                                        seed=init_seed)
         #######################################################################
         #                         END OF YOUR CODE                            #
         #######################################################################
@@ -440,10 +792,36 @@ class FullyConnectedNet(object):
         # probability and the mode (train / test). You can pass the same
         # dropout_param to each dropout layer.
         self.dropout_param = {}
+        self.dropout_generators = []
         if self.use_dropout:
             self.dropout_param = {'mode': 'train', 'p': dropout}
             if seed is not None:
                 self.dropout_param['seed'] = seed
+            self.reset_dropout_generators()
+
+    def reset_dropout_generators(self, seed=None):
+        """
+        Give each dropout layer a fresh private random number generator on
+        the device of the parameters.
+        Inputs:
+        - seed: If not None, the generators are seeded reproducibly from it;
+          otherwise they are seeded from the global random number generator,
+          so torch.manual_seed still reproduces the masks. Either way the
+          masks themselves never draw from the global generator. A 'seed' in
+          dropout_param takes precedence, reseeding layer i with seed + i on
+          every forward pass.
+        """
+        device = self.params['W1'].device
+        base = None
+        if seed is not None:
+            base = torch.Generator().manual_seed(seed)
+        self.dropout_device = device
+        self.dropout_generators = []
+        for _ in range(self.num_layers - 1):
+            generator = torch.Generator(device=device)
+            generator.manual_seed(
+                int(torch.randint(2 ** 62, (), generator=base)))
+            self.dropout_generators.append(generator)
 
     def save(self, path):
         checkpoint = {
@@ -455,11 +833,11 @@ class FullyConnectedNet(object):
           'dropout_param': self.dropout_param,
         }
 
-        torch.save(checkpoint, path)
+        save_checkpoint(path, checkpoint)
         print("Saved in {}".format(path))
 
     def load(self, path, dtype, device):
-        checkpoint = torch.load(path, map_location='cpu')
+        checkpoint = load_checkpoint(path, dtype=dtype, device=device)
         self.params = checkpoint['params']
         self.dtype = dtype
         self.reg = checkpoint['reg']
@@ -467,9 +845,6 @@ class FullyConnectedNet(object):
         self.use_dropout = checkpoint['use_dropout']
         self.dropout_param = checkpoint['dropout_param']
 
-        for p in self.params:
-            self.params[p] = self.params[p].type(dtype).to(device)
-
         print("load checkpoint file: {}".format(path))
 
     def loss(self, X, y=None):
@@ -477,13 +852,27 @@ class FullyConnectedNet(object):
         Compute loss and gradient for the fully-connected net.
         Input / output: Same as TwoLayerNet above.
         """
-        X = X.to(self.dtype)
+        # With mixed precision, run the layers on low-precision copies of the
+        # master weights
+        params, scale, dtype = self.params, 1.0, self.dtype
+        if self.compute_dtype is not None:
+            dtype = self.compute_dtype
+            params = _cast_params(self.params, dtype)
+            scale = self.loss_scaler.scale
+        X = X.to(dtype)
         mode = 'test' if y is None else 'train'
 
         # Set train/test mode for batchnorm params and dropout param
         # since they behave differently during training and testing.
         if self.use_dropout:
             self.dropout_param['mode'] = mode
+            generators = self.dropout_generators
+            # Only rebuild the generators when the parameters moved, so
+            # seeded streams are not restarted on every call
+            if len(generators) != self.num_layers - 1 or \
+                    getattr(self, 'dropout_device', None) != \
+                    self.params['W1'].device:
+                self.reset_dropout_generators()
         scores = None
         ##################################################################
         # TODO: Implement the forward pass for the fully-connected net,  #
@@ -496,20 +885,38 @@ class FullyConnectedNet(object):
         # Replace "pass" statement with your code
         # Replace "pass" statement with your code
         
-        caches = []
+        # Scores are returned to the caller in test mode, so only training
+        # iterations use the workspace
+        ws = self.workspace if mode == 'train' else None
+        caches, input_shapes = [], []
+        hidden_layer = FusedLinear_ReLU if self.fuse_layers else Linear_ReLU
         scores = X
         for i in range(1, self.num_layers):
-          weights = self.params[f'W{i}']
-          bias = self.params[f'b{i}']
-          scores, cache = Linear_ReLU.forward(scores, weights, bias)
+          weights = params[f'W{i}']
+          bias = params[f'b{i}']
+          input_shapes.append(scores.shape)
+          out = None
+          if ws is not None:
+            out = ws.get(i, 'out', (X.shape[0], weights.shape[1]), dtype, X.device)
+          scores, cache = hidden_layer.forward(scores, weights, bias, out=out)
           if self.use_dropout:
-            scores, dropout_cache = Dropout.forward(scores, self.dropout_param)
+            dropout_param = dict(self.dropout_param,
+                                 generator=self.dropout_generators[i - 1])
+            if 'seed' in dropout_param:
+              dropout_param['seed'] += i - 1
+            scores, dropout_cache = Dropout.forward(scores, dropout_param)
             cache += (dropout_cache,)
           caches.append(cache)
-        weights = self.params[f'W{self.num_layers}']
-        bias = self.params[f'b{self.num_layers}']
-        scores, cache = Linear.forward(scores, weights, bias)
+        weights = params[f'W{self.num_layers}']
+        bias = params[f'b{self.num_layers}']
+        input_shapes.append(scores.shape)
+        out = None
+        if ws is not None:
+          out = ws.get(self.num_layers, 'out', (X.shape[0], weights.shape[1]), dtype, X.device)
+        scores, cache = Linear.forward(scores, weights, bias, out=out)
         caches.append(cache)
+        # The softmax reductions always run in full precision
+        scores = scores.to(self.dtype)
 
         #################################################################
         #                      END OF YOUR CODE                         #
@@ -533,27 +940,77 @@ class FullyConnectedNet(object):
         #####################################################################
         # Replace "pass" statement with your code
         loss, dout = softmax_loss(scores, y)
+        if self.compute_dtype is not None:
+            dout = (dout * scale).to(dtype)
         layer_count = self.num_layers
         for i in range(layer_count, 0, -1):
           weights = self.params[f'W{i}']
           loss += 0.5 * self.reg * torch.sum(weights ** 2)
           cache = caches.pop()
+          out = None
+          if ws is not None:
+            w = params[f'W{i}']
+            out = (ws.get(i, 'dx', input_shapes[i - 1], dtype, X.device),
+                   ws.get(i, 'dw', w.shape, dtype, X.device),
+                   ws.get(i, 'db', (w.shape[1],), dtype, X.device))
           if i == layer_count:
-           dout, d_weights, d_bias = Linear.backward(dout, cache)
+           dout, d_weights, d_bias = Linear.backward(dout, cache, out=out)
           else:
             if self.use_dropout:
                 dropout_cache = cache[-1]
                 dout = Dropout.backward(dout, dropout_cache)
                 cache = cache[:-1]
-            dout, d_weights, d_bias = Linear_ReLU.backward(dout, cache)
-          grads[f'W{i}'] = d_weights + self.reg * weights
-          grads[f'b{i}'] = d_bias
+            if out is not None:
+              da = ws.get(i, 'da', (X.shape[0], w.shape[1]), dtype, X.device)
+              out = (da,) + out
+            dout, d_weights, d_bias = hidden_layer.backward(dout, cache, out=out)
+          d_weights = _master_grad(d_weights, self.dtype, scale)
+          # d_weights is never aliased by the caller, so add in place
+          grads[f'W{i}'] = d_weights.add_(weights, alpha=self.reg)
+          grads[f'b{i}'] = _master_grad(d_bias, self.dtype, scale)
         ###########################################################
         #                   END OF YOUR CODE                      #
         ###########################################################
 
         return loss, grads
 
+    def predict(self, X, batch_size=100, k=1):
+        """
+        Predict the k most likely classes for X with a test-time forward pass.
+
+        Unlike loss(X), no layer caches are built, nothing is recorded for
+        autograd and dropout_param is left alone. The activations of every
+        batch are written into the same preallocated buffers.
+        Inputs:
+        - X: Tensor of input data of shape (N, d_1, ..., d_k)
+        - batch_size: Number of examples per forward pass
+        - k: Number of classes to return per example
+        Returns a tuple of:
+        - classes: int64 tensor of shape (N, k), most likely class first
+        - probs: Tensor of shape (N, k) giving the softmax probability of
+          each of these classes
+        """
+        params, dtype = self.params, self.dtype
+        if self.compute_dtype is not None:
+            dtype = self.compute_dtype
+            params = _cast_params(self.params, dtype)
+        device = params['W1'].device
+        L = self.num_layers
+        buffers = [torch.empty(batch_size, params[f'W{i}'].shape[1],
+                               dtype=dtype, device=device)
+                   for i in range(1, L + 1)]
+
+        def forward(x):
+            x = x.to(device=device, dtype=dtype).flatten(1)
+            for i in range(1, L + 1):
+                out = buffers[i - 1][:x.shape[0]]
+                x = torch.addmm(params[f'b{i}'], x, params[f'W{i}'], out=out)
+                if i < L:
+                    x.relu_()
+            return x
+
+        return _predict(forward, X, batch_size, k, self.dtype, device)
+
 
 def create_solver_instance(data_dict, dtype, device, **kwargs):
     model = TwoLayerNet(hidden_dim=200, dtype=dtype, device=device)
@@ -753,11 +1210,15 @@ class Dropout(object):
             makes this
             function deterministic, which is needed for gradient checking
             but not in real networks.
+          - generator: Optional torch.Generator on the device of x to draw
+            the mask from. It is reseeded with seed when one is given.
+            Without either, a generator is seeded with one draw from the
+            global random number generator.
         Outputs:
         - out: Tensor of the same shape as x.
         - cache: tuple (dropout_param, mask). In training mode, mask
-          is the dropout mask that was used to multiply the input; in
-          test mode, mask is None.
+          is the dropout mask that was used to multiply the input, packed
+          into bits; in test mode, mask is None.
         NOTE: Please implement **inverted** dropout, not the vanilla
               version of dropout.
         See http://cs231n.github.io/neural-networks-2/#reg for more details.
@@ -767,8 +1228,6 @@ class Dropout(object):
                 neuron output.
         """
         p, mode = dropout_param['p'], dropout_param['mode']
-        if 'seed' in dropout_param:
-            torch.manual_seed(dropout_param['seed'])
 
         mask = None
         out = None
@@ -780,10 +1239,21 @@ class Dropout(object):
             # Store the dropout mask in the mask variable.               #
             ##############################################################
             # Replace "pass" statement with your code
-            mask = torch.rand(*x.shape) < (1-p)
-            mask = mask.type(x.dtype)
-            mask = mask.to(x.device)
-            out = x * mask
+            generator = dropout_param.get('generator')
+            if generator is None:
+                generator = torch.Generator(device=x.device)
+                if 'seed' not in dropout_param:
+                    generator.manual_seed(int(torch.randint(2 ** 62, ())))
+            if 'seed' in dropout_param:
+                generator.manual_seed(dropout_param['seed'])
+            # The uniform draws become the kept mask times 1 / (1 - p), so
+            # that masking and scaling take a single multiply
+            scale = 1. / (1 - p) if p < 1 else 0.
+            keep = torch.rand(x.shape, generator=generator, dtype=x.dtype,
+                              device=x.device)
+            keep = keep.lt_(1 - p).mul_(scale)
+            out = x * keep
+            mask = _pack_bits(keep != 0)
             ##############################################################
             #                   END OF YOUR CODE                         #
             ##############################################################
@@ -820,7 +1290,9 @@ class Dropout(object):
             # inverted dropout                                        #
             ###########################################################
             # Replace "pass" statement with your code
-            dx = dout * mask
+            p = dropout_param['p']
+            scale = 1. / (1 - p) if p < 1 else 0.
+            dx = torch.mul(dout, _unpack_bits(mask, dout.shape)).mul_(scale)
             ###########################################################
             #                     END OF YOUR CODE                    #
             ###########################################################
@@ -1,4 +1,6 @@
-from . import data, grad, submit
+from . import benchmark, checkpoint, data, grad, submit
+from .checkpoint import load_checkpoint, save_checkpoint
+from .params import ParamStore, initialize_params
 from .solver import Solver
 from .utils import reset_seed, tensor_to_image, visualize_dataset
 from .ProgressObjectsDataset import ProgressObjectsDataset
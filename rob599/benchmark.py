@@ -0,0 +1,937 @@
+import io
+import os
+import tempfile
+import time
+
+import torch
+
+from .checkpoint import load_checkpoint, save_checkpoint
+from .params import ParamStore, initialize_params
+from .solver import Solver
+from .utils import reset_seed
+
+""" Utilities for timing the layers, models and solvers. """
+
+
+def timeit(fn, num_runs=10, warmup=1, device="cpu"):
+    """
+    Time a function call.
+
+    Inputs:
+    - fn: A function that takes no arguments
+    - num_runs: Number of timed calls
+    - warmup: Number of untimed calls made first
+    - device: Device the function runs on; CUDA work is synchronized before
+      reading the clock
+
+    Returns:
+    - seconds: Average wall-clock time of one call, in seconds
+    """
+    cuda = torch.device(device).type == "cuda"
+    for _ in range(warmup):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_runs):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_runs
+
+
+def peak_memory(fn, device="cpu"):
+    """
+    Measure the peak memory allocated by PyTorch while running a function.
+
+    On CUDA devices this uses the caching allocator statistics. On the CPU the
+    allocations and frees recorded by the profiler are replayed in order,
+    which gives a close estimate of the peak.
+
+    Inputs:
+    - fn: A function that takes no arguments
+    - device: Device the function runs on
+
+    Returns:
+    - nbytes: Peak number of bytes in use during the call, relative to the
+      number of bytes in use when it started
+    """
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - start
+
+    from torch.profiler import ProfilerActivity, profile
+    with profile(activities=[ProfilerActivity.CPU],
+                 profile_memory=True) as prof:
+        fn()
+    events = [e for e in prof.events() if e.name == "[memory]"]
+    events.sort(key=lambda e: e.time_range.start)
+    in_use = peak = 0
+    for e in events:
+        in_use += e.cpu_memory_usage
+        peak = max(peak, in_use)
+    return peak
+
+
+def count_allocations(fn, device="cpu"):
+    """
+    Count the tensor allocations PyTorch makes while running a function.
+
+    Inputs:
+    - fn: A function that takes no arguments
+    - device: Device the function runs on
+
+    Returns:
+    - count: Number of allocations made during the call
+    """
+    if torch.device(device).type == "cuda":
+        key = "allocation.all.allocated"
+        torch.cuda.synchronize(device)
+        start = torch.cuda.memory_stats(device).get(key, 0)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.memory_stats(device).get(key, 0) - start
+
+    from torch.profiler import ProfilerActivity, profile
+    with profile(activities=[ProfilerActivity.CPU],
+                 profile_memory=True) as prof:
+        fn()
+    return sum(1 for e in prof.events()
+               if e.name == "[memory]" and e.cpu_memory_usage > 0)
+
+
+def cache_nbytes(*caches):
+    """
+    Count the memory held by the tensors in layer caches.
+
+    Caches may be arbitrarily nested tuples, lists and dicts. Each storage is
+    counted once, even if several tensors (or several caches) view it.
+
+    Returns:
+    - nbytes: Total number of bytes of the distinct storages
+    """
+    seen, nbytes = set(), 0
+    stack = list(caches)
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, torch.Tensor):
+            storage = obj.untyped_storage()
+            if storage.data_ptr() not in seen:
+                seen.add(storage.data_ptr())
+                nbytes += storage.nbytes()
+        elif isinstance(obj, (tuple, list)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+    return nbytes
+
+
+def benchmark_data_parallel(model_fn, data, worker_counts=None,
+                            batch_size=256, num_iterations=20, **kwargs):
+    """
+    Measure how Solver training throughput scales with the number of
+    data-parallel worker processes.
+
+    Inputs:
+    - model_fn: A function that takes no arguments and returns a new model.
+      The model must live on the CPU.
+    - data: Dictionary of training and validation data as accepted by Solver,
+      e.g. from rob599.data.preprocess_progress_objects(cuda=False).
+    - worker_counts: Iterable of worker counts to try. Defaults to 1, 2, 4,
+      ... up to the number of CPU cores.
+    - batch_size: Minibatch size used for every run.
+    - num_iterations: Number of timed training steps per run.
+    - kwargs: Extra keyword arguments passed to the Solver.
+
+    Returns:
+    - results: Dictionary mapping each worker count to the training
+      throughput in images per second.
+    """
+    if worker_counts is None:
+        worker_counts, n = [], 1
+        while n <= (os.cpu_count() or 1):
+            worker_counts.append(n)
+            n *= 2
+
+    results = {}
+    for num_workers in worker_counts:
+        solver = Solver(model_fn(), data, batch_size=batch_size,
+                        num_workers=num_workers, verbose=False,
+                        device="cpu", **kwargs)
+        solver._start_workers()
+        try:
+            seconds = timeit(solver._step, num_runs=num_iterations)
+        finally:
+            solver._stop_workers()
+        results[num_workers] = batch_size / seconds
+        print("%d worker(s): %.1f images / sec (%.2fx)"
+              % (num_workers, results[num_workers],
+                 results[num_workers] / results[worker_counts[0]]))
+    return results
+
+
+def benchmark_grad_accumulation(model_fn, data, batch_size=256,
+                                accumulation_steps=(1, 2, 4, 8),
+                                num_iterations=10, device="cpu", **kwargs):
+    """
+    Report the memory versus throughput tradeoff of gradient accumulation.
+
+    Inputs:
+    - model_fn: A function that takes no arguments and returns a new model
+      on the given device.
+    - data: Dictionary of training and validation data as accepted by Solver.
+    - batch_size: Logical minibatch size used for every run.
+    - accumulation_steps: Iterable of micro-batch counts to try.
+    - num_iterations: Number of timed training steps per run.
+    - device: Device to train on.
+    - kwargs: Extra keyword arguments passed to the Solver.
+
+    Returns:
+    - results: Dictionary mapping each micro-batch count to a tuple of
+      (images per second, peak memory in bytes of one training step).
+    """
+    results = {}
+    for K in accumulation_steps:
+        solver = Solver(model_fn(), data, batch_size=batch_size,
+                        accumulation_steps=K, verbose=False, device=device,
+                        **kwargs)
+        seconds = timeit(solver._step, num_runs=num_iterations, device=device)
+        nbytes = peak_memory(solver._step, device=device)
+        results[K] = (batch_size / seconds, nbytes)
+        print("K = %d: %.1f images / sec, peak memory %.1f MB"
+              % (K, results[K][0], nbytes / 2 ** 20))
+    return results
+
+
+def benchmark_mixed_precision(model_fn, data, compute_dtype=torch.bfloat16,
+                              seed=0, device="cpu", **kwargs):
+    """
+    Train the same model in full precision and in mixed precision, and
+    compare their accuracy and training throughput.
+
+    Inputs:
+    - model_fn: A function that takes a compute_dtype keyword argument and
+      returns a new model on the given device, e.g.
+      lambda compute_dtype: DeepConvNet(compute_dtype=compute_dtype)
+    - data: Dictionary of training and validation data as accepted by Solver.
+    - compute_dtype: Low-precision dtype used for the mixed-precision run.
+    - seed: Random seed used before each run, so that both runs start from
+      the same weights and see the same minibatches.
+    - device: Device to train on.
+    - kwargs: Extra keyword arguments passed to the Solver.
+
+    Returns:
+    - results: Dictionary mapping 'full' and 'mixed' to a tuple of
+      (best validation accuracy, training images per second).
+    """
+    results = {}
+    for name, dtype in [("full", None), ("mixed", compute_dtype)]:
+        reset_seed(seed)
+        model = model_fn(compute_dtype=dtype)
+        solver = Solver(model, data, verbose=False, device=device, **kwargs)
+        solver.train()
+        steps = solver.time_report["step"]
+        throughput = steps["count"] * solver.batch_size / steps["total"]
+        results[name] = (solver.best_val_acc, throughput)
+        print("%s precision: best val acc %.4f, %.1f images / sec"
+              % (name, results[name][0], throughput))
+    print("accuracy difference: %.4f; speedup: %.2fx"
+          % (results["mixed"][0] - results["full"][0],
+             results["mixed"][1] / results["full"][1]))
+    return results
+
+
+def benchmark_conv(conv_layers=None, x_shape=(4, 3, 16, 16), num_filters=8,
+                   filter_size=3, conv_param=None, dtype=torch.float32,
+                   device="cpu", num_runs=3):
+    """
+    Time the forward and backward passes of several convolution layers on
+    the same inputs, and check that they agree.
+
+    Inputs:
+    - conv_layers: Dictionary mapping names to layer classes with the
+      forward(x, w, b, conv_param) / backward(dout, cache) API. Defaults to
+      FastConv, Conv, Im2ColConv and, for 3x3 stride 1 filters,
+      WinogradConv from convolutional_networks.
+    - x_shape: Shape (N, C, H, W) of the input
+    - num_filters, filter_size: Number and size of the filters
+    - conv_param: Dictionary with 'stride' and 'pad'; defaults to stride 1
+      with padding that preserves the spatial size
+    - dtype, device: Datatype and device of the inputs
+    - num_runs: Number of timed calls per layer
+
+    Returns:
+    - results: Dictionary mapping each name to a tuple of (forward seconds,
+      backward seconds, max relative error of out/dx/dw/db against the first
+      layer)
+    """
+    from .grad import rel_error
+    if conv_param is None:
+        conv_param = {"stride": 1, "pad": (filter_size - 1) // 2}
+    if conv_layers is None:
+        from convolutional_networks import (Conv, FastConv, Im2ColConv,
+                                            WinogradConv)
+        conv_layers = {"FastConv": FastConv, "Conv": Conv,
+                       "Im2ColConv": Im2ColConv}
+        if filter_size == 3 and conv_param["stride"] == 1:
+            conv_layers["WinogradConv"] = WinogradConv
+
+    x = torch.randn(*x_shape, dtype=dtype, device=device)
+    w = torch.randn(num_filters, x_shape[1], filter_size, filter_size,
+                    dtype=dtype, device=device)
+    b = torch.randn(num_filters, dtype=dtype, device=device)
+
+    results, reference = {}, None
+    for name, layer in conv_layers.items():
+        out, cache = layer.forward(x, w, b, conv_param)
+        dout = torch.randn_like(out) if reference is None else reference[1]
+        grads = layer.backward(dout, cache)
+        if reference is None:
+            reference = (out, dout, grads)
+        error = max(rel_error(out, reference[0]),
+                    *[rel_error(g, r) for g, r in zip(grads, reference[2])])
+
+        t_forward = timeit(lambda: layer.forward(x, w, b, conv_param),
+                           num_runs=num_runs, device=device)
+        t_backward = timeit(
+            lambda: layer.backward(dout, layer.forward(x, w, b,
+                                                       conv_param)[1]),
+            num_runs=num_runs, device=device) - t_forward
+        results[name] = (t_forward, t_backward, error)
+        print("%s: forward %.6f sec, backward %.6f sec, rel error %e"
+              % (name, t_forward, t_backward, error))
+    return results
+
+
+def benchmark_pool(pool_layers=None, x_shape=(64, 32, 32, 32),
+                   pool_param=None, dtype=torch.float32, device="cpu",
+                   num_runs=10):
+    """
+    Time the forward and backward passes of several max-pooling layers and
+    measure the memory held by their caches.
+
+    Inputs:
+    - pool_layers: Dictionary mapping names to layer classes with the
+      forward(x, pool_param) / backward(dout, cache) API. Defaults to
+      MaxPool and FastMaxPool from convolutional_networks.
+    - x_shape: Shape (N, C, H, W) of the input
+    - pool_param: Pooling parameters; defaults to 2x2 windows with stride 2
+    - dtype, device: Datatype and device of the input
+    - num_runs: Number of timed calls per layer
+
+    Returns:
+    - results: Dictionary mapping each name to a tuple of (forward seconds,
+      backward seconds, cache bytes)
+    """
+    if pool_layers is None:
+        from convolutional_networks import FastMaxPool, MaxPool
+        pool_layers = {"MaxPool": MaxPool, "FastMaxPool": FastMaxPool}
+    if pool_param is None:
+        pool_param = {"pool_height": 2, "pool_width": 2, "stride": 2}
+
+    x = torch.randn(*x_shape, dtype=dtype, device=device)
+    results = {}
+    for name, layer in pool_layers.items():
+        out, cache = layer.forward(x, pool_param)
+        dout = torch.randn_like(out)
+        # The input is alive anyway, so do not count it against the cache
+        nbytes = cache_nbytes(cache, x) - cache_nbytes(x)
+        t_forward = timeit(lambda: layer.forward(x, pool_param),
+                           num_runs=num_runs, device=device)
+        t_backward = timeit(
+            lambda: layer.backward(dout, layer.forward(x, pool_param)[1]),
+            num_runs=num_runs, device=device) - t_forward
+        results[name] = (t_forward, t_backward, nbytes)
+        print("%s: forward %.6f sec, backward %.6f sec, cache %.1f KB"
+              % (name, t_forward, t_backward, nbytes / 2 ** 10))
+    return results
+
+
+def benchmark_fused_layers(input_dims=(3, 32, 32),
+                           num_filters=(32, 32, 64, 64, 128),
+                           max_pools=(1, 3, 4), batch_size=128,
+                           dtype=torch.float32, device="cpu", num_runs=3):
+    """
+    Compare the activation memory and speed of DeepConvNet with and without
+    fused macro layers. The defaults match the network built by
+    create_convolutional_solver_instance.
+
+    Inputs:
+    - input_dims, num_filters, max_pools: Architecture of the DeepConvNet
+    - batch_size: Number of images in the minibatch
+    - dtype, device: Datatype and device of the model and data
+    - num_runs: Number of timed training steps per model
+
+    Returns:
+    - results: Dictionary mapping (batchnorm, fuse_layers) to a tuple of
+      (activation bytes saved by the conv macro layers, seconds per
+      forward and backward pass)
+    """
+    from convolutional_networks import DeepConvNet
+    X = torch.randn(batch_size, *input_dims, dtype=dtype, device=device)
+    y = torch.randint(10, (batch_size,), device=device)
+
+    results = {}
+    for batchnorm in (False, True):
+        for fuse_layers in (False, True):
+            reset_seed(0)
+            model = DeepConvNet(input_dims=input_dims,
+                                num_filters=list(num_filters),
+                                max_pools=list(max_pools),
+                                batchnorm=batchnorm, weight_scale="kaiming",
+                                dtype=dtype, device=device,
+                                fuse_layers=fuse_layers)
+            # Keep the last output too, as the linear layer saves it
+            out, caches = X, []
+            for layer in range(1, model.num_layers):
+                out, cache = model._macro_forward(layer, out, model.params)
+                caches.append(cache)
+            nbytes = cache_nbytes(caches, out, X) - cache_nbytes(X)
+            del caches, cache, out
+            seconds = timeit(lambda: model.loss(X, y), num_runs=num_runs,
+                             device=device)
+            results[(batchnorm, fuse_layers)] = (nbytes, seconds)
+
+        unfused = results[(batchnorm, False)]
+        fused = results[(batchnorm, True)]
+        print("batchnorm=%s: activations %.1f MB -> %.1f MB (%.2fx less), "
+              "step %.4f sec -> %.4f sec"
+              % (batchnorm, unfused[0] / 2 ** 20, fused[0] / 2 ** 20,
+                 unfused[0] / fused[0], unfused[1], fused[1]))
+    return results
+
+
+def benchmark_checkpointing(model_fn, X, y, segments=(None, 1, 2, 4),
+                            num_runs=3, device="cpu"):
+    """
+    Report the peak memory and time of one DeepConvNet forward and backward
+    pass with and without activation checkpointing.
+
+    Inputs:
+    - model_fn: A function that takes checkpoint and checkpoint_segment
+      keyword arguments and returns a new model on the given device, e.g.
+      lambda **kw: DeepConvNet(num_filters=[16] * 9, **kw)
+    - X, y: Minibatch of data and labels
+    - segments: Iterable of segment lengths to try; None runs the model
+      without checkpointing
+    - num_runs: Number of timed calls per configuration
+    - device: Device the model runs on
+
+    Returns:
+    - results: Dictionary mapping each segment length to a tuple of (peak
+      memory in bytes, seconds per forward and backward pass)
+    """
+    results = {}
+    for segment in segments:
+        reset_seed(0)
+        model = model_fn(checkpoint=segment is not None,
+                         checkpoint_segment=segment)
+        nbytes = peak_memory(lambda: model.loss(X, y), device=device)
+        seconds = timeit(lambda: model.loss(X, y), num_runs=num_runs,
+                         device=device)
+        results[segment] = (nbytes, seconds)
+        print("segment %s: peak memory %.1f MB, %.4f sec"
+              % (segment, nbytes / 2 ** 20, seconds))
+    return results
+
+
+def benchmark_batchnorm_folding(model, X, num_runs=10, device="cpu"):
+    """
+    Check that a DeepConvNet with its batchnorm layers folded into the
+    convolutions gives the same test-time scores, and compare their latency.
+
+    Inputs:
+    - model: A trained DeepConvNet with batchnorm
+    - X: Batch of images, e.g. data_dict['X_val'][:128] from
+      rob599.data.preprocess_progress_objects(flatten=False)
+    - num_runs: Number of timed calls per model
+    - device: Device the model runs on
+
+    Returns a tuple of:
+    - error: Relative error between the scores of the two models
+    - seconds: Tuple of (unfolded, folded) seconds per batch
+    """
+    from .grad import rel_error
+    folded = model.fold_batchnorm()
+    with torch.no_grad():
+        error = rel_error(folded.loss(X), model.loss(X))
+        seconds = (timeit(lambda: model.loss(X), num_runs=num_runs,
+                          device=device),
+                   timeit(lambda: folded.loss(X), num_runs=num_runs,
+                          device=device))
+    print("rel error %e; latency %.6f sec -> %.6f sec (%.2fx)"
+          % (error, seconds[0], seconds[1], seconds[0] / seconds[1]))
+    return error, seconds
+
+
+def benchmark_spatial_batchnorm(x_shape=(128, 64, 16, 16),
+                                dtype=torch.float32, device="cpu",
+                                num_runs=10):
+    """
+    Compare SpatialBatchNorm against running BatchNorm on the permuted and
+    flattened input, in both NCHW and channels-last memory formats.
+
+    Inputs:
+    - x_shape: Shape (N, C, H, W) of the input
+    - dtype, device: Datatype and device of the input
+    - num_runs: Number of timed calls per configuration
+
+    Returns:
+    - results: Dictionary mapping (name, memory format) to a tuple of
+      (images per second for a forward and backward pass, cache bytes,
+      max relative error against the BatchNorm path)
+    """
+    from convolutional_networks import BatchNorm, SpatialBatchNorm
+    from .grad import rel_error
+
+    def permuted_forward(x, gamma, beta, bn_param):
+        N, C, H, W = x.shape
+        a = x.permute(0, 2, 3, 1).reshape(-1, C)
+        out, cache = BatchNorm.forward(a, gamma, beta, bn_param)
+        return out.view(N, H, W, C).permute(0, 3, 1, 2), cache
+
+    def permuted_backward(dout, cache):
+        N, C, H, W = dout.shape
+        a = dout.permute(0, 2, 3, 1).reshape(-1, C)
+        dx, dgamma, dbeta = BatchNorm.backward_alt(a, cache)
+        return dx.view(N, H, W, C).permute(0, 3, 1, 2), dgamma, dbeta
+
+    layers = {"BatchNorm": (permuted_forward, permuted_backward),
+              "SpatialBatchNorm": (SpatialBatchNorm.forward,
+                                   SpatialBatchNorm.backward)}
+    C = x_shape[1]
+    gamma = torch.randn(C, dtype=dtype, device=device)
+    beta = torch.randn(C, dtype=dtype, device=device)
+    results = {}
+    for memory_format in (torch.contiguous_format, torch.channels_last):
+        x = torch.randn(*x_shape, dtype=dtype, device=device)
+        x = x.contiguous(memory_format=memory_format)
+        dout = torch.randn_like(x)
+        reference = None
+        for name, (forward, backward) in layers.items():
+            out, cache = forward(x, gamma, beta, {"mode": "train"})
+            grads = backward(dout, cache)
+            if reference is None:
+                reference = (out, grads)
+            error = max(rel_error(out, reference[0]),
+                        *[rel_error(g, r) for g, r in zip(grads,
+                                                           reference[1])])
+            nbytes = cache_nbytes(cache, x) - cache_nbytes(x)
+            seconds = timeit(
+                lambda: backward(dout, forward(x, gamma, beta,
+                                               {"mode": "train"})[1]),
+                num_runs=num_runs, device=device)
+            results[(name, str(memory_format))] = (x_shape[0] / seconds,
+                                                   nbytes, error)
+            print("%s (%s): %.1f images / sec, cache %.1f MB, rel error %e"
+                  % (name, memory_format, x_shape[0] / seconds,
+                     nbytes / 2 ** 20, error))
+    return results
+
+
+def benchmark_workspace(model_fn, X, y, num_runs=10, device="cpu"):
+    """
+    Compare training steps of a model with and without a workspace arena.
+
+    Inputs:
+    - model_fn: A function that takes a workspace keyword argument and
+      returns a new model on the given device, e.g.
+      lambda workspace: FullyConnectedNet([100, 100], workspace=workspace)
+      or, for the convolutional path,
+      lambda workspace: DeepConvNet(batchnorm=True, conv_engines='im2col',
+                                    workspace=workspace)
+    - X, y: Minibatch of data and labels
+    - num_runs: Number of timed steps per model
+    - device: Device the model runs on
+
+    Returns:
+    - results: Dictionary mapping False / True (without / with workspace) to
+      a tuple of (allocations per step, workspace misses per step, seconds
+      per step). The steady-state goal for workspace misses is zero.
+    """
+    results = {}
+    for workspace in (False, True):
+        reset_seed(0)
+        model = model_fn(workspace=workspace)
+        model.loss(X, y)  # warm up, filling the workspace
+        if model.workspace is not None:
+            model.workspace.reset_stats()
+        allocations = count_allocations(lambda: model.loss(X, y),
+                                        device=device)
+        seconds = timeit(lambda: model.loss(X, y), num_runs=num_runs,
+                         device=device)
+        misses = 0.0
+        if model.workspace is not None:
+            misses = model.workspace.allocations / (num_runs + 2)
+        results[workspace] = (allocations, misses, seconds)
+        print("workspace=%s: %d allocations / step, %.1f workspace misses "
+              "/ step, %.6f sec / step"
+              % (workspace, allocations, misses, seconds))
+    print("speedup: %.2fx" % (results[False][2] / results[True][2]))
+    return results
+
+
+def benchmark_fused_linear_relu(hidden_dims=(512,) * 5, batch_size=256,
+                                input_dim=3 * 32 * 32, num_runs=10,
+                                dtype=torch.float32, device="cpu"):
+    """
+    Compare the peak memory and throughput of a FullyConnectedNet training
+    step with and without FusedLinear_ReLU hidden layers.
+
+    Inputs:
+    - hidden_dims: Sizes of the hidden layers
+    - batch_size: Number of examples in the minibatch
+    - input_dim: Size of each input
+    - num_runs: Number of timed steps per model
+    - dtype, device: Datatype and device of the model and data
+
+    Returns:
+    - results: Dictionary mapping False / True (unfused / fused) to a tuple
+      of (peak memory in bytes, examples per second)
+    """
+    from fully_connected_networks import FullyConnectedNet
+    X = torch.randn(batch_size, input_dim, dtype=dtype, device=device)
+    y = torch.randint(10, (batch_size,), device=device)
+    results = {}
+    for fuse_layers in (False, True):
+        reset_seed(0)
+        model = FullyConnectedNet(list(hidden_dims), input_dim=input_dim,
+                                  dtype=dtype, device=device,
+                                  fuse_layers=fuse_layers)
+        nbytes = peak_memory(lambda: model.loss(X, y), device=device)
+        seconds = timeit(lambda: model.loss(X, y), num_runs=num_runs,
+                         device=device)
+        results[fuse_layers] = (nbytes, batch_size / seconds)
+        print("fuse_layers=%s: peak memory %.1f MB, %.1f examples / sec"
+              % (fuse_layers, nbytes / 2 ** 20, batch_size / seconds))
+    return results
+
+
+def _softmax_loss_reference(x, y):
+    """
+    The original softmax_loss, kept as the baseline for
+    benchmark_softmax_loss.
+    """
+    N = len(y)
+    max_vals, _ = x.max(axis=1, keepdims=True)
+    F = torch.exp(x - max_vals)
+    F /= F.sum(axis=1, keepdims=True)
+    loss = -torch.log(F[range(N), y]).sum() / N
+    F[range(N), y] -= 1
+    dx = F / N
+    return loss, dx
+
+
+def benchmark_softmax_loss(batch_sizes=(1000, 10000, 100000),
+                           num_classes=10, chunk_size=None,
+                           dtype=torch.float32, device="cpu", num_runs=10):
+    """
+    Compare the throughput of softmax_loss against the original
+    implementation for large minibatches, and check that they agree.
+
+    Inputs:
+    - batch_sizes: Iterable of minibatch sizes N to try
+    - num_classes: Number of classes C
+    - chunk_size: Class chunk size passed to softmax_loss
+    - dtype, device: Datatype and device of the scores
+    - num_runs: Number of timed calls per configuration
+
+    Returns:
+    - results: Dictionary mapping each N to a tuple of (reference examples
+      per second, new examples per second, max relative error of the loss
+      and gradient)
+    """
+    from fully_connected_networks import softmax_loss
+    from .grad import rel_error
+    results = {}
+    for N in batch_sizes:
+        x = torch.randn(N, num_classes, dtype=dtype, device=device)
+        y = torch.randint(num_classes, (N,), device=device)
+        loss, dx = softmax_loss(x, y, chunk_size=chunk_size)
+        ref_loss, ref_dx = _softmax_loss_reference(x, y)
+        error = max(rel_error(loss, ref_loss), rel_error(dx, ref_dx))
+        t_ref = timeit(lambda: _softmax_loss_reference(x, y),
+                       num_runs=num_runs, device=device)
+        t_new = timeit(lambda: softmax_loss(x, y, chunk_size=chunk_size),
+                       num_runs=num_runs, device=device)
+        results[N] = (N / t_ref, N / t_new, error)
+        print("N = %d: %.3g -> %.3g examples / sec (%.2fx), rel error %e"
+              % (N, N / t_ref, N / t_new, t_ref / t_new, error))
+    return results
+
+
+def _svm_loss_reference(x, y):
+    """
+    The original svm_loss, kept as the baseline for benchmark_svm_loss.
+    """
+    N = len(y)
+    F = x[range(N), y][:, None]
+    J = torch.maximum(torch.tensor(0), x - F + torch.tensor(1))
+    loss = J.sum() / N - 1
+    dx = (J > 0).float() / N
+    dx[range(N), y] -= dx.sum(axis=1)
+    return loss, dx
+
+
+def benchmark_svm_loss(batch_sizes=(1000, 10000, 100000), num_classes=10,
+                       chunk_size=None, dtype=torch.float32, device="cpu",
+                       num_runs=10):
+    """
+    Compare the throughput of svm_loss, with dense and sparse gradients,
+    against the original implementation, and check that they agree.
+
+    Inputs:
+    - batch_sizes: Iterable of minibatch sizes N to try
+    - num_classes: Number of classes C
+    - chunk_size: Row chunk size passed to svm_loss
+    - dtype, device: Datatype and device of the scores
+    - num_runs: Number of timed calls per configuration
+
+    Returns:
+    - results: Dictionary mapping each N to a tuple of (reference, dense and
+      sparse examples per second, max relative error of the loss and
+      gradients)
+    """
+    from fully_connected_networks import svm_loss
+    from .grad import rel_error
+    results = {}
+    for N in batch_sizes:
+        x = torch.randn(N, num_classes, dtype=dtype, device=device)
+        y = torch.randint(num_classes, (N,), device=device)
+        ref_loss, ref_dx = _svm_loss_reference(x, y)
+        loss, dx = svm_loss(x, y, chunk_size=chunk_size)
+        sparse_loss, sparse_dx = svm_loss(x, y, sparse=True,
+                                          chunk_size=chunk_size)
+        error = max(rel_error(loss, ref_loss), rel_error(dx, ref_dx),
+                    rel_error(sparse_loss, ref_loss),
+                    rel_error(sparse_dx.to_dense(), ref_dx))
+        seconds = [timeit(fn, num_runs=num_runs, device=device) for fn in (
+            lambda: _svm_loss_reference(x, y),
+            lambda: svm_loss(x, y, chunk_size=chunk_size),
+            lambda: svm_loss(x, y, sparse=True, chunk_size=chunk_size))]
+        results[N] = tuple(N / t for t in seconds) + (error,)
+        print("N = %d: reference %.3g, dense %.3g, sparse %.3g examples / "
+              "sec, rel error %e" % ((N,) + results[N]))
+    return results
+
+
+def benchmark_param_store(params, to_device=None, num_runs=10):
+    """
+    Time whole-model operations on a ParamStore against the same parameters
+    held in a dict of separate tensors, and check that they agree.
+
+    Inputs:
+    - params: Mapping from parameter names to tensors, such as model.params
+    - to_device: Device used to time .to(); defaults to 'cuda' if it is
+      available and the parameters are on the CPU, otherwise 'cpu'
+    - num_runs: Number of timed calls per operation
+
+    Returns:
+    - results: Dictionary mapping each operation to a tuple of (dict and
+      ParamStore seconds per call)
+    """
+    tensors = {k: v.detach().clone() for k, v in params.items()}
+    store = ParamStore(tensors)
+    device = next(iter(tensors.values())).device
+    if to_device is None:
+        to_device = "cuda" if torch.cuda.is_available() and \
+            device.type == "cpu" else "cpu"
+
+    def dict_copy_():
+        for k, v in tensors.items():
+            buffers[k].copy_(v)
+
+    def dict_norm():
+        return torch.linalg.vector_norm(torch.stack(
+            [torch.linalg.vector_norm(v) for v in tensors.values()]))
+
+    def save(obj):
+        f = io.BytesIO()
+        torch.save(obj, f)
+        return f
+
+    buffers = {k: torch.empty_like(v) for k, v in tensors.items()}
+    store_buffers = store.clone()
+    ops = {
+        "clone": (lambda: {k: v.clone() for k, v in tensors.items()},
+                  store.clone),
+        "copy_": (dict_copy_, lambda: store_buffers.copy_(store)),
+        "zero_": (lambda: [v.zero_() for v in buffers.values()],
+                  store_buffers.zero_),
+        "norm": (dict_norm, store.norm),
+        "save": (lambda: save(tensors), lambda: save(store)),
+        "to": (lambda: {k: v.to(to_device) for k, v in tensors.items()},
+               lambda: store.to(to_device)),
+    }
+    error = abs(dict_norm().item() - store.norm().item())
+    print("norm difference %e, %d bytes in %d buffer(s)"
+          % (error, store.nbytes(), len(store.buffers)))
+    results = {}
+    for name, (dict_fn, store_fn) in ops.items():
+        sync = to_device if name == "to" else device
+        t_dict = timeit(dict_fn, num_runs=num_runs, device=sync)
+        t_store = timeit(store_fn, num_runs=num_runs, device=sync)
+        results[name] = (t_dict, t_store)
+        print("%s: %.3g -> %.3g sec (%.2fx)"
+              % (name, t_dict, t_store, t_dict / t_store))
+    return results
+
+
+def benchmark_checkpoint(model, dtype=None, device="cpu", num_runs=10):
+    """
+    Time saving and loading a model's checkpoint with torch.save / torch.load
+    against save_checkpoint / load_checkpoint, and check that they agree.
+
+    Inputs:
+    - model: A model with params and, optionally, bn_params
+    - dtype: Datatype to load the parameters as; None keeps the saved dtype
+      so that load_checkpoint can map the file without copying
+    - device: Device to load the parameters to
+    - num_runs: Number of timed calls per operation
+
+    Returns:
+    - results: Dictionary mapping 'save' and 'load' to a tuple of (torch and
+      checkpoint seconds per call), and 'nbytes' to a tuple of file sizes
+    """
+    from .grad import rel_error
+    checkpoint = {"params": model.params,
+                  "bn_params": getattr(model, "bn_params", [])}
+    legacy = {"params": dict(model.params),
+              "bn_params": checkpoint["bn_params"]}
+
+    def torch_load(path):
+        loaded = torch.load(path, map_location="cpu")
+        return {k: v.to(device=device, dtype=dtype)
+                for k, v in loaded["params"].items()}
+
+    with tempfile.TemporaryDirectory() as root:
+        torch_path = os.path.join(root, "model.pth")
+        path = os.path.join(root, "model.ckpt")
+        t_save = (timeit(lambda: torch.save(legacy, torch_path),
+                         num_runs=num_runs),
+                  timeit(lambda: save_checkpoint(path, checkpoint),
+                         num_runs=num_runs))
+        t_load = (timeit(lambda: torch_load(torch_path), num_runs=num_runs,
+                         device=device),
+                  timeit(lambda: load_checkpoint(path, dtype, device),
+                         num_runs=num_runs, device=device))
+        nbytes = (os.path.getsize(torch_path), os.path.getsize(path))
+        expected = torch_load(torch_path)
+        params = load_checkpoint(path, dtype, device)["params"]
+        error = max(rel_error(params[k].cpu(), v.cpu())
+                    for k, v in expected.items())
+
+    results = {"save": t_save, "load": t_load, "nbytes": nbytes}
+    for name, (t_torch, t_ckpt) in (("save", t_save), ("load", t_load)):
+        print("%s: %.3g -> %.3g sec (%.2fx)"
+              % (name, t_torch, t_ckpt, t_torch / t_ckpt))
+    print("file size %d -> %d bytes, rel error %e" % (nbytes + (error,)))
+    return results
+
+
+def benchmark_predict(model, X, batch_size=100, k=1, device="cpu",
+                      num_runs=3):
+    """
+    Compare the inference throughput of model.predict against running
+    model.loss(X) batch by batch, as the solver used to, followed by a
+    softmax and top-k. X is typically the test split of
+    rob599.data.progress_objects.
+
+    Inputs:
+    - model: A model with loss and predict methods
+    - X: Input data
+    - batch_size: Number of examples per forward pass
+    - k: Number of classes to predict per example
+    - device: Device the model runs on
+    - num_runs: Number of timed passes over X
+
+    Returns:
+    - results: Tuple of (loss and predict examples per second, fraction of
+      examples whose top-k classes agree)
+    """
+    N = X.shape[0]
+
+    def predict_with_loss():
+        classes = []
+        with torch.no_grad():
+            for start in range(0, N, batch_size):
+                scores = model.loss(X[start:start + batch_size].to(device))
+                classes.append(scores.topk(k, dim=1).indices)
+        return torch.cat(classes)
+
+    reference = predict_with_loss()
+    classes, _ = model.predict(X, batch_size=batch_size, k=k)
+    agreement = (classes.to(reference.device) == reference) \
+        .all(dim=1).to(torch.float).mean().item()
+    t_loss = timeit(predict_with_loss, num_runs=num_runs, device=device)
+    t_predict = timeit(lambda: model.predict(X, batch_size=batch_size, k=k),
+                       num_runs=num_runs, device=device)
+    print("%.3g -> %.3g examples / sec (%.2fx), top-%d agreement %.4f"
+          % (N / t_loss, N / t_predict, t_loss / t_predict, k, agreement))
+    return N / t_loss, N / t_predict, agreement
+
+
+def benchmark_initialization(hidden_dims=(512,) * 8, input_dim=3 * 32 * 32,
+                             num_classes=10, num_models=100,
+                             dtype=torch.float32, device="cpu"):
+    """
+    Compare building the Kaiming-initialized parameters of many
+    fully-connected networks layer by layer, as the models used to, against
+    initialize_params with one generator per parameter (seeded) and with a
+    single draw over all weights (unseeded), and check the scale and seeding
+    of the result.
+
+    Inputs:
+    - hidden_dims: Sizes of the hidden layers of each network
+    - input_dim, num_classes: Sizes of the input and output layers
+    - num_models: Number of networks built per timed call
+    - dtype, device: Datatype and device of the parameters
+
+    Returns:
+    - results: Tuple of (layer-by-layer, seeded and single-draw models built
+      per second, max relative error of the weight standard deviations)
+    """
+    dims = [input_dim] + list(hidden_dims) + [num_classes]
+    specs = []
+    for i in range(1, len(dims)):
+        specs.append(("W%d" % i, (dims[i - 1], dims[i]), "kaiming"))
+        specs.append(("b%d" % i, (dims[i],), "zeros"))
+
+    def per_layer():
+        params = {}
+        for i in range(1, len(dims)):
+            std = torch.sqrt(2 / torch.tensor(dims[i - 1]))
+            params["W%d" % i] = std * torch.randn(
+                dims[i - 1], dims[i], dtype=dtype, device=device)
+            params["b%d" % i] = torch.zeros(dims[i], dtype=dtype,
+                                            device=device)
+        return params
+
+    params = initialize_params(specs, dtype=dtype, device=device)
+    error = max(abs(params["W%d" % i].std().item()
+                    * (dims[i - 1] / 2) ** 0.5 - 1)
+                for i in range(1, len(dims)))
+    a = initialize_params(specs, dtype=dtype, device=device, seed=0)
+    b = initialize_params(specs[:2], dtype=dtype, device=device, seed=0)
+    assert torch.equal(a["W1"], b["W1"]), "per-layer seeding is not stable"
+
+    t_layer = timeit(lambda: [per_layer() for _ in range(num_models)],
+                     num_runs=3, device=device)
+    t_seeded = timeit(lambda: [initialize_params(specs, dtype=dtype,
+                                                 device=device, seed=0)
+                               for _ in range(num_models)],
+                      num_runs=3, device=device)
+    t_flat = timeit(lambda: [initialize_params(specs, dtype=dtype,
+                                               device=device)
+                             for _ in range(num_models)],
+                    num_runs=3, device=device)
+    print("layer by layer %.3g, seeded %.3g, single draw %.3g models / sec "
+          "(%.2fx), std rel error %e"
+          % (num_models / t_layer, num_models / t_seeded,
+             num_models / t_flat, t_layer / t_flat, error))
+    return (num_models / t_layer, num_models / t_seeded, num_models / t_flat,
+            error)
@@ -0,0 +1,216 @@
+import json
+import os
+import struct
+
+import torch
+
+from .params import ParamStore
+
+"""
+Checkpoint format with a JSON header and a single memory-mapped tensor blob.
+
+A checkpoint file holds, in order:
+- the magic bytes MAGIC and the length of the header, as a little-endian
+  unsigned 64-bit integer;
+- the header, a JSON object describing the saved object and every tensor
+  buffer in it;
+- zero padding up to a multiple of ALIGNMENT bytes, followed by the blob of
+  buffers, each starting on an ALIGNMENT-byte boundary.
+
+Every ParamStore in the saved object is written as its own flat buffers,
+and all other tensors are gathered into one more store. On load the blob is
+memory-mapped copy-on-write, so tensors whose dtype and device already
+match are views into the mapping and nothing is read until it is used;
+otherwise each buffer is converted with a single copy.
+"""
+
+MAGIC = b"ROB599CK"
+ALIGNMENT = 64  # bytes
+VERSION = 1
+
+_PREAMBLE = struct.Struct("<8sQ")
+
+
+def _dtype_name(dtype):
+    return str(dtype).replace("torch.", "")
+
+
+def _dtype(name):
+    dtype = getattr(torch, name, None)
+    if not isinstance(dtype, torch.dtype):
+        raise ValueError('Invalid dtype "%s" in checkpoint' % name)
+    return dtype
+
+
+def _data_start(header_length):
+    start = _PREAMBLE.size + header_length
+    return start + -start % ALIGNMENT
+
+
+def _encode(obj, stores, loose):
+    # Replace tensors and dtypes by JSON placeholders, collecting the tensors
+    if isinstance(obj, ParamStore):
+        stores.append(obj)
+        return {"__store__": len(stores) - 1}
+    if torch.is_tensor(obj):
+        name = str(len(loose))
+        loose[name] = obj.detach()
+        return {"__tensor__": name}
+    if isinstance(obj, torch.dtype):
+        return {"__dtype__": _dtype_name(obj)}
+    if isinstance(obj, dict):
+        for k in obj:
+            if not isinstance(k, str):
+                raise TypeError("Checkpoint dictionary keys must be strings, "
+                                "got %r" % (k,))
+        return {k: _encode(v, stores, loose) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(v, stores, loose) for v in obj]
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    raise TypeError("Cannot save object of type %s in a checkpoint"
+                    % type(obj).__name__)
+
+
+def _decode(obj, stores, loose):
+    if isinstance(obj, dict):
+        if "__store__" in obj:
+            return stores[obj["__store__"]]
+        if "__tensor__" in obj:
+            return loose[obj["__tensor__"]]
+        if "__dtype__" in obj:
+            return _dtype(obj["__dtype__"])
+        return {k: _decode(v, stores, loose) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_decode(v, stores, loose) for v in obj]
+    return obj
+
+
+def save_checkpoint(path, obj):
+    """
+    Save an object in the checkpoint format of this module.
+
+    The file is written to a temporary path next to path and then renamed,
+    so an interrupted save never leaves a truncated checkpoint behind.
+
+    Inputs:
+    - path: Destination file
+    - obj: Object to save, built from dicts with string keys, lists, tuples,
+      None, bools, numbers, strings, torch dtypes, tensors and ParamStores.
+      Tuples are loaded back as lists.
+    """
+    stores, loose = [], {}
+    encoded = _encode(obj, stores, loose)
+    stores.append(ParamStore(loose))
+
+    buffers, layouts = [], []
+    for store in stores:
+        index = {}
+        for key, buf in store.buffers.items():
+            index[key] = len(buffers)
+            buffers.append(buf)
+        layouts.append({k: [index[key], offset, list(shape)]
+                        for k, (key, offset, shape) in store.layout.items()})
+
+    entries, nbytes = [], 0
+    for buf in buffers:
+        entries.append({"dtype": _dtype_name(buf.dtype), "offset": nbytes,
+                        "numel": buf.numel()})
+        nbytes += buf.numel() * buf.element_size()
+        nbytes += -nbytes % ALIGNMENT
+    header = json.dumps({"version": VERSION, "object": encoded,
+                         "stores": layouts, "buffers": entries}).encode()
+    start = _data_start(len(header))
+    total = start + nbytes
+
+    path = os.fspath(path)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, len(header)))
+        f.write(header)
+        f.truncate(total)
+    if buffers:
+        blob = torch.from_file(tmp, shared=True, size=total,
+                               dtype=torch.uint8)
+        for buf, entry in zip(buffers, entries):
+            offset = start + entry["offset"]
+            end = offset + buf.numel() * buf.element_size()
+            blob[offset:end].view(buf.dtype).copy_(buf)
+        del blob
+    os.replace(tmp, path)
+
+
+def _load_legacy(path, dtype, device):
+    # Checkpoints written with torch.save: convert every tensor, and turn the
+    # models' top-level params dict into a ParamStore.
+    def convert(obj):
+        if isinstance(obj, dict):
+            return {k: convert(v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [convert(v) for v in obj]
+        if torch.is_tensor(obj):
+            return obj.to(device=device, dtype=dtype)
+        return obj
+
+    checkpoint = torch.load(path, map_location="cpu")
+    params = None
+    if isinstance(checkpoint, dict) and isinstance(
+            checkpoint.get("params"), dict):
+        params = checkpoint.pop("params")
+    checkpoint = convert(checkpoint)
+    if params is not None:
+        checkpoint["params"] = ParamStore(params).to(device=device,
+                                                     dtype=dtype)
+    return checkpoint
+
+
+def load_checkpoint(path, dtype=None, device=None):
+    """
+    Load an object saved with save_checkpoint. Files written by torch.save
+    are also accepted, and are converted tensor by tensor.
+
+    Inputs:
+    - path: Checkpoint file
+    - dtype: If not None, every tensor is cast to this dtype
+    - device: If not None, every tensor is moved to this device
+
+    Returns:
+    - obj: The saved object. When dtype and device are None or match the
+      saved tensors, its tensors share memory with a copy-on-write mapping
+      of the file; writing to them copies the touched pages, never the file.
+    """
+    path = os.fspath(path)
+    with open(path, "rb") as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size or \
+                _PREAMBLE.unpack(preamble)[0] != MAGIC:
+            return _load_legacy(path, dtype, device)
+        length = _PREAMBLE.unpack(preamble)[1]
+        header = json.loads(f.read(length).decode())
+    if header["version"] != VERSION:
+        raise ValueError("Unsupported checkpoint version %s"
+                         % header["version"])
+
+    start = _data_start(length)
+    buffers = []
+    if header["buffers"]:
+        blob = torch.from_file(path, shared=False,
+                               size=os.path.getsize(path), dtype=torch.uint8)
+        for entry in header["buffers"]:
+            buf_dtype = _dtype(entry["dtype"])
+            offset = start + entry["offset"]
+            itemsize = torch.empty(0, dtype=buf_dtype).element_size()
+            size = entry["numel"] * itemsize
+            buffers.append(blob[offset:offset + size].view(buf_dtype))
+
+    stores = []
+    for layout in header["stores"]:
+        keys = {i: (buffers[i].dtype, buffers[i].device)
+                for i, _, _ in layout.values()}
+        store = ParamStore.from_buffers(
+            {keys[i]: buffers[i] for i in keys},
+            {k: (keys[i], offset, tuple(shape))
+             for k, (i, offset, shape) in layout.items()})
+        stores.append(store.to(device=device, dtype=dtype))
+    loose = stores.pop()
+    return _decode(header["object"], stores, loose)
@@ -1,21 +1,78 @@
-import random
+import collections
+import copy
+import multiprocessing
+import os
+import pickle
+import warnings
 
 import torch
 
-import rob599
-
 """ Utilities for computing and checking gradients. """
 
 
-def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-7):
+GradCheckReport = collections.namedtuple(
+    'GradCheckReport',
+    ['indices', 'numerical', 'analytic', 'rel_errors', 'max_rel_error'])
+GradCheckReport.__doc__ = """
+Result of sparse_grad_check: the sampled indices of x, the numeric and
+analytic derivatives and their relative errors at each index, and the
+maximum relative error.
+"""
+
+
+def _centered_difference(f, x, ix, h):
+    oldval = x[ix].item()
+    x[ix] = oldval + h  # increment by h
+    fxph = f(x).item()  # evaluate f(x + h)
+    x[ix] = oldval - h  # increment by h
+    fxmh = f(x).item()  # evaluate f(x - h)
+    x[ix] = oldval  # reset
+    return (fxph - fxmh) / (2 * h)
+
+
+# (f, x, h) of a sparse_grad_check worker process, set by its initializer
+_worker_state = None
+
+
+def _init_sparse_check_worker(f, x, h):
+    global _worker_state
+    torch.set_num_threads(1)
+    # The arguments arrive backed by the parent's shared memory, so perturb
+    # a private copy. Copying f and x together keeps x the same tensor as
+    # any reference to it inside f.
+    f, x = copy.deepcopy((f, x))
+    _worker_state = (f, x, h)
+
+
+def _sparse_check_worker(ix):
+    f, x, h = _worker_state
+    return _centered_difference(f, x, ix, h)
+
+
+def _picklable(f):
+    try:
+        pickle.dumps(f)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def sparse_grad_check(f, x, analytic_grad, num_checks=10, h=1e-7, seed=0,
+                      num_workers=None):
     """
-    Utility function to perform numeric gradient checking. We use the centered
-    difference formula to compute a numeric derivative:
+    Numeric gradient check along a few sampled dimensions of x, using the
+    centered difference formula
 
     f'(x) =~ (f(x + h) - f(x - h)) / (2h)
 
-    Rather than computing a full numeric gradient, we sparsely sample a few
-    dimensions along which to compute numeric derivatives.
+    The dimensions are sampled from a private generator, so the same seed
+    always checks the same indices and the global random state is left
+    alone. With several workers the derivatives are evaluated concurrently
+    by a pool of single-threaded worker processes started with forkserver
+    (or spawn where it is unavailable), each perturbing a private copy of
+    f and x. This needs a picklable f, e.g. a module-level function or a
+    functools.partial of one; closures and lambdas, and CUDA tensors, are
+    evaluated serially in this process. x is unchanged on return.
 
     Inputs:
     - f: A function that inputs a torch tensor and returns a torch scalar
@@ -23,27 +80,115 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-7):
     - analytic_grad: A torch tensor giving the analytic gradient of f at x
     - num_checks: The number of dimensions along which to check
     - h: Step size for computing numeric derivatives
+    - seed: Seed of the generator the indices are sampled from
+    - num_workers: Number of worker processes. None uses one per CPU core
+      when f can be pickled and evaluates serially otherwise; a number
+      greater than 1 warns before falling back to serial evaluation.
+
+    Returns:
+    - report: A GradCheckReport
+    """
+    generator = torch.Generator().manual_seed(seed)
+    flat = torch.randint(x.numel(), (num_checks,), generator=generator)
+    indices = []
+    for i in flat.tolist():
+        ix = []
+        for m in reversed(x.shape):
+            i, r = divmod(i, m)
+            ix.append(r)
+        indices.append(tuple(reversed(ix)))
+
+    if num_workers is None:
+        num_workers, explicit = os.cpu_count() or 1, False
+    else:
+        explicit = True
+    num_workers = min(num_workers, num_checks)
+    parallel = num_workers > 1 and x.device.type == 'cpu'
+    if parallel and not _picklable(f):
+        if explicit:
+            warnings.warn('f cannot be pickled, so sparse_grad_check runs '
+                          'serially; pass a module-level function or a '
+                          'functools.partial to use worker processes')
+        parallel = False
+    if parallel:
+        # Forking after torch has started its thread pools can deadlock
+        methods = multiprocessing.get_all_start_methods()
+        method = 'forkserver' if 'forkserver' in methods else 'spawn'
+        context = multiprocessing.get_context(method)
+        with context.Pool(num_workers, initializer=_init_sparse_check_worker,
+                          initargs=(f, x, h)) as pool:
+            numerical = pool.map(_sparse_check_worker, indices)
+    else:
+        numerical = [_centered_difference(f, x, ix, h) for ix in indices]
+
+    analytic = [analytic_grad[ix].item() for ix in indices]
+    rel_errors = [abs(n - a) / (abs(n) + abs(a) + 1e-12)
+                  for n, a in zip(numerical, analytic)]
+    return GradCheckReport(indices, numerical, analytic, rel_errors,
+                           max(rel_errors, default=0.0))
+
+
+def check_parallel_sparse_grad(f, x, analytic_grad, num_checks=10, h=1e-7,
+                               seed=0, num_workers=2):
+    """
+    Check that sparse_grad_check returns the same report with worker
+    processes as it does serially. The serial pass runs single-threaded,
+    like the workers, so the two must agree exactly; any difference means
+    that the workers see each other's perturbations of x.
+
+    Inputs:
+    - f: A picklable function that inputs a torch tensor and returns a torch
+      scalar
+    - x, analytic_grad, num_checks, h, seed: As for sparse_grad_check
+    - num_workers: Number of worker processes of the parallel pass
+
+    Returns:
+    - report: The GradCheckReport of the serial pass
+    """
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        serial = sparse_grad_check(f, x, analytic_grad, num_checks=num_checks,
+                                   h=h, seed=seed, num_workers=1)
+    finally:
+        torch.set_num_threads(num_threads)
+    parallel = sparse_grad_check(f, x, analytic_grad, num_checks=num_checks,
+                                 h=h, seed=seed, num_workers=num_workers)
+    assert parallel == serial, \
+        'parallel sparse_grad_check differs from the serial one: %s != %s' \
+        % (parallel.numerical, serial.numerical)
+    return serial
+
+
+def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-7,
+                      num_workers=None):
     """
-    # fix random seed to 0
-    rob599.reset_seed(0)
-    for i in range(num_checks):
+    Utility function to perform numeric gradient checking. We use the centered
+    difference formula to compute a numeric derivative:
 
-        ix = tuple([random.randrange(m) for m in x.shape])
+    f'(x) =~ (f(x + h) - f(x - h)) / (2h)
 
-        oldval = x[ix].item()
-        x[ix] = oldval + h  # increment by h
-        fxph = f(x).item()  # evaluate f(x + h)
-        x[ix] = oldval - h  # increment by h
-        fxmh = f(x).item()  # evaluate f(x - h)
-        x[ix] = oldval  # reset
+    Rather than computing a full numeric gradient, we sparsely sample a few
+    dimensions along which to compute numeric derivatives. The dimensions are
+    always the same for a given shape of x, and the global random state is
+    not touched; see sparse_grad_check.
 
-        grad_numerical = (fxph - fxmh) / (2 * h)
-        grad_analytic = analytic_grad[ix]
-        rel_error_top = abs(grad_numerical - grad_analytic)
-        rel_error_bot = abs(grad_numerical) + abs(grad_analytic) + 1e-12
-        rel_error = rel_error_top / rel_error_bot
+    Inputs:
+    - f: A function that inputs a torch tensor and returns a torch scalar
+    - x: A torch tensor of the point at which to evaluate the numeric gradient
+    - analytic_grad: A torch tensor giving the analytic gradient of f at x
+    - num_checks: The number of dimensions along which to check
+    - h: Step size for computing numeric derivatives
+    - num_workers: Number of worker processes; see sparse_grad_check
+    Returns:
+    - report: A GradCheckReport
+    """
+    report = sparse_grad_check(f, x, analytic_grad, num_checks=num_checks,
+                               h=h, num_workers=num_workers)
+    for n, a, e in zip(report.numerical, report.analytic, report.rel_errors):
         msg = "numerical: %f analytic: %f, relative error: %e"
-        print(msg % (grad_numerical, grad_analytic, rel_error))
+        print(msg % (n, a, e))
+    return report
 
 
 def compute_numeric_gradient(f, x, dLdf=None, h=1e-7):
@@ -100,6 +245,169 @@ def compute_numeric_gradient(f, x, dLdf=None, h=1e-7):
     return grad
 
 
+def compute_numeric_gradient_batched(f, x, dLdf=None, h=1e-7,
+                                     batch_size=256):
+    """
+    Compute the same centered-difference gradient as compute_numeric_gradient,
+    but evaluate many perturbations per call: the perturbed copies of x are
+    stacked along a new leading batch dimension, and f is called once per
+    batch of 2 * batch_size copies.
+
+    Inputs:
+    - f: A batched function; it inputs a torch tensor of shape
+      (B, *x.shape) and returns the B outputs stacked along dimension 0.
+      A function of a single x without side effects can be batched with
+      torch.func.vmap(f).
+    - x: A torch tensor giving the point at which to compute the gradient
+    - dLdf: optional upstream gradient for intermediate layers
+    - h: epsilon used in the finite difference calculation
+    - batch_size: Number of elements of x perturbed per call to f
+    Returns:
+    - grad: A tensor of the same shape as x giving the gradient of f at x
+    """
+    if dLdf is None:
+        dLdf = torch.ones_like(f(x.unsqueeze(0))[0])
+    dLdf = dLdf.flatten()
+    D = x.numel()
+    grad = torch.zeros(D, dtype=x.dtype, device=x.device)
+    for start in range(0, D, batch_size):
+        idx = torch.arange(start, min(start + batch_size, D), device=x.device)
+        B = idx.shape[0]
+        # Rows [0, B) hold x + h and rows [B, 2B) hold x - h at idx
+        xs = x.reshape(1, D).repeat(2 * B, 1)
+        rows = torch.arange(B, device=x.device)
+        xs[rows, idx] += h
+        xs[rows + B, idx] -= h
+        out = f(xs.view(2 * B, *x.shape)).reshape(2 * B, -1)
+        dfdx = (out[:B] - out[B:]) / (2 * h)
+        grad[idx] = dfdx @ dLdf.to(dfdx.dtype)
+    return grad.view_as(x)
+
+
+def directional_grad_check(f, x, analytic_grad, dLdf=None, num_directions=5,
+                           h=1e-6, seed=0, verbose=True):
+    """
+    Check a whole analytic gradient at once with directional derivatives.
+    For a random unit direction v, the centered difference
+
+    (f(x + h v) - f(x - h v)) / (2h)
+
+    must match the dot product of the analytic gradient with v, so each
+    direction costs two evaluations of f regardless of the size of x.
+
+    x is perturbed in place, as with compute_numeric_gradient, so f may
+    either use its argument or read x through a closure; x is restored
+    before returning.
+
+    Inputs:
+    - f: A function that inputs a torch tensor and returns a torch tensor
+    - x: A torch tensor of the point at which to check the gradient
+    - analytic_grad: A torch tensor giving the analytic gradient of f at x
+    - dLdf: optional upstream gradient for non-scalar outputs of f
+    - num_directions: Number of random directions to check
+    - h: Step size for computing numeric derivatives
+    - seed: Seed of the private generator the directions are drawn from;
+      the global random number generator is not touched
+    - verbose: If True, print one line per direction
+    Returns:
+    - max_error: Maximum relative error over the directions
+    """
+    generator = torch.Generator(device=x.device).manual_seed(seed)
+    x0 = x.clone()
+    max_error = 0.0
+    try:
+        for _ in range(num_directions):
+            v = torch.randn(x.shape, generator=generator, dtype=x.dtype,
+                            device=x.device)
+            v /= v.norm()
+            x.copy_(x0).add_(v, alpha=h)
+            fxph = f(x)
+            x.copy_(x0).sub_(v, alpha=h)
+            fxmh = f(x)
+            diff = (fxph - fxmh) / (2 * h)
+            if dLdf is not None:
+                diff = diff * dLdf
+            numerical = diff.sum().item()
+            analytic = (analytic_grad * v).sum().item()
+            error = abs(numerical - analytic) / (
+                abs(numerical) + abs(analytic) + 1e-12)
+            max_error = max(max_error, error)
+            if verbose:
+                msg = "numerical: %f analytic: %f, relative error: %e"
+                print(msg % (numerical, analytic, error))
+    finally:
+        x.copy_(x0)
+    return max_error
+
+
+def check_conv_engines(x_shape=(2, 3, 7, 9), num_filters=4, pads=(0, 1, 2),
+                       dtype=torch.float64, device='cpu', tol=1e-10,
+                       seed=0):
+    """
+    Check the Im2ColConv and WinogradConv engines against FastConv on 3x3,
+    stride 1 convolutions with each padding in pads. The forward outputs,
+    including those written into an out= buffer, and the dx, dw and db of
+    the backward passes must all match within tol. The default odd height
+    and width exercise the partial output tiles of WinogradConv. Also
+    checks that WinogradConv raises ValueError on filters, strides and
+    paddings it does not support.
+
+    Inputs:
+    - x_shape: Shape (N, C, H, W) of the input
+    - num_filters: Number of 3x3 filters
+    - pads: Paddings to check
+    - dtype, device: Datatype and device of the inputs; the default tol
+      assumes float64
+    - tol: Largest allowed relative error
+    - seed: Seed of the private generator the inputs are drawn from
+
+    Returns:
+    - errors: Dictionary mapping (engine name, pad) to the maximum relative
+      error of out, dx, dw and db against FastConv
+    """
+    from convolutional_networks import FastConv, Im2ColConv, WinogradConv
+    generator = torch.Generator().manual_seed(seed)
+
+    def randn(*shape):
+        return torch.randn(shape, generator=generator,
+                           dtype=dtype).to(device)
+
+    x = randn(*x_shape)
+    w = randn(num_filters, x_shape[1], 3, 3)
+    b = randn(num_filters)
+    errors = {}
+    for pad in pads:
+        conv_param = {'stride': 1, 'pad': pad}
+        ref_out, ref_cache = FastConv.forward(x, w, b, conv_param)
+        dout = randn(*ref_out.shape)
+        ref_grads = FastConv.backward(dout, ref_cache)
+        for name, layer in (('im2col', Im2ColConv),
+                            ('winograd', WinogradConv)):
+            out, cache = layer.forward(x, w, b, conv_param)
+            buffered, _ = layer.forward(x, w, b, conv_param,
+                                        out=torch.empty_like(ref_out))
+            grads = layer.backward(dout, cache)
+            error = max(rel_error(out, ref_out),
+                        rel_error(buffered, ref_out),
+                        *[rel_error(g, r) for g, r in zip(grads, ref_grads)])
+            assert error < tol, \
+                '%s convolution with pad %d: relative error %e exceeds %e' \
+                % (name, pad, error, tol)
+            errors[name, pad] = error
+
+    unsupported = [(randn(num_filters, x_shape[1], 5, 5), 1, 2),
+                   (w, 2, 1), (w, 1, 3)]
+    for w_bad, stride, pad in unsupported:
+        conv_param = {'stride': stride, 'pad': pad}
+        try:
+            WinogradConv.forward(x, w_bad, b, conv_param)
+        except ValueError:
+            continue
+        raise AssertionError('WinogradConv accepted %s filters with %s'
+                             % (tuple(w_bad.shape[2:]), conv_param))
+    return errors
+
+
 def rel_error(x, y, eps=1e-10):
     """
     Compute the relative error between a pair of tensors x and y,
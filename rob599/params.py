@@ -0,0 +1,310 @@
+import collections.abc
+import math
+
+import torch
+
+
+class ParamStore(collections.abc.MutableMapping):
+    """
+    Dictionary of model parameters backed by flat storage.
+
+    All parameters with the same dtype and device share one contiguous 1-D
+    buffer, and each parameter is a named view into it, starting on a
+    64-byte boundary. The padding between views is kept at zero. A
+    ParamStore is a drop-in replacement for the dict of tensors held in
+    model.params:
+
+    - store[name] returns the view, so in-place updates of the returned
+      tensor update the store;
+    - store[name] = tensor copies tensor into the existing view when the
+      shape, dtype and device match, and re-lays out the buffers otherwise.
+
+    Whole-model operations (clone, copy_, zero_, norm, to, share_memory_ and
+    serialization) then touch one buffer per dtype instead of one tensor per
+    parameter.
+    """
+
+    ALIGNMENT = 64  # bytes
+
+    def __init__(self, params=None):
+        """
+        Inputs:
+        - params: Optional mapping from parameter names to tensors; the
+          tensors are copied into the store.
+        """
+        self._build(dict(params or {}))
+
+    def _build(self, params):
+        # Each buffer is keyed by (dtype, device); layout maps each name to
+        # (key, offset, shape), with the offset counted in elements.
+        layout, sizes = {}, {}
+        for k, v in params.items():
+            key = (v.dtype, v.device)
+            align = max(1, self.ALIGNMENT // v.element_size())
+            offset = sizes.get(key, 0)
+            offset += -offset % align
+            layout[k] = (key, offset, tuple(v.shape))
+            sizes[key] = offset + v.numel()
+        buffers = {key: torch.zeros(size, dtype=key[0], device=key[1])
+                   for key, size in sizes.items()}
+        self._attach(layout, buffers)
+        for k, v in params.items():
+            self._views[k].copy_(v)
+
+    def _attach(self, layout, buffers):
+        self._layout = layout
+        self.buffers = buffers
+        self._views = {}
+        for k, (key, offset, shape) in layout.items():
+            numel = math.prod(shape)
+            self._views[k] = buffers[key][offset:offset + numel].view(shape)
+
+    @classmethod
+    def from_buffers(cls, buffers, layout):
+        """
+        Create a store viewing existing buffers, without copying them.
+
+        Inputs:
+        - buffers: Dictionary mapping (dtype, device) keys to 1-D tensors
+        - layout: Dictionary mapping parameter names to (key, offset, shape)
+          tuples, with the offset counted in elements of the buffer
+        """
+        store = cls.__new__(cls)
+        store._attach(layout, buffers)
+        return store
+
+    @classmethod
+    def zeros(cls, shapes, dtype=torch.float32, device="cpu"):
+        """
+        Create a store of zero-filled parameters sharing a single buffer.
+
+        Inputs:
+        - shapes: Dictionary mapping parameter names to shapes
+        - dtype, device: Datatype and device of the buffer
+        """
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        align = max(1, cls.ALIGNMENT // itemsize)
+        offsets, size = {}, 0
+        for k, shape in shapes.items():
+            size += -size % align
+            offsets[k] = size
+            size += math.prod(shape)
+        buf = torch.zeros(size, dtype=dtype, device=device)
+        key = (buf.dtype, buf.device)
+        return cls.from_buffers(
+            {key: buf},
+            {k: (key, offsets[k], tuple(shape)) for k, shape in shapes.items()})
+
+    @property
+    def layout(self):
+        """
+        Dictionary mapping each parameter name to a (key, offset, shape)
+        tuple, where key is the (dtype, device) of its buffer.
+        """
+        return dict(self._layout)
+
+    def _same_layout(self, other):
+        return (isinstance(other, ParamStore)
+                and self._layout == other._layout)
+
+    def __getitem__(self, k):
+        return self._views[k]
+
+    def __setitem__(self, k, v):
+        view = self._views.get(k)
+        if view is not None and view.shape == v.shape and \
+                view.dtype == v.dtype and view.device == v.device:
+            view.copy_(v)
+            return
+        params = dict(self._views)
+        params[k] = v
+        self._build(params)
+
+    def __delitem__(self, k):
+        params = dict(self._views)
+        del params[k]
+        self._build(params)
+
+    def __iter__(self):
+        return iter(self._views)
+
+    def __len__(self):
+        return len(self._views)
+
+    def __repr__(self):
+        return "ParamStore(%s)" % ", ".join(
+            "%s: %s" % (k, tuple(v.shape)) for k, v in self._views.items())
+
+    def __getstate__(self):
+        # The views are rebuilt from the layout on unpickling
+        return {"layout": self._layout, "buffers": self.buffers}
+
+    def __setstate__(self, state):
+        self._attach(state["layout"], state["buffers"])
+
+    def clone(self):
+        """
+        Return a copy of the store with freshly allocated buffers.
+        """
+        return ParamStore.from_buffers(
+            {key: buf.clone() for key, buf in self.buffers.items()},
+            self._layout)
+
+    def copy_(self, params):
+        """
+        Copy the values of params into this store in place. When params is
+        a ParamStore with the same layout this is one copy per buffer.
+        """
+        if self._same_layout(params):
+            for key, buf in self.buffers.items():
+                buf.copy_(params.buffers[key])
+        else:
+            for k, v in params.items():
+                self._views[k].copy_(v)
+        return self
+
+    def zero_(self):
+        """
+        Set every parameter to zero in place.
+        """
+        for buf in self.buffers.values():
+            buf.zero_()
+        return self
+
+    def norm(self):
+        """
+        Return the L2 norm of all parameters taken together, as a scalar
+        tensor. Low precision buffers are accumulated in float32.
+        """
+        if not self.buffers:
+            return torch.tensor(0.0)
+        norms = []
+        for (dtype, device), buf in self.buffers.items():
+            acc = torch.promote_types(dtype, torch.float32)
+            norms.append(torch.linalg.vector_norm(buf, dtype=acc))
+        device = norms[0].device
+        return torch.linalg.vector_norm(
+            torch.stack([n.to(device, torch.float64) for n in norms]))
+
+    def to(self, device=None, dtype=None):
+        """
+        Return a store with every parameter on device and / or cast to
+        dtype. Each buffer is moved with a single copy and the views keep
+        their element offsets; if several buffers end up with the same dtype
+        and device, the parameters are laid out again in a single buffer.
+        """
+        buffers = {key: buf.to(device=device, dtype=dtype)
+                   for key, buf in self.buffers.items()}
+        keys = {key: (buf.dtype, buf.device) for key, buf in buffers.items()}
+        if len(set(keys.values())) < len(keys):
+            return ParamStore({k: v.to(device=device, dtype=dtype)
+                               for k, v in self._views.items()})
+        layout = {k: (keys[key], offset, shape)
+                  for k, (key, offset, shape) in self._layout.items()}
+        return ParamStore.from_buffers(
+            {keys[key]: buf for key, buf in buffers.items()}, layout)
+
+    def share_memory_(self):
+        """
+        Move the buffers to shared memory; the views follow them.
+        """
+        for buf in self.buffers.values():
+            buf.share_memory_()
+        return self
+
+    def nbytes(self):
+        """
+        Return the number of bytes held by the buffers, including padding.
+        """
+        return sum(buf.numel() * buf.element_size()
+                   for buf in self.buffers.values())
+
+
+def _init_values(init, shape):
+    # Return (std, fill) so that the parameter is std * randn + fill
+    if init in ("kaiming", "xavier"):
+        if len(shape) < 2:
+            raise ValueError('"%s" initialization needs a weight of at least '
+                             "two dimensions, got shape %s" % (init, shape))
+        # Linear weights are (Din, Dout), conv weights (Dout, Din, K, K)
+        fan_in = shape[0] if len(shape) == 2 else math.prod(shape[1:])
+        gain = 2.0 if init == "kaiming" else 1.0
+        return math.sqrt(gain / fan_in), 0.0
+    if init == "zeros":
+        return 0.0, 0.0
+    if init == "ones":
+        return 0.0, 1.0
+    if isinstance(init, str):
+        raise ValueError('Invalid initialization "%s"' % init)
+    return float(init), 0.0
+
+
+def initialize_params(specs, dtype=torch.float32, device="cpu", seed=None):
+    """
+    Allocate and initialize all parameters of a network at once.
+
+    The shapes of every layer are laid out up front in one zero-filled
+    ParamStore, with the randomly initialized parameters next to each other
+    at the start of the buffer and the constant ones after them. Without a
+    seed, that whole span is filled by a single draw from the random number
+    generator, and each parameter is then scaled in place by the standard
+    deviation its initialization asks for. The store still iterates over the
+    parameters in the order of specs.
+
+    Inputs:
+    - specs: Sequence of (name, shape, init) tuples, in parameter order,
+      where init is one of:
+      - a number: draw from a normal distribution with this standard
+        deviation;
+      - 'kaiming': draw from N(0, 2 / fan_in), for layers followed by a ReLU;
+      - 'xavier': draw from N(0, 1 / fan_in);
+      - 'zeros' or 'ones': fill with a constant.
+      fan_in is Din for a linear weight of shape (Din, Dout) and Din * K * K
+      for a convolution weight of shape (Dout, Din, K, K).
+    - dtype, device: Datatype and device of the parameters
+    - seed: If None, the draw uses the global random number generator.
+      Otherwise parameter i of specs is drawn from its own generator seeded
+      with seed + i, so every layer gets the same values whatever the shapes
+      of the other layers are.
+
+    Returns:
+    - params: A ParamStore holding the initialized parameters
+    """
+    specs = [(name, tuple(shape), init) for name, shape, init in specs]
+    stds = [_init_values(init, shape) for _, shape, init in specs]
+    random = [i for i, (std, _) in enumerate(stds) if std != 0]
+    constant = [i for i, (std, _) in enumerate(stds) if std == 0]
+    store = ParamStore.zeros({specs[i][0]: specs[i][1]
+                              for i in random + constant},
+                             dtype=dtype, device=device)
+    layout = store.layout
+    store = ParamStore.from_buffers(
+        store.buffers, {name: layout[name] for name, _, _ in specs})
+    (buf,) = store.buffers.values()
+
+    if seed is None and random:
+        # One draw over the weights; the padding between them is zeroed
+        # again below
+        first, last = specs[random[0]][0], specs[random[-1]][0]
+        start = layout[first][1]
+        end = layout[last][1] + store[last].numel()
+        torch.randn(end - start, dtype=dtype, device=buf.device,
+                    out=buf[start:end])
+    end = None
+    for i in random:
+        name, shape, _ = specs[i]
+        view, offset = store[name], layout[name][1]
+        if seed is None:
+            if end is not None:
+                buf[end:offset].zero_()
+            end = offset + view.numel()
+        else:
+            generator = torch.Generator(device=buf.device)
+            generator.manual_seed(seed + i)
+            torch.randn(shape, generator=generator, dtype=dtype,
+                        device=buf.device, out=view)
+        view.mul_(stds[i][0])
+    for i in constant:
+        if stds[i][1] != 0:
+            store[specs[i][0]].fill_(stds[i][1])
+    return store
@@ -1,7 +1,302 @@
+import contextlib
+import os
 import pickle
+import tempfile
 import time
+import traceback
 
 import torch
+import torch.multiprocessing as mp
+
+from .params import ParamStore
+
+
+class BestParams(object):
+    """
+    Keeps a snapshot of the best model parameters seen during training.
+
+    The snapshot can be stored in one of three ways:
+    - 'copy': Clone every parameter on each improvement. This is the simplest
+      option, but it allocates a fresh set of tensors every time.
+    - 'swap': Keep a second set of buffers that is allocated once and
+      overwritten in place on each improvement. When training ends the
+      buffers are swapped with the model parameters, so the old parameter
+      tensors become the buffers for the next call to train().
+    - 'mmap': Spill the snapshot to a memory-mapped file on disk, so that it
+      does not take up any host or device memory.
+    """
+
+    def __init__(self, storage="copy", path=None):
+        """
+        Inputs:
+        - storage: One of 'copy', 'swap' or 'mmap'.
+        - path: File used to back the snapshot when storage is 'mmap'. If
+          None, a temporary file is used.
+        """
+        if storage not in ("copy", "swap", "mmap"):
+            raise ValueError('Invalid best params storage "%s"' % storage)
+        self.storage = storage
+        self.path = path
+        self.params = {}
+        self.devices = {}
+
+    def __len__(self):
+        return len(self.params)
+
+    def update(self, params):
+        """
+        Record params as the new best parameters.
+        """
+        if self.storage == "copy":
+            if isinstance(params, ParamStore):
+                self.params = params.clone()
+            else:
+                self.params = {k: v.clone() for k, v in params.items()}
+            return
+
+        if not self._matches(params):
+            self._allocate(params)
+        if isinstance(self.params, ParamStore):
+            self.params.copy_(params)
+        else:
+            for k, v in params.items():
+                self.params[k].copy_(v)
+        for k, v in params.items():
+            self.devices[k] = v.device
+
+    def restore(self, params):
+        """
+        Return the best parameters recorded so far, to be used in place of
+        params. If no snapshot was ever recorded, params is returned as is.
+        """
+        if len(self.params) == 0:
+            return params
+        if self.storage == "swap":
+            # Swap the two sets of buffers instead of rebuilding a dict
+            best, self.params = self.params, params
+            return best
+        if self.storage == "mmap":
+            for k, v in self.params.items():
+                params[k].copy_(v.to(self.devices[k]))
+            return params
+        return self.params
+
+    def _matches(self, params):
+        if self.params.keys() != params.keys():
+            return False
+        for k, v in params.items():
+            buf = self.params[k]
+            if buf.shape != v.shape or buf.dtype != v.dtype:
+                return False
+            if self.storage == "swap" and buf.device != v.device:
+                return False
+        return True
+
+    def _allocate(self, params):
+        if self.storage == "swap":
+            if isinstance(params, ParamStore):
+                self.params = params.clone()
+            else:
+                self.params = {k: torch.empty_like(v)
+                               for k, v in params.items()}
+            return
+
+        # Lay out every parameter in a single file, aligning each one to 64
+        # bytes so that it can be viewed with its own dtype.
+        offsets, nbytes = {}, 0
+        for k, v in params.items():
+            offsets[k] = nbytes
+            nbytes += v.numel() * v.element_size()
+            nbytes += -nbytes % 64
+        path = self.path
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".best_params")
+            os.close(fd)
+        with open(path, "wb") as f:
+            f.truncate(max(nbytes, 1))
+        blob = torch.from_file(path, shared=True,
+                               size=max(nbytes, 1), dtype=torch.uint8)
+        if self.path is None:
+            # The mapping stays valid after the temporary file is unlinked
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.params = {}
+        for k, v in params.items():
+            start = offsets[k]
+            end = start + v.numel() * v.element_size()
+            self.params[k] = blob[start:end].view(v.dtype).view(v.shape)
+
+
+class TimeBudget(object):
+    """
+    Tracks how a training time budget is spent and predicts whether more work
+    still fits in it.
+
+    Separate exponential moving averages are kept for the cost of a training
+    step, an accuracy evaluation and a checkpoint save. This way a slow
+    epoch-end evaluation does not make the next training step look expensive,
+    and a fast step does not hide the cost of the evaluation that follows it.
+    """
+
+    KINDS = ("step", "eval", "checkpoint")
+
+    def __init__(self, time_limit=None, momentum=0.8, safety=1.1):
+        """
+        Inputs:
+        - time_limit: Budget in seconds, or None for an unlimited budget.
+        - momentum: Momentum of the moving cost estimates.
+        - safety: Factor applied to predicted costs to leave some slack.
+        """
+        self.time_limit = time_limit
+        self.momentum = momentum
+        self.safety = safety
+        self.start_time = time.time()
+        self.estimates = {}
+        self.totals = {k: 0.0 for k in self.KINDS}
+        self.counts = {k: 0 for k in self.KINDS}
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    def remaining(self):
+        if self.time_limit is None:
+            return float("inf")
+        return self.time_limit - self.elapsed()
+
+    @contextlib.contextmanager
+    def timing(self, kind):
+        """
+        Context manager that records the time spent in its body as kind.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(kind, time.time() - start)
+
+    def record(self, kind, seconds):
+        self.totals[kind] += seconds
+        self.counts[kind] += 1
+        est = self.estimates.get(kind)
+        if est is None:
+            self.estimates[kind] = seconds
+        else:
+            m = self.momentum
+            self.estimates[kind] = m * est + (1 - m) * seconds
+
+    def estimate(self, kind):
+        return self.estimates.get(kind, 0.0)
+
+    def cost(self, steps=0, evals=0, checkpoints=0):
+        """
+        Predicted time in seconds for the given amount of work.
+        """
+        cost = steps * self.estimate("step") \
+            + evals * self.estimate("eval") \
+            + checkpoints * self.estimate("checkpoint")
+        return self.safety * cost
+
+    def fits(self, steps=0, evals=0, checkpoints=0):
+        return self.cost(steps, evals, checkpoints) <= self.remaining()
+
+    def plan(self, steps_left, steps_to_epoch_end, iterations_per_epoch,
+             checkpoints=False):
+        """
+        Predict how many of the remaining training steps fit in the budget,
+        assuming an evaluation (and optionally a checkpoint) at the end of
+        every epoch plus one final evaluation of the last parameters.
+        """
+        remaining = self.remaining() - self.cost(evals=1)
+        step = self.cost(steps=1)
+        if step <= 0 or remaining == float("inf"):
+            return steps_left
+        epoch_extra = self.cost(evals=1, checkpoints=int(checkpoints))
+
+        planned = 0
+        chunk = min(steps_left, steps_to_epoch_end)
+        while planned < steps_left:
+            chunk_cost = chunk * step + epoch_extra
+            if chunk_cost > remaining:
+                break
+            planned += chunk
+            remaining -= chunk_cost
+            chunk = min(steps_left - planned, iterations_per_epoch)
+        partial = int(max(remaining, 0) // step)
+        return min(steps_left, planned + partial)
+
+    def report(self):
+        """
+        Summarize how the time was used so far.
+        Returns a dictionary with the total elapsed time, the time limit, and
+        for each kind of work its total time, count and current estimate.
+        Time that was not attributed to any kind is reported as 'other'.
+        """
+        elapsed = self.elapsed()
+        report = {"time_limit": self.time_limit, "elapsed": elapsed}
+        for k in self.KINDS:
+            report[k] = {
+                "total": self.totals[k],
+                "count": self.counts[k],
+                "estimate": self.estimate(k),
+            }
+        report["other"] = elapsed - sum(self.totals.values())
+        return report
+
+
+_BN_STAT_KEYS = ("running_mean", "running_var")
+
+
+def _bn_stats(model):
+    """
+    Return the batchnorm running statistics of model, one dict per layer.
+    """
+    return [{k: bn[k] for k in _BN_STAT_KEYS if k in bn}
+            for bn in getattr(model, "bn_params", [])]
+
+
+def _data_parallel_worker(rank, model, seed, num_threads, tasks, results):
+    """
+    Worker loop for data-parallel training. Each task is a
+    (X, y, scale, dropout_seed, bn_stats) shard of a minibatch; the worker
+    answers with the loss, the gradients and the batchnorm running
+    statistics computed by model.loss on that shard. model.params live in
+    shared memory, so the worker always sees the parameters most recently
+    written by the Solver. The rest of the model state that the Solver owns
+    travels with each task: the current loss scale with mixed precision,
+    the dropout seed of the shard, if any, and the running statistics to
+    start from.
+    """
+    torch.set_num_threads(num_threads)
+    # Give each worker its own random streams, e.g. for dropout masks
+    torch.manual_seed(seed + rank)
+    if hasattr(model, "reset_dropout_generators"):
+        model.reset_dropout_generators(seed + rank)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        X, y, scale, dropout_seed, bn_stats = task
+        if scale is not None:
+            model.loss_scaler.scale = scale
+        dropout_param = getattr(model, "dropout_param", None)
+        if dropout_param is not None:
+            if dropout_seed is None:
+                dropout_param.pop("seed", None)
+            else:
+                dropout_param["seed"] = dropout_seed
+        for bn, stats in zip(getattr(model, "bn_params", []), bn_stats):
+            for k in _BN_STAT_KEYS:
+                if k in stats:
+                    bn[k] = stats[k]
+                else:
+                    bn.pop(k, None)
+        try:
+            loss, grads = model.loss(X, y)
+            results.put((rank, loss.item(), grads, _bn_stats(model)))
+        except Exception:
+            results.put((rank, None, traceback.format_exc(), None))
 
 
 class Solver(object):
@@ -95,6 +390,19 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - best_params_storage: How to keep the best parameters seen so far;
+          one of 'copy', 'swap' or 'mmap'. See BestParams for details.
+        - best_params_path: File backing the best parameters when
+          best_params_storage is 'mmap'. Defaults to a temporary file.
+        - num_workers: If greater than 1, split each minibatch across this
+          many worker processes that compute model.loss on their shard in
+          parallel; the gradients are then averaged into a single update.
+          model.params are placed in shared memory. Only supported on CPU.
+        - accumulation_steps: Split each minibatch into this many micro-batches
+          and accumulate their gradients before making a single update. This
+          lowers peak memory use at the cost of throughput. Batchnorm running
+          statistics are updated once per minibatch, but each micro-batch is
+          normalized with its own statistics.
         """
         self.model = model
         self.X_train = data["X_train"]
@@ -117,11 +425,19 @@ class Solver(object):
         self.print_every = kwargs.pop("print_every", 10)
         self.print_acc_every = kwargs.pop("print_acc_every", 1)
         self.verbose = kwargs.pop("verbose", True)
+        self.best_params_storage = kwargs.pop("best_params_storage", "copy")
+        self.best_params_path = kwargs.pop("best_params_path", None)
+        self.num_workers = kwargs.pop("num_workers", 1)
+        self.accumulation_steps = kwargs.pop("accumulation_steps", 1)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
             extra = ", ".join('"%s"' % k for k in list(kwargs.keys()))
             raise ValueError("Unrecognized arguments %s" % extra)
+        if self.num_workers > 1 and torch.device(self.device).type != "cpu":
+            raise ValueError("Data-parallel training is only supported "
+                             "on the CPU")
+        self._workers = []
 
         self._reset()
 
@@ -133,10 +449,13 @@ class Solver(object):
         # Set up some variables for book-keeping
         self.epoch = 0
         self.best_val_acc = 0
-        self.best_params = {}
+        self.best_tracker = BestParams(self.best_params_storage,
+                                       self.best_params_path)
+        self.best_params = self.best_tracker.params
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self._grad_buffers = None
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -156,18 +475,194 @@ class Solver(object):
         y_batch = self.y_train[batch_mask].to(self.device)
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.accumulation_steps > 1:
+            loss, grads = self._accumulated_loss(X_batch, y_batch)
+        else:
+            loss, grads = self._loss(X_batch, y_batch)
         self.loss_history.append(loss.item())
 
+        # With mixed precision, skip the update if the gradients overflowed;
+        # the model's loss scaler lowers the scale for the next step.
+        scaler = getattr(self.model, "loss_scaler", None)
+        if scaler is not None and scaler.update(grads):
+            return
+
         # Perform a parameter update
         with torch.no_grad():
             for p, w in self.model.params.items():
                 dw = grads[p]
                 config = self.optim_configs[p]
                 next_w, next_config = self.update_rule(w, dw, config)
-                self.model.params[p] = next_w
+                if self._workers:
+                    # Keep the parameters in shared memory
+                    w.copy_(next_w)
+                else:
+                    self.model.params[p] = next_w
                 self.optim_configs[p] = next_config
 
+    def _loss(self, X, y):
+        """
+        Compute the loss and gradients for a minibatch, either directly or by
+        sharding it across the data-parallel workers.
+        """
+        if not self._workers:
+            return self.model.loss(X, y)
+
+        shards = list(zip(X.tensor_split(len(self._workers)),
+                          y.tensor_split(len(self._workers))))
+        shards = [(Xs, ys) for Xs, ys in shards if ys.shape[0] > 0]
+        scaler = getattr(self.model, "loss_scaler", None)
+        scale = scaler.scale if scaler is not None else None
+        # Every worker starts from the model's current running statistics,
+        # so the ranks never drift apart. A fixed dropout seed is offset per
+        # rank, past the offsets of the layers and micro-batches, so that
+        # the shards do not share a mask pattern.
+        bn_stats = _bn_stats(self.model)
+        seed = getattr(self.model, "dropout_param", {}).get("seed")
+        stride = self._dropout_seed_stride() * self.accumulation_steps
+        for rank, ((Xs, ys), (_, tasks)) in enumerate(
+                zip(shards, self._workers)):
+            dropout_seed = None if seed is None else seed + rank * stride
+            tasks.put((Xs, ys, scale, dropout_seed, bn_stats))
+
+        outputs = [None] * len(shards)
+        for _ in range(len(shards)):
+            rank, loss, grads, stats = self._results.get()
+            if loss is None:
+                raise RuntimeError("Data-parallel worker %d failed:\n%s"
+                                   % (rank, grads))
+            outputs[rank] = (loss, grads, stats)
+
+        # model.loss averages over the minibatch, so weight each shard by its
+        # size. Reduce in rank order to keep the result deterministic. The
+        # running statistics are averaged the same way, which matches one
+        # update with the averaged shard statistics.
+        N = y.shape[0]
+        total_loss, total_grads = 0.0, {}
+        total_stats = [{} for _ in bn_stats]
+        for (_, ys), (loss, grads, stats) in zip(shards, outputs):
+            weight = ys.shape[0] / N
+            total_loss += weight * loss
+            for k, g in grads.items():
+                if k in total_grads:
+                    total_grads[k].add_(g, alpha=weight)
+                else:
+                    total_grads[k] = g.mul_(weight)
+            for totals, worker_stats in zip(total_stats, stats):
+                for k, v in worker_stats.items():
+                    totals[k] = weight * v + totals.get(k, 0)
+        for bn, totals in zip(getattr(self.model, "bn_params", []),
+                              total_stats):
+            bn.update(totals)
+        return torch.tensor(total_loss), total_grads
+
+    def _dropout_seed_stride(self):
+        """
+        Number of consecutive dropout seeds one forward pass of the model
+        uses: the model offsets a fixed seed by the layer index.
+        """
+        return max(1, getattr(self.model, "num_layers", 2) - 1)
+
+    def _accumulated_loss(self, X, y):
+        """
+        Compute the loss and gradients for a minibatch as the weighted sum over
+        accumulation_steps micro-batches. Gradients are summed into buffers
+        that are allocated once and reused for every step.
+        """
+        N = y.shape[0]
+        chunks = zip(X.tensor_split(self.accumulation_steps),
+                     y.tensor_split(self.accumulation_steps))
+        chunks = [(Xc, yc) for Xc, yc in chunks if yc.shape[0] > 0]
+
+        if self._grad_buffers is None:
+            params = self.model.params
+            if isinstance(params, ParamStore):
+                self._grad_buffers = params.clone().zero_()
+            else:
+                self._grad_buffers = {k: torch.zeros_like(v)
+                                      for k, v in params.items()}
+        elif isinstance(self._grad_buffers, ParamStore):
+            self._grad_buffers.zero_()
+        else:
+            for buf in self._grad_buffers.values():
+                buf.zero_()
+
+        # Batchnorm layers update their running statistics on every forward
+        # pass. Start each micro-batch from the same statistics and average
+        # the results, which is equivalent to a single update with the
+        # averaged micro-batch statistics.
+        bn_params = getattr(self.model, "bn_params", [])
+        start_stats = _bn_stats(self.model)
+        end_stats = [{} for _ in bn_params]
+
+        # A fixed dropout seed would give every micro-batch the same mask
+        # pattern, so offset it for each micro-batch. The model already
+        # offsets the seed by the layer index, so stride the micro-batch
+        # offsets by the number of dropout layers to keep all seeds distinct.
+        dropout_param = getattr(self.model, "dropout_param", {})
+        seed = dropout_param.get("seed")
+        seed_stride = self._dropout_seed_stride()
+
+        total_loss = 0.0
+        try:
+            for i, (Xc, yc) in enumerate(chunks):
+                weight = yc.shape[0] / N
+                for bn, stats in zip(bn_params, start_stats):
+                    for k in _BN_STAT_KEYS:
+                        if k in stats:
+                            bn[k] = stats[k]
+                        else:
+                            bn.pop(k, None)
+                if seed is not None:
+                    dropout_param["seed"] = seed + i * seed_stride
+
+                loss, grads = self._loss(Xc, yc)
+                total_loss += weight * loss.item()
+                for k, g in grads.items():
+                    self._grad_buffers[k].add_(g, alpha=weight)
+
+                for bn, stats in zip(bn_params, end_stats):
+                    for k in _BN_STAT_KEYS:
+                        if k in bn:
+                            stats[k] = weight * bn[k] + stats.get(k, 0)
+        finally:
+            if seed is not None:
+                dropout_param["seed"] = seed
+
+        for bn, stats in zip(bn_params, end_stats):
+            bn.update(stats)
+        return torch.tensor(total_loss), self._grad_buffers
+
+    def _start_workers(self):
+        """
+        Start the data-parallel worker processes, if requested.
+        """
+        if self.num_workers <= 1 or self._workers:
+            return
+        if isinstance(self.model.params, ParamStore):
+            self.model.params.share_memory_()
+        else:
+            for w in self.model.params.values():
+                w.share_memory_()
+        seed = int(torch.randint(2 ** 31 - 1, (1,)).item())
+        num_threads = max(1, torch.get_num_threads() // self.num_workers)
+        self._results = mp.Queue()
+        for rank in range(self.num_workers):
+            tasks = mp.Queue()
+            worker = mp.Process(target=_data_parallel_worker,
+                                args=(rank, self.model, seed, num_threads,
+                                      tasks, self._results),
+                                daemon=True)
+            worker.start()
+            self._workers.append((worker, tasks))
+
+    def _stop_workers(self):
+        for _, tasks in self._workers:
+            tasks.put(None)
+        for worker, _ in self._workers:
+            worker.join()
+        self._workers = []
+
     def _save_checkpoint(self):
         if self.checkpoint_name is None:
             return
@@ -229,41 +724,109 @@ class Solver(object):
         X = X.to(self.device)
         y = y.to(self.device)
 
-        # Compute predictions in batches
-        num_batches = N // batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(torch.argmax(scores, dim=1))
-
-        y_pred = torch.cat(y_pred)
+        # Compute predictions in batches, through the model's cache-free
+        # inference path if it has one
+        predict = getattr(self.model, "predict", None)
+        if predict is not None:
+            y_pred = predict(X, batch_size=batch_size)[0][:, 0]
+        else:
+            y_pred = []
+            for start in range(0, N, batch_size):
+                scores = self.model.loss(X[start:start + batch_size])
+                y_pred.append(torch.argmax(scores, dim=1))
+            y_pred = torch.cat(y_pred)
         acc = (y_pred == y).to(torch.float).mean()
 
         return acc.item()
 
+    def _evaluate(self, budget):
+        """
+        Check train and val accuracy, save a checkpoint and keep track of the
+        best model. This is called by train() and should not be called
+        manually.
+        """
+        with torch.no_grad(), budget.timing("eval"):
+            train_acc = \
+                self.check_accuracy(self.X_train,
+                                    self.y_train,
+                                    num_samples=self.num_train_samples)
+            val_acc = \
+                self.check_accuracy(self.X_val,
+                                    self.y_val,
+                                    num_samples=self.num_val_samples)
+            self.train_acc_history.append(train_acc)
+            self.val_acc_history.append(val_acc)
+
+            # Keep track of the best model
+            if val_acc > self.best_val_acc:
+                self.best_val_acc = val_acc
+                self.best_tracker.update(self.model.params)
+                self.best_params = self.best_tracker.params
+
+        if self.checkpoint_name is not None:
+            with budget.timing("checkpoint"):
+                self._save_checkpoint()
+
+        if self.verbose and self.epoch % self.print_acc_every == 0:
+            print(
+                "(Epoch %d / %d) train acc: %f; val_acc: %f"
+                % (self.epoch, self.num_epochs, train_acc, val_acc)
+            )
+
     def train(self, time_limit=None, return_best_params=True):
         """
         Run optimization to train the model.
+
+        Inputs:
+        - time_limit: If not None, a budget in seconds for the whole call.
+          After every evaluation the remaining iterations, evaluations and
+          checkpoints are planned with TimeBudget.plan; training stops after
+          the last iteration that fits, which is evaluated like the last
+          iteration of the final epoch. Each iteration is still checked
+          against the budget in case the estimates were too optimistic.
+        - return_best_params: If True, swap the parameters that performed best
+          on the validation set into the model at the end of training.
+
+        After training, solver.time_report describes how the time was spent;
+        see TimeBudget.report().
         """
         num_train = self.X_train.shape[0]
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
-        prev_time = start_time = time.time()
-
-        for t in range(num_iterations):
+        budget = TimeBudget(time_limit)
+        self.time_budget = budget
+        ckpt = int(self.checkpoint_name is not None)
+        last_eval = -1
+        # Iteration at which training stops, updated from the budget plan
+        stop_at = num_iterations
+
+        self._start_workers()
+        try:
+            for t in range(num_iterations):
+                if t >= stop_at:
+                    if self.verbose:
+                        print("(Time %.2f sec; Iteration %d / %d) End of "
+                              "training; the remaining iterations do not fit "
+                              "in the time limit."
+                              % (budget.elapsed(), t, num_iterations))
+                    break
 
-            cur_time = time.time()
-            if (time_limit is not None) and (t > 0):
-                next_time = cur_time - prev_time
-                if cur_time - start_time + next_time > time_limit:
+                # Check train and val accuracy on the first iteration, the
+                # last iteration, and at the end of each epoch.
+                first_it = t == 0
+                last_it = t == stop_at - 1
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                do_eval = first_it or last_it or epoch_end
+
+                # Every iteration must leave room for one evaluation: either
+                # its own epoch-end evaluation or the final one after we stop.
+                checkpoints = ckpt if do_eval else 0
+                if t > 0 and not budget.fits(steps=1, evals=1,
+                                             checkpoints=checkpoints):
                     print(
                         "(Time %.2f sec; Iteration %d / %d) loss: %f"
                         % (
-                            cur_time - start_time,
+                            budget.elapsed(),
                             t,
                             num_iterations,
                             self.loss_history[-1],
@@ -271,62 +834,75 @@ class Solver(object):
                     )
                     print("End of training; next iteration "
                           "will exceed the time limit.")
+                    if last_eval != t - 1 and budget.fits(evals=1):
+                        self._evaluate(budget)
                     break
-            prev_time = cur_time
-
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print(
-                    "(Time %.2f sec; Iteration %d / %d) loss: %f"
-                    % (
-                        time.time() - start_time,
-                        t + 1,
-                        num_iterations,
-                        self.loss_history[-1],
-                    )
-                )
 
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]["learning_rate"] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            with torch.no_grad():
-                first_it = t == 0
-                last_it = t == num_iterations - 1
-                if first_it or last_it or epoch_end:
-                    train_acc = \
-                        self.check_accuracy(self.X_train,
-                                            self.y_train,
-                                            num_samples=self.num_train_samples)
-                    val_acc = \
-                        self.check_accuracy(self.X_val,
-                                            self.y_val,
-                                            num_samples=self.num_val_samples)
-                    self.train_acc_history.append(train_acc)
-                    self.val_acc_history.append(val_acc)
-                    self._save_checkpoint()
-
-                    if self.verbose and self.epoch % self.print_acc_every == 0:
-                        print(
-                            "(Epoch %d / %d) train acc: %f; val_acc: %f"
-                            % (self.epoch, self.num_epochs, train_acc, val_acc)
+                with budget.timing("step"):
+                    self._step()
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
+                    print(
+                        "(Time %.2f sec; Iteration %d / %d) loss: %f"
+                        % (
+                            budget.elapsed(),
+                            t + 1,
+                            num_iterations,
+                            self.loss_history[-1],
                         )
+                    )
 
-                    # Keep track of the best model
-                    if val_acc > self.best_val_acc:
-                        self.best_val_acc = val_acc
-                        self.best_params = {}
-                        for k, v in self.model.params.items():
-                            self.best_params[k] = v.clone()
+                # At the end of every epoch, increment the epoch counter and
+                # decay the learning rate.
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        config = self.optim_configs[k]
+                        config["learning_rate"] *= self.lr_decay
+
+                if do_eval:
+                    self._evaluate(budget)
+                    last_eval = t
+                    if time_limit is not None and not last_it:
+                        steps_left = num_iterations - t - 1
+                        to_epoch_end = iterations_per_epoch \
+                            - (t + 1) % iterations_per_epoch
+                        planned = budget.plan(
+                            steps_left,
+                            to_epoch_end,
+                            iterations_per_epoch,
+                            checkpoints=ckpt,
+                        )
+                        stop_at = t + 1 + planned
+                        if self.verbose:
+                            print("(Time %.2f sec) about %d / %d remaining "
+                                  "iterations fit in the time limit"
+                                  % (budget.elapsed(), planned, steps_left))
+        finally:
+            self._stop_workers()
+
+        self.time_report = budget.report()
+        if self.verbose and time_limit is not None:
+            report = self.time_report
+            print(
+                "Used %.2f / %.2f sec: steps %.2f sec (%d), evals %.2f sec "
+                "(%d), checkpoints %.2f sec (%d), other %.2f sec"
+                % (
+                    report["elapsed"],
+                    time_limit,
+                    report["step"]["total"],
+                    report["step"]["count"],
+                    report["eval"]["total"],
+                    report["eval"]["count"],
+                    report["checkpoint"]["total"],
+                    report["checkpoint"]["count"],
+                    report["other"],
+                )
+            )
 
         # At the end of training swap the best params into the model
         if return_best_params:
-            self.model.params = self.best_params
+            self.model.params = \
+                self.best_tracker.restore(self.model.params)
+            self.best_params = self.model.params